@@ -1,9 +1,10 @@
 import networkx as nx
-from anm import OverlayNode, OverlayEdge
+from anm import OverlayNode, OverlayEdge, expand_mesh_groups
 from collections import defaultdict
 import itertools
 import pprint
 import autonetkit.log as log
+import autonetkit.anm_columns as anm_columns
 from ank_utils import unwrap_nodes, unwrap_graph, unwrap_edges
 
 try:
@@ -34,6 +35,9 @@ def set_node_default(OverlayGraph, nbunch, **kwargs):
             if key not in graph.node[node]:
                 graph.node[node][key] = val
 
+    for key in kwargs:
+        OverlayGraph._anm._invalidate_attr_index(OverlayGraph._overlay_id, key)
+
 
 #TODO: also add ability to copy multiple attributes
 
@@ -43,26 +47,39 @@ def copy_attr_from(overlay_src, overlay_dst, src_attr, dst_attr = None, nbunch =
     if not dst_attr:
         dst_attr = src_attr
 
-    graph_src = unwrap_graph(overlay_src)
     graph_dst = unwrap_graph(overlay_dst)
-    if not nbunch:
-        nbunch = graph_src.nodes()
-
-    for n in nbunch:
-        try:
-            val = graph_src.node[n][src_attr]
-        except KeyError:
-            #TODO: check if because node doesn't exist in dest, or because attribute doesn't exist in graph_src
-            log.debug("Unable to copy node attribute %s for %s in %s" % (src_attr, n, overlay_src))
-        else:
-            #TODO: use a dtype to take an int, float, etc
-            if type is float:
-                val = float(val)
-            elif type is int:
-                val = int(val)
-
-            if n in graph_dst:
-                graph_dst.node[n][dst_attr] = val
+    if nbunch:
+        nbunch = list(nbunch)
+
+    columns_src = overlay_src._columns
+    columns_dst = overlay_dst._columns
+    if (type is None and columns_src is not None and columns_dst is not None
+            and columns_src.ids is columns_dst.ids):
+        # same rows in both overlays: copy column
+        node_ids = None
+        if nbunch:
+            graph_src = unwrap_graph(overlay_src)
+            node_ids = [n for n in (getattr(node, "node_id", node)
+                for node in nbunch) if n in graph_src]
+        copied = columns_dst.copy(columns_src, src_attr, dst_attr, node_ids)
+        if nbunch and copied < len(nbunch):
+            log.debug("Unable to copy node attribute %s for %s nodes in %s" % (
+                src_attr, len(nbunch) - copied, overlay_src))
+        overlay_dst._node_attr_changed(dst_attr)
+        return
+
+    values = overlay_src.get_node_attr(src_attr, nbunch)
+    if nbunch and len(values) < len(nbunch):
+        #TODO: check if because node doesn't exist in dest, or because attribute doesn't exist in graph_src
+        log.debug("Unable to copy node attribute %s for %s nodes in %s" % (
+            src_attr, len(nbunch) - len(values), overlay_src))
+
+    #TODO: use a dtype to take an int, float, etc
+    if type in (float, int):
+        values = dict((n, type(val)) for n, val in values.iteritems())
+
+    overlay_dst.set_node_attr(dst_attr, dict((n, val)
+        for n, val in values.iteritems() if n in graph_dst))
 
 def copy_edge_attr_from(overlay_src, overlay_dst, src_attr, dst_attr = None, type = None):
     graph_src = unwrap_graph(overlay_src)
@@ -112,6 +129,9 @@ def stringify_netaddr(graph):
 def save(OverlayGraph):
     import netaddr
     graph = OverlayGraph._graph.copy() # copy as want to annotate
+    graph = OverlayGraph._anm._materialise_view(OverlayGraph._overlay_id,
+            graph)
+    expand_mesh_groups(graph)
 
 # and put in basic attributes
     for node in OverlayGraph:
@@ -210,6 +230,8 @@ def split(OverlayGraph, edges, retain = []):
 
     graph.remove_edges_from(edges)
     graph.add_edges_from(edges_to_add)
+    OverlayGraph._anm._invalidate_interface_index(OverlayGraph._overlay_id)
+    OverlayGraph._anm._invalidate_attr_index(OverlayGraph._overlay_id)
 
     return wrap_nodes(OverlayGraph, added_nodes)
 
@@ -232,6 +254,8 @@ def explode_nodes(OverlayGraph, nodes, retain = []):
     nodes = list(nodes)
 #TODO: if graph is bidirectional, need to explode here too
 #TODO: how do we handle explode for multi graphs?
+# sessions are nx edges rather than a mesh group: each pair has its own
+# interfaces, build_ospf sets area and cost per pair, and removes inter-AS pairs
     for node in nodes:
         log.debug("Exploding from %s" % node)
         neighbors = graph.neighbors(node)
@@ -255,6 +279,9 @@ def explode_nodes(OverlayGraph, nodes, retain = []):
         added_edges += edges_to_add
 
         graph.remove_node(node)
+
+    OverlayGraph._anm._invalidate_interface_index(OverlayGraph._overlay_id)
+    OverlayGraph._anm._invalidate_attr_index(OverlayGraph._overlay_id)
     return wrap_edges(OverlayGraph, added_edges)
 
 def label(OverlayGraph, nodes):
@@ -321,6 +348,8 @@ def aggregate_nodes(OverlayGraph, nodes, retain = []):
             total_added_edges += edges_to_add
             graph.remove_nodes_from(nodes_to_remove)
 
+    OverlayGraph._anm._invalidate_interface_index(OverlayGraph._overlay_id)
+    OverlayGraph._anm._invalidate_attr_index(OverlayGraph._overlay_id)
     return wrap_edges(OverlayGraph, total_added_edges)
 
 # chain of two or more nodes
@@ -367,6 +396,24 @@ def neigh_average(OverlayGraph, node, attribute, attribute_graph = None):
     except ValueError:
         return most_frequent(values)
 
+def neigh_averages(OverlayGraph, nodes, attribute, attribute_graph = None):
+    """ returns list of neigh_average of attribute for each of nodes
+    if attribute is stored in numeric columns, averages over the CSR
+        adjacency of OverlayGraph
+    """
+    nodes = list(nodes)
+    graph = unwrap_graph(OverlayGraph)
+    columns = (attribute_graph or OverlayGraph)._columns
+    if columns is not None and OverlayGraph._columns is not None:
+        indptr, indices = anm_columns.adjacency(graph, columns.ids)
+        averages = columns.neighbor_means(attribute, indptr, indices,
+                [n.node_id for n in nodes])
+        if averages is not None:
+            return [averages[n.node_id] for n in nodes]
+
+    return [neigh_average(OverlayGraph, n, attribute, attribute_graph)
+            for n in nodes]
+
 def neigh_attr(OverlayGraph, node, attribute, attribute_graph = None):
     #TODO: tidy up parameters to take attribute_graph first, and then evaluate if attribute_graph set, if not then use attribute_graph as attribute
 #TODO: explain how OverlayGraph and attribute_graph work, eg for G_ip and G_phy
@@ -4,6 +4,7 @@ from networkx.readwrite import json_graph
 import netaddr
 import string
 import autonetkit.anm
+import autonetkit.anm_columns as anm_columns
 import autonetkit.log as log
 
 class AnkEncoder(json.JSONEncoder):
@@ -19,13 +20,12 @@ class AnkEncoder(json.JSONEncoder):
             #TODO: add documentation about serializing anm nodes
             log.warning("%s is anm overlay_node. Use attribute rather than object in compiler." % obj)
             return str(obj)
-        if isinstance(obj, autonetkit.plugins.ipv4.TreeNode):
-            #TODO: add documentation about serializing anm nodes
-            return str(obj)
         if isinstance(obj, autonetkit.anm.OverlayEdge):
             #TODO: add documentation about serializing anm nodes
             log.warning("%s is anm overlay_edge. Use attribute rather than object in compiler." % obj)
             return str(obj)
+        if isinstance(obj, anm_columns.ColumnNodeData):
+            return dict(obj)
         if isinstance(obj, autonetkit.nidb.nidb_node_category):
             #TODO: add documentation about serializing anm nodes
             log.debug("%s is nidb nidb_node_category. Use attribute rather than object in compiler." % obj)
@@ -100,7 +100,9 @@ def jsonify_anm(anm):
     """ Returns a dictionary of json-ified overlay graphs"""
     anm_json = {}
     for overlay_id in anm.overlays():
-        OverlayGraph = anm[overlay_id]._graph.copy()
+        OverlayGraph = anm._materialise_view(overlay_id,
+                anm[overlay_id]._graph.copy())
+        autonetkit.anm.expand_mesh_groups(OverlayGraph)
         for n in OverlayGraph:
             try:
                 del OverlayGraph.node[n]['id']
@@ -113,20 +115,30 @@ def jsonify_anm(anm):
 def jsonify_anm_with_graphics(anm):
     """ Returns a dictionary of json-ified overlay graphs, with graphics data appended to each overlay"""
     anm_json = {}
-    graphics_graph = anm["graphics"]._graph.copy()
+    # graphics attributes are the same for each overlay, so read columns once
+    g_graphics = anm["graphics"]
+    x = g_graphics.get_node_attr('x')
+    y = g_graphics.get_node_attr('y')
+    asn = g_graphics.get_node_attr('asn')
+    device_type = g_graphics.get_node_attr('device_type')
+    device_subtype = g_graphics.get_node_attr('device_subtype')
+    pop = g_graphics.get_node_attr('pop')
+
     for overlay_id in anm.overlays():
-        OverlayGraph = anm[overlay_id]._graph.copy()
+        OverlayGraph = anm._materialise_view(overlay_id,
+                anm[overlay_id]._graph.copy())
+        autonetkit.anm.expand_mesh_groups(OverlayGraph)
 
 
 #TODO: only update, don't over write if already set
         for n in OverlayGraph:
             OverlayGraph.node[n].update( {
-                'x': graphics_graph.node[n]['x'],
-                'y': graphics_graph.node[n]['y'],
-                'asn': graphics_graph.node[n]['asn'],
-                'device_type': graphics_graph.node[n]['device_type'],
-                'device_subtype': graphics_graph.node[n].get('device_subtype'),
-                'pop': graphics_graph.node[n].get('pop'),
+                'x': x[n],
+                'y': y[n],
+                'asn': asn[n],
+                'device_type': device_type[n],
+                'device_subtype': device_subtype.get(n),
+                'pop': pop.get(n),
                 })
 
             try:
@@ -134,17 +146,9 @@ def jsonify_anm_with_graphics(anm):
             except KeyError:
                 pass
 
-#TODO: combine these, and round as necessary
-        x = (OverlayGraph.node[n]['x'] for n in OverlayGraph)
-        y = (OverlayGraph.node[n]['y'] for n in OverlayGraph)
-        try:
-            x_min = min(x)
-        except ValueError:
-            x_min = 0
-        try:
-            y_min = min(y)
-        except ValueError:
-            y_min = 0
+#TODO: round as necessary
+        x_min = g_graphics.min_node_attr('x', OverlayGraph, 0)
+        y_min = g_graphics.min_node_attr('y', OverlayGraph, 0)
         for n in OverlayGraph:
             OverlayGraph.node[n]['x'] += - x_min
             OverlayGraph.node[n]['y'] += - y_min
@@ -153,7 +157,11 @@ def jsonify_anm_with_graphics(anm):
     return anm_json
 
 def jsonify_nidb(nidb):
-    graph = nidb._graph
+    # copy node data, as positions are only normalised for publishing: the
+    # compile cache reuses nidb node data, and dynagen renders positions
+    graph = nidb._graph.__class__(nidb._graph)
+    for node in graph:
+        graph.node[node] = dict(graph.node[node])
     for node in graph:
         graph.node[node]['x'] = graph.node[node]['graphics']['x']
         graph.node[node]['y'] = graph.node[node]['graphics']['y']
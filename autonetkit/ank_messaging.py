@@ -1,6 +1,9 @@
 import autonetkit.config as config
 import autonetkit.log as log
 import socket
+import threading
+import time
+import atexit
 import autonetkit.ank_json
 
 use_rabbitmq = config.settings['Rabbitmq']['active']
@@ -16,19 +19,187 @@ if use_http_post:
     import urllib
 
 
-def update_http(anm = None, nidb = None):
-    host = config.settings['Http Post']['server']
-    port = config.settings['Http Post']['port']
-    http_url = "http://%s:%s/publish" % (host, port)
+class HttpPublisher(object):
+    """Publishes ANM (and NIDB) snapshots to the visualisation server.
+
+    Submitted snapshots are coalesced: submit only records the latest, and
+    it is serialised at most once per send_interval. Serialising is on the
+    caller's thread, as the build goes on changing the overlays, and the
+    POST is from a background thread, so sending never blocks the build.
+    A snapshot submitted within the interval is serialised by the next
+    submit after it, or by flush. If the server can't be reached, publishing
+    backs off, and snapshots submitted meanwhile aren't serialised.
+    """
+    send_interval = 1 # seconds
+    min_backoff = 5
+    max_backoff = 60
+    connect_timeout = 0.5
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.http_url = "http://%s:%s/publish" % (host, port)
+        self._condition = threading.Condition()
+        self._latest = None # (anm, nidb) submitted, not yet serialised
+        self._pending = None # latest serialised snapshot to send
+        self._busy = False
+        self._next_send = 0
+        self._retry_at = 0
+        self._backoff = self.min_backoff
+        self._thread = None
+        self._closed = False
+
+    def submit(self, anm, nidb = None, force = False):
+        """Records anm and nidb as the latest snapshot, replacing any not yet
+        sent, and serialises it to send unless one was serialised within
+        send_interval. force serialises regardless of the interval, eg for a
+        completed build. Skipped while backing off from an unreachable
+        server"""
+        with self._condition:
+            if self._unreachable():
+                log.debug("Visualisation server unreachable, not publishing")
+                return
+            self._latest = (anm, nidb)
+            if not force and time.time() < self._next_send:
+                return # coalesced
+        self._serialise()
+
+    def _serialise(self):
+        """Serialises latest snapshot and queues it to send"""
+        with self._condition:
+            if self._latest is None:
+                return
+            anm, nidb = self._latest
+            self._latest = None
+            self._next_send = time.time() + self.send_interval
 
-    if anm and nidb:
-        body = autonetkit.ank_json.dumps(anm, nidb)
-    elif anm:
-        body = autonetkit.ank_json.dumps(anm)
-    else:
-        import json
-        body = json.dumps({}) # blank to test visualisation server running
+        try:
+            body = autonetkit.ank_json.dumps(anm, nidb)
+        except Exception, e:
+            # eg partially built snapshot, don't stop the build
+            log.debug("Unable to serialise snapshot to publish: %s" % e)
+            return
+
+        with self._condition:
+            self._pending = body
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+                atexit.register(self.close)
+            self._condition.notify_all()
+
+    def flush(self, timeout = 10):
+        """Serialises any coalesced snapshot, then waits up to timeout
+        seconds for it to be sent. Returns immediately if the server is
+        unreachable"""
+        with self._condition:
+            unreachable = self._unreachable()
+        if not unreachable:
+            self._serialise()
+
+        end = time.time() + timeout
+        with self._condition:
+            while self._pending or self._busy:
+                remaining = end - time.time()
+                if remaining <= 0 or self._unreachable():
+                    return
+                self._condition.wait(remaining)
+
+    def close(self, timeout = 10):
+        """Flushes, then stops the publishing thread: a daemon thread still
+        waiting during interpreter shutdown raises"""
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(self.connect_timeout)
+
+    def _unreachable(self):
+        return time.time() < self._retry_at
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None or self._unreachable():
+                    if self._closed:
+                        return
+                    if self._pending is None:
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(self._retry_at - time.time())
+                body = self._pending
+                self._pending = None
+                self._busy = True
+
+            retry = False
+            try:
+                retry = not self._publish(body)
+            finally:
+                with self._condition:
+                    if retry and self._pending is None:
+                        self._pending = body # send when reachable
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _reachable(self):
+        """Checks server is accepting connections, backing off if not"""
+        try:
+            connection = socket.create_connection((self.host, self.port),
+                    self.connect_timeout)
+            connection.close()
+        except (socket.error, socket.timeout):
+            if self._backoff == self.min_backoff:
+                log.info("Unable to connect to visualisation server %s"
+                        % self.http_url)
+            log.debug("Retrying visualisation server in %ss" % self._backoff)
+            self._retry_at = time.time() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            return False
+
+        self._retry_at = 0
+        self._backoff = self.min_backoff
+        return True
+
+    def _publish(self, body):
+        """Returns False if should retry later"""
+        if not self._reachable():
+            return False
 
+        params = urllib.urlencode({
+            'body': body
+            })
+        try:
+            urllib.urlopen(self.http_url, params).read()
+        except IOError, e:
+            log.info("Unable to connect to visualisation server %s"
+                    % self.http_url)
+            return False
+        return True
+
+_publisher = None
+
+def http_publisher():
+    """Returns shared HttpPublisher for configured server"""
+    global _publisher
+    if _publisher is None:
+        _publisher = HttpPublisher(config.settings['Http Post']['server'],
+                config.settings['Http Post']['port'])
+    return _publisher
+
+def update_http(anm = None, nidb = None, force = False):
+    """Publishes anm (and nidb) to visualisation server in background,
+    coalescing updates within HttpPublisher.send_interval unless force.
+    With no anm, synchronously tests visualisation server is running"""
+    if anm:
+        if use_http_post:
+            http_publisher().submit(anm, nidb, force)
+        return
+
+    import json
+    body = json.dumps({}) # blank to test visualisation server running
+    http_url = http_publisher().http_url
     params = urllib.urlencode({
         'body': body
         })
@@ -38,9 +209,7 @@ def update_http(anm = None, nidb = None):
         log.info("Unable to connect to visualisation server %s" % http_url)
         return
 
-    if not anm:
-        # testing
-        log.info("Visualisation server running")
+    log.info("Visualisation server running")
 
 
 def highlight(nodes, edges):
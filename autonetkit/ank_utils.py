@@ -20,6 +20,178 @@ def unwrap_graph(overlay_graph):
     """Unwrap graph"""
     return overlay_graph._graph
 
+class LabelIndex(object):
+    """Lookup table from node label to node, for O(1) node(label) lookups
+
+    Built lazily on first lookup. Owners call invalidate() when nodes are
+    added, removed or relabelled; the index is also rebuilt if the node count
+    has changed, as some functions (eg ank.split) modify the nx graph directly.
+    """
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self._index = None
+        self._size = None
+
+    def _build(self, nodes, size):
+        index = {}
+        for node in nodes:
+            index.setdefault(str(node), node) # first node wins, as per scan
+        self._index = index
+        self._size = size
+
+    def lookup(self, label, nodes, size):
+        """Returns node with label, or None if not found.
+        nodes is a callable returning the (wrapped) nodes to index,
+        size is the current node count, used to detect a stale index"""
+        if self._index is None or self._size != size:
+            self._build(nodes(), size)
+
+        node = self._index.get(label)
+        if node is not None and str(node) != label:
+            # relabelled without invalidating, rebuild and retry
+            self._build(nodes(), size)
+            node = self._index.get(label)
+
+        return node
+
+class InterfaceEdgeIndex(object):
+    """Lookup table from (node_id, interface_id) to the edges bound to it
+
+    Edges bind interfaces by storing {node_id: interface_id} in _interfaces.
+    Built lazily from the nx graph on first lookup; owners call invalidate()
+    when edges are added or removed, or bindings change.
+    """
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self._index = None
+
+    def _build(self, graph):
+        index = {}
+        # same (node, neighbor) order as graph.edges_iter(node)
+        for node_id, neighbors in graph.adjacency_iter():
+            for neighbor, data in neighbors.items():
+                try:
+                    interface_id = data['_interfaces'][node_id]
+                except (KeyError, TypeError):
+                    continue # edge not bound to an interface on this node
+                index.setdefault((node_id, interface_id), []).append(neighbor)
+        self._index = index
+
+    def lookup(self, graph, node_id, interface_id):
+        """Returns ids of the far-end nodes of edges from node_id
+        which are bound to interface_id"""
+        if self._index is None:
+            self._build(graph)
+        return self._index.get((node_id, interface_id), [])
+
+class AttributeIndex(object):
+    """Lookup table from node attribute value to node ids, for equality
+    queries such as overlay.nodes(asn=1)
+
+    Values are read with getattr(node, key) when built, so properties
+    (eg asn from phy) match a scan. Owners call update() when a node attribute
+    is set, and invalidate() when nodes are added or removed; the index is
+    also rebuilt if the node count has changed.
+    If a value is unhashable (eg a list) the attribute can't be indexed, and
+    lookups return None so the caller falls back to a scan.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.invalidate()
+
+    def invalidate(self):
+        self._values = None # {value: set(node_ids)}
+        self._node_values = None # {node_id: value}
+        self._positions = None # {node_id: position in graph iteration order}
+        self._unreadable = None # node_ids where getattr raised
+        self._unhashable = False
+        self._size = None
+
+    def _build(self, nodes, size):
+        values = {}
+        node_values = {}
+        positions = {}
+        unreadable = set()
+        self._size = size
+        for position, node in enumerate(nodes):
+            node_id = node.node_id
+            positions[node_id] = position
+            try:
+                value = getattr(node, self.key)
+            except KeyError:
+                unreadable.add(node_id) # eg asn for node not in phy
+                continue
+            try:
+                values.setdefault(value, set()).add(node_id)
+            except TypeError:
+                self._unhashable = True
+                return
+            node_values[node_id] = value
+
+        self._values = values
+        self._node_values = node_values
+        self._positions = positions
+        self._unreadable = unreadable
+
+    def _current(self, nodes, size):
+        """Rebuilds if needed, returns False if attribute can't be indexed"""
+        if self._size != size:
+            self.invalidate()
+        if self._values is None and not self._unhashable:
+            self._build(nodes(), size)
+        return not self._unhashable
+
+    def lookup(self, value, nodes, size):
+        """Returns set of ids of nodes where attribute equals value,
+        or None if the index can't answer the query.
+        nodes is a callable returning the (wrapped) nodes to index,
+        size is the current node count, used to detect a stale index"""
+        if not self._current(nodes, size):
+            return None
+        try:
+            return self._values.get(value, frozenset())
+        except TypeError:
+            return None # unhashable query value
+
+    def groups(self, nodes, size):
+        """Returns {value: set(node_ids)}, or None if can't answer"""
+        if not self._current(nodes, size) or self._unreadable:
+            return None # scan would raise for unreadable nodes
+        return self._values
+
+    def order(self, node_ids):
+        """Sorts node_ids into graph iteration order, as a scan returns"""
+        return sorted(node_ids, key=self._positions.get)
+
+    def update(self, node_id, value):
+        """Moves node_id to value"""
+        if self._values is None:
+            return # not built
+        if node_id not in self._positions:
+            self.invalidate() # new node
+            return
+
+        try:
+            hash(value)
+        except TypeError:
+            self.invalidate()
+            return
+
+        if node_id in self._node_values:
+            old_value = self._node_values[node_id]
+            node_ids = self._values[old_value]
+            node_ids.discard(node_id)
+            if not node_ids:
+                del self._values[old_value]
+
+        self._values.setdefault(value, set()).add(node_id)
+        self._node_values[node_id] = value
+        self._unreadable.discard(node_id)
+
 
 def alphabetical_sort( l ): 
     """From http://stackoverflow.com/questions/2669059/how-to-sort-alpha-numeric-set-in-python"""
@@ -2,8 +2,10 @@ import networkx as nx
 import itertools
 import pprint
 import time
-from autonetkit.ank_utils import unwrap_edges, unwrap_nodes
+from autonetkit.ank_utils import (unwrap_edges, unwrap_nodes, LabelIndex,
+        InterfaceEdgeIndex, AttributeIndex)
 import autonetkit.log as log
+import autonetkit.anm_columns as anm_columns
 import functools
 import string
 
@@ -22,8 +24,50 @@ class OverlayNotFound(AutoNetkitException):
     def __str__(self):
         return "Overlay %s not found" % self.Errors
 
+class SharedInterfaceData(dict):
+    """Interface data shared by the interfaces of every overlay, rather than
+    a copy per interface per overlay. Read-only: overlay_interface copies on
+    write"""
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared interface data is read-only")
+
+    __setitem__ = __delitem__ = _read_only
+    update = setdefault = pop = popitem = clear = _read_only
+
+    def __reduce__(self):
+        """For pickling and deepcopy"""
+        return (SharedInterfaceData, (dict(self),))
+
+class OverlayView(object):
+    """Node attributes a view overlay reads through from its parent overlay,
+    rather than copying when nodes are added with retain"""
+    def __init__(self, parent_id):
+        self.parent_id = parent_id
+        self.retained = {} # {node_id: keys read from parent}
+
+    def add_nodes(self, node_ids, keys):
+        keys = frozenset(keys)
+        for node_id in node_ids:
+            existing = self.retained.get(node_id)
+            if existing:
+                self.retained[node_id] = existing | keys
+            else:
+                self.retained[node_id] = keys # shared between nodes
+
+    def remove_node(self, node_id):
+        self.retained.pop(node_id, None)
+
+# returned by AbstractNetworkModel._view_attr if attribute not retained
+NOT_RETAINED = object()
+
+PHYSICAL_INTERFACE = SharedInterfaceData(description=None, type='physical')
+LOOPBACK_INTERFACE = SharedInterfaceData(description='loopback',
+        type='loopback')
+
 #TODO: rename to OverlayInterface
 class overlay_interface(object):
+    __slots__ = ('anm', 'overlay_id', 'node_id', 'interface_id')
+
     def __init__(self, anm, overlay_id, node_id, interface_id):
         object.__setattr__(self, 'anm', anm)
         object.__setattr__(self, 'overlay_id', overlay_id)
@@ -47,20 +91,35 @@ class overlay_interface(object):
     @property
     def is_bound(self):
         """Returns if this interface is bound to an edge on this layer"""
-        return len(self.edges()) > 0
+        return len(self._bound_dst_ids) > 0
 
     def __str__(self):
         return self.__repr__()
 
+    def __getnewargs__(self):
+        return ()
+
+    def __getstate__(self):
+        """For pickling"""
+        return (self.anm, self.overlay_id, self.node_id, self.interface_id)
+
+    def __setstate__(self, state):
+        """For pickling"""
+        (anm, overlay_id, node_id, interface_id) = state
+        object.__setattr__(self, 'anm', anm)
+        object.__setattr__(self, 'overlay_id', overlay_id)
+        object.__setattr__(self, 'node_id', node_id)
+        object.__setattr__(self, 'interface_id', interface_id)
+
     @property
     def _graph(self):
         """Return graph the node belongs to"""
-        return self.anm.overlay_nx_graphs[self.overlay_id]
+        return self.anm._overlays[self.overlay_id]
 
     @property
     def _node(self):
         """Return graph data the node belongs to"""
-        return self._graph.node[self.node_id]
+        return self.anm._overlays[self.overlay_id].node[self.node_id]
 
     @property
     def _interface(self):
@@ -137,17 +196,24 @@ class overlay_interface(object):
     @property
     def node(self):
         """Returns parent node of this interface"""
-        return OverlayNode(self.anm, self.overlay_id, self.node_id)
+        return self.anm._overlay_node(self.overlay_id, self.node_id)
 
     def dump(self):
         return str(self._interface.items())
 
     def __getattr__(self, key):
-        """Returns interface property"""
+        """Returns interface property, from phy if not set in this overlay"""
         try:
-            return self._interface.get(key)
+            return self._interface[key]
         except KeyError:
-            return
+            pass
+
+        if self.overlay_id != "phy":
+            try:
+                return self.anm._overlays["phy"].node[self.node_id][
+                        "_interfaces"][self.interface_id].get(key)
+            except KeyError:
+                return
 
     def get(self, key):
         """For consistency, node.get(key) is neater 
@@ -157,26 +223,58 @@ class overlay_interface(object):
     def __setattr__(self, key, val):
         """Sets interface property"""
         try:
-            self._interface[key] = val
+            interfaces = self._node["_interfaces"]
+            data = interfaces[self.interface_id]
         except KeyError:
             self.set(key, val)
+            return
+
+        if isinstance(data, SharedInterfaceData):
+            # copy on write
+            data = interfaces[self.interface_id] = dict(data)
+        data[key] = val
 
     def set(self, key, val):
         """For consistency, node.set(key, value) is neater
         than setattr(interface, key, value)"""
         return self.__setattr__(key, val)
 
+    @property
+    def _bound_dst_ids(self):
+        """Returns dst node ids of edges bound to this interface"""
+        index = self.anm._interface_edge_index(self.overlay_id)
+        dst_ids = index.lookup(self._graph, self.node_id, self.interface_id)
+        mesh_sessions = self._bound_mesh_sessions()
+        if mesh_sessions:
+            return dst_ids + [dst_id for (dst_id, group) in mesh_sessions]
+        return dst_ids
+
+    def _bound_mesh_sessions(self):
+        """Returns (dst node id, group) of mesh group sessions
+        bound to this interface"""
+        graph = self._graph
+        return [(dst_id, group) for group in mesh_groups(graph)
+                if group['interface'] == self.interface_id
+                and self.node_id in group['members']
+                for dst_id in group['members']
+                if dst_id != self.node_id and dst_id in graph]
+
     def edges(self):
         """Returns all edges from node that have this interface ID
         This is the convention for binding an edge to an interface"""
         # edges have _interfaces stored as a dict of {node_id: interface_id, }
-        valid_edges = [e for e in self.node.edges()
-                if self.node_id in e._interfaces
-                and e._interfaces[self.node_id] == self.interface_id]
-        return valid_edges
+        index = self.anm._interface_edge_index(self.overlay_id)
+        dst_ids = index.lookup(self._graph, self.node_id, self.interface_id)
+        return ([OverlayEdge(self.anm, self.overlay_id, self.node_id, dst_id)
+                for dst_id in dst_ids] +
+                [MeshEdge(self.anm, self.overlay_id, self.node_id, dst_id, group)
+                for (dst_id, group) in self._bound_mesh_sessions()])
 
 @functools.total_ordering
 class OverlayNode(object):
+    # wrappers are created for every node access, so keep them small
+    __slots__ = ('anm', 'overlay_id', 'node_id')
+
     def __init__(self, anm, overlay_id, node_id):
 # Set using this method to bypass __setattr__
         object.__setattr__(self, 'anm', anm)
@@ -336,7 +434,7 @@ class OverlayNode(object):
     @property
     def _graph(self):
         """Return graph the node belongs to"""
-        return self.anm.overlay_nx_graphs[self.overlay_id]
+        return self.anm._overlays[self.overlay_id]
 
     @property
     def is_router(self):
@@ -362,7 +460,7 @@ class OverlayNode(object):
 
     def __getitem__(self, key):
         """Get item key"""
-        return OverlayNode(self.anm, key, self.node_id)
+        return self.anm._overlay_node(key, self.node_id)
 
     @property
     def asn(self):
@@ -370,8 +468,15 @@ class OverlayNode(object):
         try:
             return self._graph.node[self.node_id]['asn']  # not in this graph
         except KeyError:
-            # try from phy
-            return self.anm.overlay_nx_graphs['phy'].node[self.node_id]['asn'] 
+            pass
+
+        if self.overlay_id in self.anm._views:
+            asn = self.anm._view_attr(self.overlay_id, self.node_id, 'asn')
+            if asn is not NOT_RETAINED:
+                return asn
+
+        # try from phy
+        return self.anm._overlays['phy'].node[self.node_id]['asn'] 
 
     @property
     def id(self):
@@ -384,8 +489,17 @@ class OverlayNode(object):
         return OverlayGraph(self.anm, self.overlay_id)
 
     def degree(self):
-        """Returns degree of node"""
-        return self._graph.degree(self.node_id)
+        """Returns degree of node, including mesh group sessions"""
+        graph = self._graph
+        degree = graph.degree(self.node_id)
+        if not mesh_groups(graph):
+            return degree
+        mesh_neighbors = set(dst for (dst, group)
+                in neighbor_sessions(graph, self.node_id) if group)
+        if graph.is_directed():
+            # sessions are in both directions
+            degree += len(mesh_neighbors - set(graph.pred[self.node_id]))
+        return degree + len(mesh_neighbors)
 
     def neighbors(self, *args, **kwargs):
         """Returns neighbors of node"""
@@ -413,7 +527,7 @@ class OverlayNode(object):
         ie node.phy.x is same as node.overlay.phy.x
         """
 # refer back to the physical node, to access attributes such as name
-        return OverlayNode(self.anm, "phy", self.node_id)
+        return self.anm._overlay_node("phy", self.node_id)
 
     def dump(self):
         """Dump attributes of this node"""
@@ -438,10 +552,17 @@ class OverlayNode(object):
         """Returns node property
         This is useful for accesing attributes passed through from graphml"""
         try:
-            return self._graph.node[self.node_id].get(key)
+            data = self.anm._overlays[self.overlay_id].node[self.node_id]
         except KeyError:
             return
 
+        if key in data:
+            return data[key]
+        if self.overlay_id in self.anm._views:
+            val = self.anm._view_attr(self.overlay_id, self.node_id, key)
+            if val is not NOT_RETAINED:
+                return val
+
     def get(self, key):
         """For consistency, node.get(key) is neater than getattr(node, key)"""
         return getattr(self, key)
@@ -453,7 +574,14 @@ class OverlayNode(object):
             self._graph.node[self.node_id][key] = val
         except KeyError:
             self._graph.add_node(self.node_id)
+            self.anm._invalidate_label_index(self.overlay_id)
+            self.anm._invalidate_attr_index(self.overlay_id)
             self.set(key, val)
+            return
+
+        if key == "label" or key in self.anm.label_attrs:
+            self.anm._invalidate_label_index(self.overlay_id)
+        self.anm._update_attr_index(self, key)
 
     def set(self, key, val):
         """For consistency, node.set(key, value) is neater 
@@ -464,6 +592,8 @@ class OverlayNode(object):
 @functools.total_ordering
 class OverlayEdge(object):
     """API to access link in network"""
+    __slots__ = ('anm', 'overlay_id', 'src_id', 'dst_id')
+
     def __init__(self, anm, overlay_id, src_id, dst_id):
 # Set using this method to bypass __setattr__
         object.__setattr__(self, 'anm', anm)
@@ -498,7 +628,6 @@ class OverlayEdge(object):
 
     def __setstate__(self, state):
         """For pickling"""
-        self._overlays = state
         (anm, overlay_id, src_id, dst_id) = state
         object.__setattr__(self, 'anm', anm)
         object.__setattr__(self, 'overlay_id', overlay_id)
@@ -508,12 +637,12 @@ class OverlayEdge(object):
     @property
     def src(self):
         """Source node of edge"""
-        return OverlayNode(self.anm, self.overlay_id, self.src_id)
+        return self.anm._overlay_node(self.overlay_id, self.src_id)
 
     @property
     def dst(self):
         """Destination node of edge"""
-        return OverlayNode(self.anm, self.overlay_id, self.dst_id)
+        return self.anm._overlay_node(self.overlay_id, self.dst_id)
 
     @property
     def src_int(self):
@@ -553,6 +682,8 @@ class OverlayEdge(object):
     def bind_interface(self, node, interface):
         """Bind this edge to specified index"""
         self._interfaces[node.id] = interface
+        # _interfaces dicts can be shared between overlays by retain
+        self.anm._invalidate_interface_index()
 
     def interfaces(self):
         #TODO: warn if interface doesn't exist on node
@@ -562,7 +693,7 @@ class OverlayEdge(object):
     @property
     def _graph(self):
         """Return graph the node belongs to"""
-        return self.anm.overlay_nx_graphs[self.overlay_id]
+        return self.anm._overlays[self.overlay_id]
 
     def get(self, key):
         """For consistency, edge.get(key) is neater than getattr(edge, key)"""
@@ -575,11 +706,105 @@ class OverlayEdge(object):
 
     def __getattr__(self, key):
         """Returns edge property"""
-        return self._graph[self.src_id][self.dst_id].get(key)
+        return self.anm._overlays[self.overlay_id][self.src_id][self.dst_id].get(key)
 
     def __setattr__(self, key, val):
         """Sets edge property"""
         self._graph[self.src_id][self.dst_id][key] = val
+        if key == "_interfaces":
+            self.anm._invalidate_interface_index(self.overlay_id)
+
+
+def mesh_groups(graph):
+    """Returns mesh groups stored on nx graph,
+    see OverlayGraph.add_mesh_group"""
+    return graph.graph.get('mesh_groups', [])
+
+def mesh_group(graph, src, dst):
+    """Returns first mesh group with a session from src to dst, or None"""
+    if src == dst or src not in graph or dst not in graph:
+        return None
+    for group in mesh_groups(graph):
+        if src in group['members'] and dst in group['members']:
+            return group
+
+def neighbor_sessions(graph, src):
+    """Returns (dst, group) of stored edges (group is None) and mesh group
+    sessions from src. If src has mesh sessions, these are ordered as nx
+    orders an adjacency, as if each session had been stored as an edge"""
+    mesh_sessions = [(dst, group) for group in mesh_groups(graph)
+            if src in group['members']
+            for dst in group['members']
+            if dst != src and dst in graph]
+    if not mesh_sessions:
+        return [(dst, None) for dst in graph[src]]
+    sessions = {}
+    for dst in graph[src]:
+        sessions[dst] = None
+    for dst, group in mesh_sessions:
+        sessions.setdefault(dst, group)
+    return sessions.items()
+
+def expand_mesh_groups(graph):
+    """Replaces mesh groups on nx graph with an edge per session, for export
+    (json, graphml) of a copy of an overlay graph. Returns graph"""
+    for group in graph.graph.pop('mesh_groups', []):
+        members = [n for n in group['members'] if n in graph]
+        for src in members:
+            for dst in members:
+                if src == dst or graph.has_edge(src, dst):
+                    continue
+                data = dict(group['data'])
+                if group['interface'] is not None:
+                    # as edge.bind_interface(edge.src, interface)
+                    data['_interfaces'] = {src: group['interface']}
+                graph.add_edge(src, dst, data)
+    return graph
+
+class MeshEdge(OverlayEdge):
+    """Session between two members of a mesh group.
+    Attributes are stored once on the group, so are shared by (and setting
+    one applies to) all sessions in the group"""
+    __slots__ = ('group',)
+
+    def __init__(self, anm, overlay_id, src_id, dst_id, group):
+        OverlayEdge.__init__(self, anm, overlay_id, src_id, dst_id)
+        object.__setattr__(self, 'group', group)
+
+    def __getstate__(self):
+        """For pickling"""
+        return (self.anm, self.overlay_id, self.src_id, self.dst_id,
+                self.group)
+
+    def __setstate__(self, state):
+        """For pickling"""
+        OverlayEdge.__setstate__(self, state[:4])
+        object.__setattr__(self, 'group', state[4])
+
+    @property
+    def _interfaces(self):
+        interface_id = self.group['interface']
+        if interface_id is None:
+            return {}
+        return {self.src_id: interface_id, self.dst_id: interface_id}
+
+    def dump(self):
+        return str(self.group['data'])
+
+    def __nonzero__(self):
+        return self.src_id in self._graph and self.dst_id in self._graph
+
+    def bind_interface(self, node, interface):
+        """Bind all sessions in the group to specified index"""
+        self.group['interface'] = interface
+
+    def __getattr__(self, key):
+        """Returns group property"""
+        return self.group['data'].get(key)
+
+    def __setattr__(self, key, val):
+        """Sets group property"""
+        self.group['data'][key] = val
 
 
 class OverlayGraphData(object):
@@ -617,6 +842,47 @@ class OverlayBase(object):
             raise OverlayNotFound(overlay_id)
         self._anm = anm
         self._overlay_id = overlay_id
+        self._labels = LabelIndex()
+
+    @property
+    def _label_index(self):
+        """Label lookup table for this overlay"""
+        return self._labels
+
+    def _attr_index(self, key):
+        """Attribute index for key, or None if key not indexed.
+        Not used for subgraphs, as indexes cover the whole overlay"""
+        return None
+
+    def _indexed_node_ids(self, kwargs):
+        """Answers equality predicates in kwargs from attribute indexes.
+        Returns (node ids in graph order, or None if no index applies,
+        remaining kwargs to check by scan)"""
+        candidates = None
+        remaining = {}
+        index_used = None
+        size = len(self._graph)
+        for key, val in kwargs.items():
+            index = self._attr_index(key)
+            node_ids = None
+            if index is not None:
+                node_ids = index.lookup(val, self.__iter__, size)
+            if node_ids is None:
+                remaining[key] = val
+                continue
+
+            index_used = index
+            if candidates is None:
+                candidates = node_ids
+            else:
+                candidates = candidates & node_ids
+
+        if candidates is None:
+            return None, kwargs
+
+        graph = self._graph
+        node_ids = index_used.order(n for n in candidates if n in graph)
+        return node_ids, remaining
 
     def __repr__(self):
         return self._overlay_id
@@ -642,6 +908,9 @@ class OverlayBase(object):
             dst.lower()
             if self._graph.has_edge(src, dst):
                 return OverlayEdge(self._anm, self._overlay_id, src, dst)
+            group = mesh_group(self._graph, src, dst)
+            if group:
+                return MeshEdge(self._anm, self._overlay_id, src, dst, group)
         except AttributeError:
             pass # not strings
         except TypeError:
@@ -665,21 +934,34 @@ class OverlayBase(object):
             except KeyError:
                 pass  # no edge_id for this edge
 
+        # mesh group sessions have no edge_id, match on src and dst
+        try:
+            if dst_to_find:
+                dst_id = dst_to_find.node_id
+            else:
+                dst_id = edge_to_find.dst_id
+        except AttributeError:
+            return
+        group = mesh_group(self._graph, src_id, dst_id)
+        if group:
+            return MeshEdge(self._anm, self._overlay_id, src_id, dst_id, group)
+
     def __getitem__(self, key):
         return self.node(key)
 
     def node(self, key):
         """Returns node based on name
-        This is currently O(N). Could use a lookup table"""
+        Label lookups use the overlay's label index"""
         try:
             if key.node_id in self._graph:
-                return OverlayNode(self._anm, self._overlay_id, key.node_id)
+                return self._anm._overlay_node(self._overlay_id, key.node_id)
         except AttributeError:
             # doesn't have node_id, likely a label string, search based on this
             # label
-            for node in self:
-                if str(node) == key:
-                    return node
+            node = self._label_index.lookup(key, self.__iter__,
+                    len(self._graph))
+            if node is not None:
+                return node
             log.warning("Unable to find node %s in %s " % (key, self))
             return None
 
@@ -687,8 +969,13 @@ class OverlayBase(object):
         return node.degree()
 
     def neighbors(self, node):
-        return iter(OverlayNode(self._anm, self._overlay_id, node)
-                    for node in self._graph.neighbors(node.node_id))
+        wrap = self._anm._node_wrapper(self._overlay_id)
+        if mesh_groups(self._graph):
+            neighbors = (dst for (dst, group)
+                    in neighbor_sessions(self._graph, node.node_id))
+        else:
+            neighbors = self._graph.neighbors(node.node_id)
+        return iter(wrap(node) for node in neighbors)
 
     def overlay(self, key):
         """Get to other overlay graphs in functions"""
@@ -705,12 +992,13 @@ class OverlayBase(object):
         self._anm.dump_graph(self)
 
     def has_edge(self, edge):
-        """Tests if edge in graph"""
-        return self._graph.has_edge(edge.src, edge.dst)
+        """Tests if edge in graph, as a stored edge or mesh group session"""
+        return (self._graph.has_edge(edge.src, edge.dst) or
+                mesh_group(self._graph, edge.src_id, edge.dst_id) is not None)
 
     def __iter__(self):
-        return iter(OverlayNode(self._anm, self._overlay_id, node)
-                    for node in self._graph)
+        wrap = self._anm._node_wrapper(self._overlay_id)
+        return iter(wrap(node) for node in self._graph)
 
     def __len__(self):
         return len(self._graph)
@@ -718,7 +1006,7 @@ class OverlayBase(object):
     def nodes(self, *args, **kwargs):
         result = self.__iter__()
         if len(args) or len(kwargs):
-            result = self.filter(result, *args, **kwargs)
+            result = self.filter(None, *args, **kwargs)
         return result
 
     def routers(self, *args, **kwargs):
@@ -728,7 +1016,7 @@ class OverlayBase(object):
 
     def device(self, key):
         """To access programatically"""
-        return OverlayNode(self._anm, self._overlay_id, key)
+        return self._anm._overlay_node(self._overlay_id, key)
 
     def groupby(self, attribute, nodes=None):
         """Returns a dictionary sorted by attribute
@@ -739,6 +1027,33 @@ class OverlayBase(object):
         result = {}
 
         if not nodes:
+            index = self._attr_index(attribute)
+            if index is not None:
+                groups = index.groups(self.__iter__, len(self._graph))
+                if groups is not None:
+                    wrap = self._anm._node_wrapper(self._overlay_id)
+                    for key, node_ids in groups.items():
+                        result[key] = [wrap(n) for n in index.order(node_ids)]
+                    return result
+
+            if not hasattr(OverlayNode, attribute):
+                # stored attribute, not a property such as asn: use column
+                columns = self._columns
+                if columns is not None:
+                    groups = columns.groups(attribute)
+                    if groups is not None:
+                        wrap = self._anm._node_wrapper(self._overlay_id)
+                        for key, node_ids in groups.items():
+                            result[key] = [wrap(n) for n in node_ids]
+                        return result
+                column = self.get_node_attr(attribute)
+                node_ids = sorted(self._graph, key=column.get)
+                wrap = self._anm._node_wrapper(self._overlay_id)
+                for key, grouping in itertools.groupby(node_ids,
+                        key=column.get):
+                    result[key] = [wrap(n) for n in grouping]
+                return result
+
             data = self.nodes()
         else:
             data = nodes
@@ -749,9 +1064,112 @@ class OverlayBase(object):
 
         return result
 
+    @property
+    def _columns(self):
+        """OverlayColumns storing node attributes of the overlay, or None if
+        stored in dicts, or read through from a parent overlay"""
+        if self._graph is not self._anm._overlays.get(self._overlay_id):
+            return None # subgraph
+        return self._anm._overlay_columns(self._overlay_id)
+
+    def get_node_attr(self, key, nbunch=None):
+        """Returns {node_id: value} of attribute key, for nodes in nbunch
+        (default all nodes) which have key set.
+        Reads the nx node data directly rather than through OverlayNodes,
+        so properties such as asn (which falls back to phy) aren't applied
+
+        >>> G_in.get_node_attr("x")
+        {'r1': 100, 'r2': 250, ...}
+        """
+        node_data = self._graph.node
+        columns = self._columns
+        if nbunch is None:
+            nbunch = node_data
+            if columns is not None:
+                result = columns.get(key)
+            else:
+                result = dict((n, data[key]) for n, data
+                        in node_data.iteritems() if key in data)
+        elif columns is not None:
+            nbunch = [getattr(node, "node_id", node) for node in nbunch]
+            result = columns.get(key, [n for n in nbunch if n in node_data])
+        else:
+            result = {}
+            nbunch = [getattr(node, "node_id", node) for node in nbunch]
+            for node_id in nbunch:
+                try:
+                    result[node_id] = node_data[node_id][key]
+                except KeyError:
+                    pass # node not in overlay, or key not set
+
+        if self._overlay_id in self._anm._views:
+            for node_id in nbunch:
+                if node_id in result or node_id not in node_data:
+                    continue
+                val = self._anm._view_attr(self._overlay_id, node_id, key)
+                if val is not NOT_RETAINED:
+                    result[node_id] = val
+
+        return result
+
+    def set_node_attr(self, key, values):
+        """Sets attribute key from values, a dict of {node_id: value}.
+        Writes the nx node data directly rather than through OverlayNodes"""
+        node_data = self._graph.node
+        columns = self._columns
+        if columns is not None:
+            added = [n for n in values if n not in node_data]
+            if added:
+                columns.set(key, dict((n, val) for n, val
+                    in values.iteritems() if n in node_data))
+            else:
+                columns.set(key, values)
+        else:
+            added = []
+            for node_id, value in values.iteritems():
+                try:
+                    node_data[node_id][key] = value
+                except KeyError:
+                    added.append(node_id)
+
+        for node_id in added:
+            # not in overlay: node.set() adds it
+            self._anm._overlay_node(self._overlay_id, node_id).set(key,
+                    values[node_id])
+        self._node_attr_changed(key)
+
+    def _node_attr_changed(self, key):
+        """Invalidates indexes of attribute key, after setting it directly
+        in the node data"""
+        self._anm._invalidate_attr_index(self._overlay_id, key)
+        if key == "label" or key in self._anm.label_attrs:
+            self._anm._invalidate_label_index(self._overlay_id)
+
+    def min_node_attr(self, key, nbunch=None, default=None):
+        """Returns smallest value of attribute key for nodes in nbunch
+        (default all nodes) which have key set, or default if none have"""
+        columns = self._columns
+        if columns is not None:
+            node_ids = None
+            if nbunch is not None:
+                node_data = self._graph.node
+                node_ids = [n for n in (getattr(node, "node_id", node)
+                    for node in nbunch) if n in node_data]
+            return columns.min(key, node_ids, default)
+
+        values = self.get_node_attr(key, nbunch).values()
+        if not values:
+            return default
+        return min(values)
+
     def filter(self, nbunch=None, *args, **kwargs):
         if not nbunch:
-            nbunch = self.nodes()
+            node_ids, kwargs = self._indexed_node_ids(kwargs)
+            if node_ids is None:
+                nbunch = self.nodes()
+            else:
+                wrap = self._anm._node_wrapper(self._overlay_id)
+                nbunch = [wrap(n) for n in node_ids]
 
         def filter_func(node):
             """Filter based on args and kwargs"""
@@ -764,12 +1182,15 @@ class OverlayBase(object):
         return (n for n in nbunch if filter_func(n))
 
     def edges(self, src_nbunch=None, dst_nbunch=None, *args, **kwargs):
+        """Returns edges from src_nbunch to dst_nbunch, with attributes
+        matching args and kwargs. Sessions of mesh groups are expanded
+        in with the stored edges."""
 # nbunch may be single node
         if src_nbunch:
             try:
                 src_nbunch = src_nbunch.node_id
             except AttributeError:
-                src_nbunch = (n.node_id for n in src_nbunch)
+                src_nbunch = [n.node_id for n in src_nbunch]
                               # only store the id in overlay
 
         def filter_func(edge):
@@ -780,8 +1201,11 @@ class OverlayBase(object):
                     edge, key) == val for key, val in kwargs.items())
             )
 
-        valid_edges = (
-            (src, dst) for (src, dst) in self._graph.edges_iter(src_nbunch))
+        if mesh_groups(self._graph):
+            valid_edges = self._session_pairs(src_nbunch)
+        else:
+            valid_edges = ((src, dst, None) for (src, dst)
+                    in self._graph.edges_iter(src_nbunch))
         if dst_nbunch:
             try:
                 dst_nbunch = dst_nbunch.node_id
@@ -793,17 +1217,32 @@ class OverlayBase(object):
                 dst_nbunch = set(
                     dst_nbunch)  # faster membership test than other sequences
 
-            valid_edges = ((src, dst) for (src, dst) in valid_edges
-                           if dst in dst_nbunch)
+            valid_edges = ((src, dst, group) for (src, dst, group)
+                    in valid_edges if dst in dst_nbunch)
 
+        all_edges = (self._session_edge(src, dst, group)
+                     for (src, dst, group) in valid_edges)
         if len(args) or len(kwargs):
-            all_edges = iter(OverlayEdge(self._anm, self._overlay_id, src, dst)
-                             for (src, dst) in valid_edges)
-            result = (edge for edge in all_edges if filter_func(edge))
-        else:
-            result = (OverlayEdge(self._anm, self._overlay_id, src, dst)
-                      for (src, dst) in valid_edges)
-        return result
+            return (edge for edge in all_edges if filter_func(edge))
+        return all_edges
+
+    def _session_pairs(self, src_nbunch):
+        """Returns (src, dst, group) of stored edges (group is None) and
+        mesh group sessions from src_nbunch, in adjacency order"""
+        graph = self._graph
+        seen = set() # undirected edges are returned once, as in nx
+        for src in graph.nbunch_iter(src_nbunch):
+            for dst, group in neighbor_sessions(graph, src):
+                if group is None and dst in seen:
+                    continue
+                yield (src, dst, group)
+            if not graph.is_directed():
+                seen.add(src)
+
+    def _session_edge(self, src, dst, group):
+        if group is None:
+            return OverlayEdge(self._anm, self._overlay_id, src, dst)
+        return MeshEdge(self._anm, self._overlay_id, src, dst, group)
 
 
 class OverlaySubgraph(OverlayBase):
@@ -826,10 +1265,30 @@ class OverlayGraph(OverlayBase):
     @property
     def _graph(self):
         # access underlying graph for this OverlayNode
-        return self._anm.overlay_nx_graphs[self._overlay_id]
+        return self._anm._overlays[self._overlay_id]
+
+    @property
+    def _label_index(self):
+        # stored on anm, as OverlayGraph objects are created on each access
+        return self._anm._label_index(self._overlay_id)
+
+    def _attr_index(self, key):
+        return self._anm._attr_index(self._overlay_id, key)
+
+    def add_index(self, *keys):
+        """Index nodes in this overlay on attributes keys, for equality
+        queries in nodes(), filter(), routers() and groupby()
+
+        >>> G_in.add_index("asn", "device_type")
+        """
+        self._anm._indexed_attrs.setdefault(self._overlay_id,
+                set()).update(keys)
 
     def _replace_graph(self, graph):
         self._anm.overlay_nx_graphs[self._overlay_id] = graph
+        self._anm._invalidate_label_index(self._overlay_id)
+        self._anm._invalidate_interface_index(self._overlay_id)
+        self._anm._invalidate_attr_index(self._overlay_id)
 
     # these work similar to their nx counterparts: just need to strip the
     # node_id
@@ -850,9 +1309,16 @@ class OverlayGraph(OverlayBase):
         nbunch = list(nbunch)
         node_ids = list(nbunch)  # before appending retain data
 
+        view = self._anm._views.get(self._overlay_id)
+        view_node_ids = []
         if len(retain):
             add_nodes = []
             for node in nbunch:
+                if view is not None and node.overlay_id == view.parent_id:
+                    # read retained attributes through from parent
+                    view_node_ids.append(node.node_id)
+                    add_nodes.append((node.node_id, {}))
+                    continue
                 data = dict((key, node.get(key)) for key in retain)
                 add_nodes.append((node.node_id, data))
             nbunch = add_nodes
@@ -861,6 +1327,16 @@ class OverlayGraph(OverlayBase):
                 n.node_id for n in nbunch)  # only store the id in overlay
 
         self._graph.add_nodes_from(nbunch, **kwargs)
+        if view_node_ids:
+            view.add_nodes(view_node_ids, retain)
+            if update:
+                # parent values replace any set in this overlay, as per copy
+                for node_id in view_node_ids:
+                    data = self._graph.node[node_id]
+                    for key in retain:
+                        data.pop(key, None)
+        self._anm._invalidate_label_index(self._overlay_id)
+        self._anm._invalidate_attr_index(self._overlay_id)
         self._init_interfaces(node_ids)
 
     def add_node(self, node, retain=None, **kwargs):
@@ -882,6 +1358,8 @@ class OverlayGraph(OverlayBase):
             data = dict((key, node.get(key)) for key in retain)
             kwargs.update(data)  # also use the retained data
         self._graph.add_node(node_id, kwargs)
+        self._anm._invalidate_label_index(self._overlay_id)
+        self._anm._invalidate_attr_index(self._overlay_id)
         self._init_interfaces([node_id])
 
     def _init_interfaces(self, nbunch=None):
@@ -898,21 +1376,14 @@ class OverlayGraph(OverlayBase):
         for node in nbunch:
             try:
                 phy_interfaces = phy_graph.node[node]["_interfaces"]
-                interface_data = {
-                    'description': None,
-                    'type': 'physical',
-                }
-                # need to do dict() to copy, otherwise all point to same memory location -> clobber
-                data = dict(
-                    (key, dict(interface_data)) for key in phy_interfaces)
+                # data is shared until written, see overlay_interface
+                data = dict.fromkeys(phy_interfaces, PHYSICAL_INTERFACE)
                 self._graph.node[node]['_interfaces'] = data
             except KeyError:
 # no counterpart in physical graph, initialise
                 log.debug("Initialise interfaces for %s in %s" % (
                     node, self._overlay_id))
-                self._graph.node[node]['_interfaces'] = {0:
-                                                         {'description': 'loopback',
-                                                             'type': 'loopback'}}
+                self._graph.node[node]['_interfaces'] = {0: LOOPBACK_INTERFACE}
 
     def allocate_interfaces(self):
         """allocates edges to interfaces"""
@@ -933,6 +1404,8 @@ class OverlayGraph(OverlayBase):
             edge._interfaces[src.id] = src_int_id
             edge._interfaces[dst.id] = dst_int_id
 
+        self._anm._invalidate_interface_index(self._overlay_id)
+
     def __delitem__(self, key):
         self.remove_node(key)
 
@@ -942,6 +1415,11 @@ class OverlayGraph(OverlayBase):
         except AttributeError:
             node_id = node
         self._graph.remove_node(node_id)
+        if self._overlay_id in self._anm._views:
+            self._anm._views[self._overlay_id].remove_node(node_id)
+        self._anm._invalidate_label_index(self._overlay_id)
+        self._anm._invalidate_interface_index(self._overlay_id)
+        self._anm._invalidate_attr_index(self._overlay_id)
 
     def add_edge(self, src, dst, retain=None, **kwargs):
         if not retain:
@@ -959,6 +1437,7 @@ class OverlayGraph(OverlayBase):
         except AttributeError:
             pass  # don't need to unwrap
         self._graph.remove_edges_from(ebunch)
+        self._anm._invalidate_interface_index(self._overlay_id)
 
     def add_edges(self, *args, **kwargs):
         self.add_edges_from(args, kwargs)
@@ -1004,14 +1483,42 @@ class OverlayGraph(OverlayBase):
                 and dst in self._graph]
 
         self._graph.add_edges_from(ebunch, **kwargs)
+        self._anm._invalidate_interface_index(self._overlay_id)
+
+    def add_mesh_group(self, nbunch, interface=None, **kwargs):
+        """Adds a session between each ordered pair of nodes in nbunch,
+        stored once as a group of members rather than as n(n-1) edges.
+        Sessions are expanded by edges(), and share the attributes in kwargs.
+        If interface is set, sessions are bound to it on both nodes.
+        Like add_edges_from, only nodes already in the graph are added.
+        Exports expand sessions to edges, see expand_mesh_groups."""
+        members = [n.node_id for n in nbunch]
+        members = [n for n in members if n in self._graph]
+        if len(members) < 2:
+            return # no sessions
+        self._graph.graph.setdefault('mesh_groups', []).append({
+            'members': members,
+            'interface': interface,
+            'data': kwargs,
+            })
 
     def update(self, nbunch=None, **kwargs):
         """Sets property defined in kwargs to all nodes in nbunch"""
+        columns = self._columns
         if nbunch is None:
-            nbunch = self.nodes()
-        for node in nbunch:
-            for key, value in kwargs.items():
-                node.set(key, value)
+            node_ids = self._graph.nodes()
+            column_ids = None # all nodes
+        else:
+            node_ids = column_ids = [n.node_id for n in nbunch]
+            if columns is not None and not all(n in self._graph
+                    for n in node_ids):
+                columns = None # node.set() adds nodes not in overlay
+        for key, value in kwargs.items():
+            if columns is not None:
+                columns.fill(key, value, column_ids)
+                self._node_attr_changed(key)
+            else:
+                self.set_node_attr(key, dict.fromkeys(node_ids, value))
 
     def update_edges(self, ebunch=None, **kwargs):
         """Sets property defined in kwargs to all edges in ebunch"""
@@ -1028,8 +1535,18 @@ class OverlayGraph(OverlayBase):
 
 
 class AbstractNetworkModel(object):
-    def __init__(self):
+    def __init__(self, columnar=False):
+        """If columnar is set, node attributes are stored in numpy arrays
+        per attribute (see anm_columns), if numpy is installed"""
+        self._node_ids = self._column_ids(columnar)
+        self._columns = {} # {overlay_id: OverlayColumns}
         self._overlays = {}
+        self._label_indexes = {}
+        self._interface_edge_indexes = {}
+        self._attr_indexes = {}
+        self._indexed_attrs = {} # {overlay_id: keys}, None for all overlays
+        self._node_cache = {}
+        self._views = {} # {overlay_id: OverlayView}
         self.add_overlay("phy")
         self.add_overlay("graphics")
 
@@ -1045,9 +1562,25 @@ class AbstractNetworkModel(object):
     def __getnewargs__():
         return ()
 
+    @staticmethod
+    def _column_ids(columnar):
+        """Returns NodeIds to number rows of node attribute columns, or None
+        to store node attributes in dicts"""
+        if not columnar:
+            return None
+        if anm_columns.numpy is None:
+            log.info("numpy not installed, storing node attributes in dicts")
+            return None
+        return anm_columns.NodeIds()
+
     def __getstate__(self):
         """For pickling"""
-        return (self._overlays, self.label_seperator, self.label_attrs)
+        overlays = dict(self._overlays)
+        for overlay_id in self._views:
+            overlays[overlay_id] = self._materialise_view(overlay_id,
+                    overlays[overlay_id].copy())
+        return (overlays, self.label_seperator, self.label_attrs,
+                self._node_ids is not None)
 
     @property
     def overlay_nx_graphs(self):
@@ -1058,11 +1591,21 @@ class AbstractNetworkModel(object):
 
     def __setstate__(self, state):
         """For pickling"""
-        (overlays, label_seperator, label_attrs) = state
+        (overlays, label_seperator, label_attrs) = state[:3]
+        self._node_ids = self._column_ids(state[3:] and state[3])
+        self._columns = {}
         self._overlays = overlays
+        self._label_indexes = {}
+        self._interface_edge_indexes = {}
+        self._attr_indexes = {}
+        self._indexed_attrs = {}
+        self._node_cache = {}
+        self._views = {}
         self.label_seperator = label_seperator
         self.label_attrs = label_attrs
         self._build_node_label()
+        for overlay_id in overlays:
+            self._overlay_columns(overlay_id) # store node data in columns
 
     def save(self):
         import autonetkit.ank_json as ank_json
@@ -1107,6 +1650,10 @@ class AbstractNetworkModel(object):
             for overlay_id, graph_data in data.items():
                 self._overlays[
                     overlay_id] = ank_json.ank_json_loads(graph_data)
+        self._views = {} # saved materialised
+        self._label_indexes = {}
+        self._interface_edge_indexes = {}
+        self._attr_indexes = {}
 
     @property
     def _phy(self):
@@ -1125,8 +1672,17 @@ class AbstractNetworkModel(object):
         return g_in
 
     def add_overlay(self, name, nodes=None, graph=None, directed=False,
-            multi_edge=False, retain=None):
-        """Adds overlay graph of name name"""
+            multi_edge=False, retain=None, parent=None):
+        """Adds overlay graph of name name
+
+        If parent overlay is set, the overlay is a view of parent: nodes added
+        from parent with retain read those attributes through from parent,
+        rather than copying them. Attributes set on the view are stored in
+        the view.
+
+        >>> g_ospf = anm.add_overlay("ospf", g_in.routers(), retain="asn",
+        ...     parent=g_in)
+        """
         if graph:
             if not directed and graph.is_directed():
                 log.info("Converting graph %s to undirected" % name)
@@ -1143,7 +1699,10 @@ class AbstractNetworkModel(object):
             else:
                 graph = nx.Graph()
 
-        self._overlays[name] = graph
+        view = None
+        if parent is not None:
+            view = OverlayView(str(parent))
+        self._set_overlay(name, graph, view)
         overlay = OverlayGraph(self, name)
         overlay.allocate_interfaces()
         if nodes:
@@ -1151,6 +1710,33 @@ class AbstractNetworkModel(object):
             overlay.add_nodes_from(nodes, retain)
         return overlay
 
+    def _set_overlay(self, name, graph, view=None):
+        """Sets nx graph of overlay name, and view if a view of a parent
+        overlay, discarding cached wrappers and indexes"""
+        self._overlays[name] = graph
+        self._node_cache.pop(name, None)
+        if view is not None:
+            self._views[name] = view
+        else:
+            self._views.pop(name, None)
+        self._invalidate_label_index(name)
+        self._invalidate_interface_index(name)
+        self._invalidate_attr_index(name)
+        self._overlay_columns(name) # store node data in columns
+
+    def _overlay_columns(self, overlay_id):
+        """Returns OverlayColumns storing node attributes of overlay_id, or
+        None if stored in dicts, or read through from a parent overlay"""
+        if self._node_ids is None or overlay_id in self._views:
+            return None
+        graph = self._overlays[overlay_id]
+        columns = self._columns.get(overlay_id)
+        if columns is None or columns.graph is not graph:
+            columns = self._columns[overlay_id] = anm_columns.OverlayColumns(
+                    self._node_ids, graph)
+        columns.sync()
+        return columns
+
     def overlays(self):
         return self._overlays.keys()
 
@@ -1160,6 +1746,147 @@ class AbstractNetworkModel(object):
     def __getitem__(self, key):
         return OverlayGraph(self, key)
 
+    def _node_wrapper(self, overlay_id):
+        """Returns function mapping node_id to its OverlayNode in overlay_id.
+        OverlayNodes only hold (anm, overlay_id, node_id), so are cached
+        and shared rather than created on each access"""
+        try:
+            cache = self._node_cache[overlay_id]
+        except KeyError:
+            cache = self._node_cache[overlay_id] = {}
+
+        def wrap(node_id):
+            try:
+                return cache[node_id]
+            except KeyError:
+                node = cache[node_id] = OverlayNode(self, overlay_id, node_id)
+                return node
+        return wrap
+
+    def _overlay_node(self, overlay_id, node_id):
+        """Returns cached OverlayNode for node_id in overlay_id"""
+        try:
+            return self._node_cache[overlay_id][node_id]
+        except KeyError:
+            return self._node_wrapper(overlay_id)(node_id)
+
+    def _label_index(self, overlay_id):
+        """Returns label lookup table for overlay_id"""
+        try:
+            return self._label_indexes[overlay_id]
+        except KeyError:
+            index = self._label_indexes[overlay_id] = LabelIndex()
+            return index
+
+    def _invalidate_label_index(self, overlay_id=None):
+        """Labels are mapped from phy, so changes to phy (or to the
+        label format) invalidate the label index of every overlay"""
+        if overlay_id is None or overlay_id == "phy":
+            for index in self._label_indexes.values():
+                index.invalidate()
+        elif overlay_id in self._label_indexes:
+            self._label_indexes[overlay_id].invalidate()
+
+    def _interface_edge_index(self, overlay_id):
+        """Returns (node_id, interface_id) -> edge lookup table
+        for overlay_id"""
+        try:
+            return self._interface_edge_indexes[overlay_id]
+        except KeyError:
+            index = self._interface_edge_indexes[
+                overlay_id] = InterfaceEdgeIndex()
+            return index
+
+    def _invalidate_interface_index(self, overlay_id=None):
+        """Invalidates the interface edge index of overlay_id,
+        or of all overlays if overlay_id not set"""
+        if overlay_id is None:
+            for index in self._interface_edge_indexes.values():
+                index.invalidate()
+        elif overlay_id in self._interface_edge_indexes:
+            self._interface_edge_indexes[overlay_id].invalidate()
+
+    def add_index(self, *keys):
+        """Index nodes on attributes keys in all overlays,
+        see OverlayGraph.add_index"""
+        self._indexed_attrs.setdefault(None, set()).update(keys)
+
+    def _attr_index(self, overlay_id, key):
+        """Returns attribute index for key in overlay_id,
+        or None if key isn't indexed"""
+        try:
+            return self._attr_indexes[overlay_id][key]
+        except KeyError:
+            if (key not in self._indexed_attrs.get(None, ()) and
+                    key not in self._indexed_attrs.get(overlay_id, ())):
+                return None
+            index = self._attr_indexes.setdefault(overlay_id, {})[
+                    key] = AttributeIndex(key)
+            return index
+
+    def _update_attr_index(self, node, key):
+        """Called when attribute key is set on node"""
+        try:
+            index = self._attr_indexes[node.overlay_id][key]
+        except KeyError:
+            pass
+        else:
+            index.update(node.node_id, getattr(node, key))
+
+        if node.overlay_id == "phy":
+            # properties such as asn fall back to phy
+            for overlay_id, indexes in self._attr_indexes.items():
+                if overlay_id != "phy" and key in indexes:
+                    indexes[key].invalidate()
+        elif self._views:
+            for view_id in self._child_views(node.overlay_id):
+                self._invalidate_attr_index(view_id, key)
+
+    def _invalidate_attr_index(self, overlay_id=None, key=None):
+        """Invalidates attribute indexes of overlay_id (all overlays if not
+        set), and of views of it, for key (all keys if not set)"""
+        if overlay_id is None or overlay_id == "phy":
+            overlays = self._attr_indexes.values() # phy seen through asn
+        else:
+            overlays = [self._attr_indexes.get(view_id, {}) for view_id
+                    in [overlay_id] + self._child_views(overlay_id)]
+
+        for indexes in overlays:
+            if key is None:
+                for index in indexes.values():
+                    index.invalidate()
+            elif key in indexes:
+                indexes[key].invalidate()
+
+    def _child_views(self, overlay_id):
+        """Returns ids of view overlays reading through from overlay_id"""
+        children = [view_id for view_id, view in self._views.items()
+                if view.parent_id == overlay_id]
+        for view_id in list(children):
+            children.extend(self._child_views(view_id))
+        return children
+
+    def _view_attr(self, overlay_id, node_id, key):
+        """Returns attribute key of node_id read through from the parent of
+        view overlay_id, or NOT_RETAINED if key wasn't retained for node_id"""
+        view = self._views[overlay_id]
+        if key not in view.retained.get(node_id, ()):
+            return NOT_RETAINED
+        # as per retain, which copies node.get(key) from parent
+        return getattr(self._overlay_node(view.parent_id, node_id), key)
+
+    def _materialise_view(self, overlay_id, graph):
+        """Sets attributes read through from parent on graph, a copy of view
+        overlay_id, for export (json, pickle, graphml). Returns graph"""
+        view = self._views.get(overlay_id)
+        if view is None:
+            return graph
+        for node_id, data in graph.nodes(data=True):
+            for key in view.retained.get(node_id, ()):
+                if key not in data:
+                    data[key] = self._view_attr(overlay_id, node_id, key)
+        return graph
+
     def node_label(self, node):
         """Returns node label from physical graph"""
         return self.default_node_label(node)
@@ -1183,6 +1910,7 @@ class AbstractNetworkModel(object):
 
         self.label_seperator = seperator
         self.label_attrs = label_attrs
+        self._invalidate_label_index()
 
     def dump_graph(self, graph):
         print "----Graph %s----" % graph
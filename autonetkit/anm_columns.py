@@ -0,0 +1,421 @@
+"""
+Columnar storage of overlay node attributes, used by the ANM if numpy is
+installed and columnar is set.
+
+Nodes are numbered with integer ids (rows) shared by every overlay of an
+ANM. Each attribute of an overlay is stored as one array indexed by row:
+bool, int and float attributes in typed numpy arrays, other attributes in
+object arrays, with a mask of the rows that have the attribute set.
+
+Each node data dict of the nx graph is replaced, in place so the node
+order is kept, by a ColumnNodeData view of its row. OverlayNode and
+functions which use the nx graph directly read and write the columns.
+Node data added to the graph as dicts (eg by nx add_node) is stored in the
+columns on the next sync. Copies and pickles of the graph hold dicts.
+"""
+
+import collections
+import copy
+import itertools
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# returned by OverlayColumns.value if the attribute isn't set
+MISSING = object()
+
+_INITIAL_CAPACITY = 64
+
+
+def _dtypes():
+    return {
+        bool: numpy.bool_,
+        int: numpy.int64,
+        float: numpy.float64,
+    }
+
+
+def _kind(value):
+    """Python type of value if stored in a typed column, otherwise object.
+    bool is checked by type, as it is a subclass of int"""
+    kind = type(value)
+    if kind is bool or kind is int or kind is float:
+        return kind
+    return object
+
+
+def _object_array(values):
+    """Object array of values, without numpy expanding sequences"""
+    array = numpy.empty(len(values), dtype=object)
+    for index, value in enumerate(values):
+        array[index] = value
+    return array
+
+
+def _object_scalar(value):
+    """0-d object array, to fill rows with value without numpy expanding
+    sequences"""
+    array = numpy.empty((), dtype=object)
+    array[()] = value
+    return array
+
+
+class NodeIds(object):
+    """Row of each node id, shared by the overlays of an ANM"""
+
+    def __init__(self):
+        self.rows = {}
+        self.node_ids = []
+
+    def row(self, node_id):
+        """Returns row of node_id, adding it if new"""
+        try:
+            return self.rows[node_id]
+        except KeyError:
+            row = self.rows[node_id] = len(self.node_ids)
+            self.node_ids.append(node_id)
+            return row
+
+    def __len__(self):
+        return len(self.node_ids)
+
+
+class Column(object):
+    """Values of one attribute, indexed by row"""
+    __slots__ = ('kind', 'values', 'present')
+
+    def __init__(self, kind, capacity):
+        self.kind = kind
+        if kind is object:
+            self.values = numpy.empty(capacity, dtype=object)
+        else:
+            self.values = numpy.zeros(capacity, dtype=_dtypes()[kind])
+        self.present = numpy.zeros(capacity, dtype=bool)
+
+    def resize(self, capacity):
+        values = numpy.empty(capacity, dtype=self.values.dtype)
+        if self.kind is not object:
+            values.fill(0)
+        values[:len(self.values)] = self.values
+        present = numpy.zeros(capacity, dtype=bool)
+        present[:len(self.present)] = self.present
+        self.values = values
+        self.present = present
+
+    def to_object(self):
+        """Stores values as python objects, to hold values of other types.
+        astype returns python bool, int and float objects"""
+        self.values = self.values.astype(object)
+        self.values[~self.present] = None
+        self.kind = object
+
+
+class OverlayColumns(object):
+    """Node attribute columns of an overlay, nx graph.
+    Functions taking node_ids use all nodes of the graph, in the order of
+    its node data, if node_ids is None"""
+
+    def __init__(self, ids, graph):
+        self.ids = ids
+        self.graph = graph
+        self.capacity = 0
+        self.columns = {}
+        self.member = numpy.zeros(0, dtype=bool)
+        self.node_ids = [] # as of last sync
+        self._node_data = []
+        self._rows = numpy.zeros(0, dtype=numpy.intp)
+
+    def sync(self):
+        """Stores node data added to the graph as dicts in the columns, and
+        updates the nodes in the overlay"""
+        node_data = self.graph.node
+        node_ids = node_data.keys()
+        values = node_data.values()
+        if node_ids == self.node_ids and all(map(operator.is_, values,
+                self._node_data)):
+            return # unchanged
+        rows = self.ids.rows
+        for node_id, data in zip(node_ids, values):
+            if (data.__class__ is not ColumnNodeData or data._columns is not self
+                    or data._row != rows.get(node_id)):
+                # replacing the value keeps the order of node_data
+                node_data[node_id] = self.adopt(node_id, data)
+        self.node_ids = node_ids
+        self._node_data = node_data.values()
+        self._rows = self.rows(node_ids)
+        self.member[:] = False
+        self.member[self._rows] = True
+
+    def _grow(self, row):
+        capacity = max(2 * self.capacity, row + 1, _INITIAL_CAPACITY)
+        member = numpy.zeros(capacity, dtype=bool)
+        member[:self.capacity] = self.member
+        self.member = member
+        for column in self.columns.values():
+            column.resize(capacity)
+        self.capacity = capacity
+
+    def _column(self, key, kind):
+        """Returns column for key able to store values of kind"""
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = Column(kind, self.capacity)
+        elif column.kind is not kind and column.kind is not object:
+            column.to_object()
+        return column
+
+    def adopt(self, node_id, data):
+        """Stores data as attributes of node_id, returns view of its row.
+        Values of removed nodes are kept until added again, for views
+        already handed out, as with nx node dicts"""
+        row = self.ids.row(node_id)
+        data = dict(data)
+        if row >= self.capacity:
+            self._grow(row)
+        for column in self.columns.itervalues():
+            if column.present[row]:
+                column.present[row] = False
+                if column.kind is object:
+                    column.values[row] = None
+        for key, value in data.iteritems():
+            self.set_value(row, key, value)
+        return ColumnNodeData(self, row)
+
+    def value(self, row, key):
+        try:
+            column = self.columns[key]
+        except KeyError:
+            return MISSING
+        if column.present.item(row):
+            return column.values.item(row)
+        return MISSING
+
+    def set_value(self, row, key, value):
+        column = self._column(key, _kind(value))
+        column.values[row] = value
+        column.present[row] = True
+
+    def delete_value(self, row, key):
+        """Returns True if key was set for row"""
+        column = self.columns.get(key)
+        if column is None or not column.present.item(row):
+            return False
+        column.present[row] = False
+        if column.kind is object:
+            column.values[row] = None
+        return True
+
+    def keys(self, row):
+        return [key for key, column in self.columns.iteritems()
+                if column.present.item(row)]
+
+    def rows(self, node_ids=None):
+        """Array of rows of node_ids, which must be in the overlay"""
+        if node_ids is None:
+            return self._rows
+        rows = self.ids.rows
+        return numpy.fromiter((rows[n] for n in node_ids), dtype=numpy.intp,
+                count=len(node_ids))
+
+    def get(self, key, node_ids=None):
+        """Returns {node_id: value} for node_ids with key set"""
+        column = self.columns.get(key)
+        if column is None:
+            return {}
+        if node_ids is None:
+            node_ids = self.node_ids
+        rows = self.rows(node_ids)
+        present = column.present[rows]
+        values = column.values[rows[present]].tolist()
+        node_ids = itertools.compress(node_ids, present.tolist())
+        return dict(itertools.izip(node_ids, values))
+
+    def set(self, key, values):
+        """Sets key from {node_id: value}, for node_ids in the overlay"""
+        if not values:
+            return
+        node_ids = values.keys()
+        values = values.values()
+        kinds = set(_kind(value) for value in values)
+        kind = kinds.pop() if len(kinds) == 1 else object
+        column = self._column(key, kind)
+        rows = self.rows(node_ids)
+        if column.kind is object:
+            column.values[rows] = _object_array(values)
+        else:
+            column.values[rows] = values
+        column.present[rows] = True
+
+    def fill(self, key, value, node_ids=None):
+        """Sets key to value for node_ids in the overlay"""
+        rows = self.rows(node_ids)
+        if not len(rows):
+            return
+        column = self._column(key, _kind(value))
+        if column.kind is object:
+            value = _object_scalar(value)
+        column.values[rows] = value
+        column.present[rows] = True
+
+    def copy(self, other, key, dst_key, node_ids=None):
+        """Sets dst_key from key of other overlay, for node_ids (default all
+        nodes of other) in both overlays. Returns number of nodes copied"""
+        src = other.columns.get(key)
+        if src is None:
+            return 0
+        if node_ids is None:
+            rows = other.rows()
+        else:
+            rows = self.rows(node_ids)
+        rows = rows[rows < min(self.capacity, other.capacity)]
+        rows = rows[self.member[rows] & other.member[rows]
+                & src.present[rows]]
+        if len(rows):
+            column = self._column(dst_key, src.kind)
+            values = src.values[rows]
+            if column.kind is object and src.kind is not object:
+                values = values.astype(object)
+            column.values[rows] = values
+            column.present[rows] = True
+        return len(rows)
+
+    def min(self, key, node_ids=None, default=None):
+        """Smallest value of key for node_ids, or default if not set"""
+        column = self.columns.get(key)
+        if column is None:
+            return default
+        rows = self.rows(node_ids)
+        values = column.values[rows[column.present[rows]]]
+        if not len(values):
+            return default
+        if column.kind is object:
+            return min(values.tolist())
+        return values.min().item()
+
+    def groups(self, key, node_ids=None):
+        """Returns {value: [node_id, ...]} of node_ids grouped by key, in
+        the order of node_ids, with None for nodes without key.
+        Returns None for object columns, which aren't sortable in numpy"""
+        if node_ids is None:
+            node_ids = self.node_ids
+        column = self.columns.get(key)
+        if column is None:
+            return {None: list(node_ids)} if node_ids else {}
+        if column.kind is object:
+            return None
+        rows = self.rows(node_ids)
+        present = column.present[rows]
+        node_ids = _object_array(node_ids)
+        result = {}
+        missing = node_ids[~present]
+        if len(missing):
+            result[None] = missing.tolist()
+        values = column.values[rows[present]]
+        node_ids = node_ids[present]
+        uniques, inverse = numpy.unique(values, return_inverse=True)
+        order = numpy.argsort(inverse, kind="mergesort") # stable
+        bounds = numpy.cumsum(numpy.bincount(inverse))[:-1]
+        for value, group in zip(uniques.tolist(),
+                numpy.split(node_ids[order], bounds)):
+            result[value] = group.tolist()
+        return result
+
+    def neighbor_means(self, key, indptr, indices, node_ids):
+        """Returns {node_id: mean of key over its neighbours in the CSR
+        adjacency indptr, indices}. Returns None unless key is numeric and
+        set for all of the neighbours, and each node has a neighbour"""
+        column = self.columns.get(key)
+        if column is None or column.kind not in (int, float):
+            return None
+        rows = self.rows(node_ids)
+        starts = indptr[rows]
+        counts = indptr[rows + 1] - starts
+        if not counts.all():
+            return None
+        neighbors = numpy.concatenate([indices[start:start + count]
+                for start, count in zip(starts, counts)])
+        if (neighbors >= self.capacity).any():
+            return None
+        if not (self.member[neighbors] & column.present[neighbors]).all():
+            return None
+        values = column.values[neighbors].astype(numpy.float64)
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        # sum in neighbour order, as sum() of the values would
+        sums = numpy.zeros(len(rows))
+        for position in range(counts.max()):
+            found = counts > position
+            sums[found] += values[offsets[found] + position]
+        return dict(zip(node_ids, (sums / counts).tolist()))
+
+
+class ColumnNodeData(collections.MutableMapping):
+    """Attributes of a node, as a view of its row in the overlay columns"""
+    __slots__ = ('_columns', '_row')
+
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    def __getitem__(self, key):
+        value = self._columns.value(self._row, key)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._columns.value(self._row, key)
+        if value is MISSING:
+            return default
+        return value
+
+    def __contains__(self, key):
+        return self._columns.value(self._row, key) is not MISSING
+
+    def __setitem__(self, key, value):
+        self._columns.set_value(self._row, key, value)
+
+    def __delitem__(self, key):
+        if not self._columns.delete_value(self._row, key):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._columns.keys(self._row))
+
+    def __len__(self):
+        return len(self._columns.keys(self._row))
+
+    def copy(self):
+        return dict(self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        """For pickling, as a dict"""
+        return (dict, (dict(self),))
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+
+def adjacency(graph, ids):
+    """Returns (indptr, indices) CSR adjacency of nx graph, in rows of ids:
+    the neighbours of row r are indices[indptr[r]:indptr[r + 1]]"""
+    rows = ids.rows
+    for node_id in graph.adj:
+        ids.row(node_id)
+    counts = numpy.zeros(len(ids) + 1, dtype=numpy.intp)
+    for node_id, neighbors in graph.adj.iteritems():
+        counts[rows[node_id] + 1] = len(neighbors)
+    indptr = numpy.cumsum(counts)
+    indices = numpy.empty(indptr[-1], dtype=numpy.intp)
+    for node_id, neighbors in graph.adj.iteritems():
+        start = indptr[rows[node_id]]
+        indices[start:start + len(neighbors)] = [rows[n] for n in neighbors]
+    return indptr, indices
@@ -9,6 +9,9 @@ import autonetkit.load.graphml as graphml
 import autonetkit.exception
 import networkx as nx
 import autonetkit.ank as ank_utils
+import autonetkit.build_scheduler as build_scheduler
+import autonetkit.profiler as profiler
+from autonetkit.build_scheduler import Phase
 import itertools
 
 __all__ = ['build']
@@ -63,9 +66,17 @@ def grid_2d(dim):
 
     return graph
 
-def build(input_graph):
-    """Main function to build network overlay topologies"""
-    anm = autonetkit.anm.AbstractNetworkModel()
+def build(input_graph, build_jobs=1, stable_ips=False, ip_headroom=0,
+        columnar=False):
+    """Main function to build network overlay topologies.
+    Independent build phases are run in up to build_jobs processes.
+    stable_ips keeps IPv4 allocations from the previous build,
+    ip_headroom is percent spare IPv4 addresses to allocate for growth,
+    columnar stores node attributes in numpy arrays"""
+    anm = autonetkit.anm.AbstractNetworkModel(columnar=columnar)
+    # attributes commonly queried with nodes(key=val)
+    anm.add_index("asn", "device_type", "host", "syntax", "collision_domain",
+            "igp")
 
     input_undirected = nx.Graph(input_graph)
     g_in = anm.add_overlay("input", graph=input_undirected)
@@ -75,6 +86,10 @@ def build(input_graph):
     if not g_in.data.specified_int_names:
         # if not specified then automatically assign interface names
         g_in.data.specified_int_names = False
+    if stable_ips:
+        g_in.data.stable_ip_allocation = True
+    if ip_headroom:
+        g_in.data.ip_headroom = ip_headroom
 
     import autonetkit.plugins.graph_product as graph_product
     graph_product.expand(g_in)  # apply graph products if relevant
@@ -94,14 +109,22 @@ def build(input_graph):
     g_graphics.add_nodes_from(g_in, retain=['x', 'y', 'device_type',
                               'device_subtype', 'pop', 'asn'])
 
-    build_phy(anm)
-    autonetkit.update_http(anm)
-    g_phy = anm['phy']
+    build_scheduler.run(anm, BUILD_PHASES, jobs=build_jobs,
+            completed=publish_phase)
+    autonetkit.update_http(anm, force=True)
 
-    build_vrf(anm) # need to do before to add loopbacks before ip allocations
-    build_ip(anm) # ip infrastructure topology
-    autonetkit.update_http(anm)
+    return anm
 
+def publish_phase(anm, phase):
+    """Sends partially built ANM to web server after key phases"""
+    if phase.name in ("phy", "ip"):
+        autonetkit.update_http(anm)
+
+@profiler.profiled("build")
+def build_ip_families(anm):
+    """Builds IPv4 and IPv6 overlays as per input address family"""
+    g_in = anm['input']
+    g_phy = anm['phy']
     address_family = g_in.data.address_family or "v4" # default is v4
 #TODO: can remove the infrastructure now create g_ip seperately
     if address_family in ("v4", "dual_stack"):
@@ -115,6 +138,10 @@ def build(input_graph):
         build_ipv6(anm)
         g_phy.update(g_phy, use_ipv6 = True)
 
+@profiler.profiled("build")
+def build_igp_defaults(anm):
+    """Sets default igp on input nodes, and creates igp overlays"""
+    g_in = anm['input']
     default_igp = g_in.data.igp or "ospf" 
     non_igp_nodes = [n for n in g_in if not n.igp]
 #TODO: should this be modifying g_in?
@@ -123,18 +150,7 @@ def build(input_graph):
     anm.add_overlay("ospf")
     anm.add_overlay("isis")
 
-    ank_utils.copy_attr_from(g_in, g_phy, "include_csr")
-
-    build_ospf(anm)
-    build_isis(anm)
-    build_bgp(anm)
-    build_dns(anm)
-    build_memory(anm)
-    build_speed(anm)
-    
-    autonetkit.update_http(anm)
-
-    return anm
+    ank_utils.copy_attr_from(g_in, anm['phy'], "include_csr")
 
 def allocate_vrf_roles(g_vrf):
     """Allocate VRF roles"""
@@ -192,6 +208,7 @@ def vrf_edges(g_vrf):
 
     return pe_to_ce_edges, ce_to_pe_edges
 
+@profiler.profiled("build")
 def build_vrf(anm):
     """Build VRF Overlay"""
     g_in = anm['input']
@@ -284,34 +301,72 @@ def three_tier_ibgp_corner_cases(rtrs):
 
     return up_links, down_links, over_links
 
+def ibgp_attrs(routers):
+    """Returns (ibgp_level, ibgp_l2_cluster, ibgp_l3_cluster) of each router,
+    read once rather than per candidate pair"""
+    return [(r.ibgp_level, r.ibgp_l2_cluster, r.ibgp_l3_cluster)
+            for r in routers]
+
+def ibgp_sessions(routers, attrs, src_level, dst_level, key):
+    """Returns (s, t) for s != t, where s is at src_level, t is at dst_level,
+    and key(attrs) of s and t are equal.
+    Routers are bucketed on key, so cost is proportional to sessions
+    returned. Sessions are in the same order as filtering all pairs."""
+    buckets = {}
+    for index, (router, attr) in enumerate(zip(routers, attrs)):
+        if attr[0] == dst_level:
+            buckets.setdefault(key(attr), []).append((index, router))
+
+    sessions = []
+    for index, (router, attr) in enumerate(zip(routers, attrs)):
+        if attr[0] != src_level:
+            continue
+        sessions += [(router, dst) for (dst_index, dst)
+                in buckets.get(key(attr), []) if dst_index != index]
+    return sessions
+
+def ibgp_meshes(routers, attrs, level, key):
+    """Returns lists of routers at level with equal key(attrs), in order.
+    Each list of two or more routers is a full mesh of sessions."""
+    buckets = {}
+    keys = []
+    for router, attr in zip(routers, attrs):
+        if attr[0] != level:
+            continue
+        if key(attr) not in buckets:
+            keys.append(key(attr))
+        buckets.setdefault(key(attr), []).append(router)
+    return [buckets[k] for k in keys if len(buckets[k]) > 1]
+
+def same_l2_l3_cluster(attr):
+    return attr[1:]
+
+def same_l3_cluster(attr):
+    return attr[2]
+
+def any_cluster(attr):
+    return None
+
+@profiler.profiled("build")
 def three_tier_ibgp_edges(routers):
     """Constructs three-tier ibgp"""
     up_links = []
     down_links = []
     over_links = []
-    all_pairs = [(s, t) for s in routers for t in routers if s != t]
-    l1_l2_up_links = [(s, t) for (s, t) in all_pairs
-                      if (s.ibgp_level, t.ibgp_level) == (1, 2)
-                      and s.ibgp_l2_cluster == t.ibgp_l2_cluster
-                      and s.ibgp_l3_cluster == t.ibgp_l3_cluster
-                      ]
+    attrs = ibgp_attrs(routers)
+    l1_l2_up_links = ibgp_sessions(routers, attrs, 1, 2, same_l2_l3_cluster)
     up_links += l1_l2_up_links
     down_links += [(t, s) for (s, t) in l1_l2_up_links]  # the reverse
 
-    over_links += [(s, t) for (s, t) in all_pairs
-                   if s.ibgp_level == t.ibgp_level == 2
-                   and s.ibgp_l2_cluster == t.ibgp_l2_cluster
-                   and s.ibgp_l3_cluster == t.ibgp_l3_cluster
-                   ]  # l2 peer links
+    over_links += ibgp_sessions(routers, attrs, 2, 2,
+            same_l2_l3_cluster)  # l2 peer links
 
-    l2_l3_up_links = [(s, t) for (s, t) in all_pairs
-                      if (s.ibgp_level, t.ibgp_level) == (2, 3)
-                      and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    l2_l3_up_links = ibgp_sessions(routers, attrs, 2, 3, same_l3_cluster)
     up_links += l2_l3_up_links
     down_links += [(t, s) for (s, t) in l2_l3_up_links]  # the reverse
 
-    over_links += [(s, t) for (s, t) in all_pairs
-                   if s.ibgp_level == t.ibgp_level == 3]  # l3 peer links
+    over_links += ibgp_sessions(routers, attrs, 3, 3,
+            any_cluster)  # l3 peer links
 
 # also check for any clusters which only contain l1 and l3 links
     l1_l3_up_links, l1_l3_down_links, l1_l3_over_links = three_tier_ibgp_corner_cases(routers)
@@ -322,20 +377,17 @@ def three_tier_ibgp_edges(routers):
     return up_links, down_links, over_links
 
 
+@profiler.profiled("build")
 def build_two_tier_ibgp(routers):
     """Constructs two-tier ibgp"""
-    up_links = down_links = over_links = []
-    all_pairs = [(s, t) for s in routers for t in routers if s != t]
-    up_links = [(s, t) for (s, t) in all_pairs
-                if (s.ibgp_level, t.ibgp_level) == (1, 2)
-                and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    attrs = ibgp_attrs(routers)
+    up_links = ibgp_sessions(routers, attrs, 1, 2, same_l3_cluster)
     down_links = [(t, s) for (s, t) in up_links]  # the reverse
 
-    over_links = [(s, t) for (s, t) in all_pairs
-                  if s.ibgp_level == t.ibgp_level == 2
-                  and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    over_links = ibgp_sessions(routers, attrs, 2, 2, same_l3_cluster)
     return up_links, down_links, over_links
 
+@profiler.profiled("build")
 def build_bgp(anm):
     """Build iBGP end eBGP overlays"""
     # eBGP
@@ -384,6 +436,7 @@ def build_bgp(anm):
             # ibgp_l3_cluster defaults to ASN
             node.ibgp_l3_cluster = node.asn
 
+    ibgp_full_meshes = []
     for asn, devices in ank_utils.groupby("asn", g_bgp):
         # group by nodes in phy graph
         routers = list(g_bgp.node(n) for n in devices if n.is_router)
@@ -392,7 +445,6 @@ def build_bgp(anm):
         max_level = max(ibgp_levels)
         # all possible edge src/dst pairs
         ibgp_routers = [r for r in routers if r.ibgp_level > 0]
-        all_pairs = [(s, t) for s in ibgp_routers for t in ibgp_routers if s != t]
         if max_level == 3:
             up_links, down_links, over_links = three_tier_ibgp_edges(ibgp_routers)
 
@@ -402,10 +454,9 @@ def build_bgp(anm):
         elif max_level == 1:
             up_links = []
             down_links = []
-            over_links = [(s, t) for (s, t) in all_pairs
-                             if s.ibgp_l3_cluster == t.ibgp_l3_cluster
-                             and s.ibgp_l2_cluster == t.ibgp_l2_cluster
-                             ]
+            over_links = [] # all routers are level 1: stored as mesh groups
+            ibgp_full_meshes += ibgp_meshes(ibgp_routers,
+                    ibgp_attrs(ibgp_routers), 1, same_l2_l3_cluster)
         else:
             # no iBGP
             up_links = []
@@ -447,6 +498,12 @@ def build_bgp(anm):
         for interface in node.interfaces():
             interface.multipoint = any(e.multipoint for e in interface.edges())
 
+    # added last so loops above don't expand each session
+    for routers in ibgp_full_meshes:
+        g_bgp.add_mesh_group(routers, interface=0, type='ibgp',
+                direction='over')
+
+@profiler.profiled("build")
 def build_ipv6(anm):
     """Builds IPv6 graph, using nodes and edges from IPv4 graph"""
     import autonetkit.plugins.ipv6 as ipv6
@@ -529,6 +586,7 @@ def manual_ipv4_loopback_allocation(anm):
 
     g_ipv4.data.loopback_blocks = loopback_blocks
 
+@profiler.profiled("build")
 def build_ip(anm):
     g_ip = anm.add_overlay("ip")
     g_in = anm['input']
@@ -547,11 +605,13 @@ def build_ip(anm):
         edge.split = True # mark as split for use in building nidb
     split_created_nodes = list(
         ank_utils.split(g_ip, edges_to_split, retain=['edge_id', 'split']))
-    for node in split_created_nodes:
-        node['graphics'].x = ank_utils.neigh_average(g_ip, node, "x",
-                                                     g_graphics) + 0.1 # temporary fix for gh-90
-        node['graphics'].y = ank_utils.neigh_average(g_ip, node, "y",
-                                                     g_graphics) + 0.1 # temporary fix for gh-90
+    x_averages = ank_utils.neigh_averages(g_ip, split_created_nodes, "x",
+                                          g_graphics)
+    y_averages = ank_utils.neigh_averages(g_ip, split_created_nodes, "y",
+                                          g_graphics)
+    for node, x, y in zip(split_created_nodes, x_averages, y_averages):
+        node['graphics'].x = x + 0.1 # temporary fix for gh-90
+        node['graphics'].y = y + 0.1 # temporary fix for gh-90
         asn = ank_utils.neigh_most_frequent(
             g_ip, node, "asn", g_phy)  # arbitrary choice
         node['graphics'].asn = asn
@@ -579,6 +639,7 @@ def build_ip(anm):
             node.cd_id = cd_label
             graphics_node.label = cd_label
 
+@profiler.profiled("build")
 def build_ipv4(anm, infrastructure=True):
     """Builds IPv4 graph"""
     g_ipv4 = anm.add_overlay("ipv4")
@@ -591,24 +652,32 @@ def build_ipv4(anm, infrastructure=True):
     g_ipv4.add_edges_from(g_ip.edges())
     autonetkit.update_http(anm)
 
+    import autonetkit.plugins.ipv4 as ipv4
+    journal = None
+    if g_in.data.stable_ip_allocation:
+        journal = ipv4.AllocationJournal()
+    headroom = g_in.data.ip_headroom or 0
+
     #TODO: need to set allocate_ipv4 by default in the readers
     if g_in.data.alloc_ipv4_infrastructure is False:
         manual_ipv4_infrastructure_allocation(anm)
     else:
-        import autonetkit.plugins.ipv4 as ipv4
-        ipv4.allocate_ips(g_ipv4, infrastructure = True, loopbacks = False)
+        ipv4.allocate_ips(g_ipv4, infrastructure = True, loopbacks = False,
+                journal = journal, headroom = headroom)
         #ank_utils.save(g_ipv4)
 
     if g_in.data.alloc_ipv4_loopbacks is False:
         manual_ipv4_loopback_allocation(anm)
     else:
-        import autonetkit.plugins.ipv4 as ipv4
-        ipv4.allocate_ips(g_ipv4, infrastructure = False, loopbacks = True)
+        ipv4.allocate_ips(g_ipv4, infrastructure = False, loopbacks = True,
+                journal = journal, headroom = headroom)
         #ank_utils.save(g_ipv4)
 
     #TODO: need to also support secondary_loopbacks for IPv6
     ipv4.allocate_ips(g_ipv4, infrastructure = False, loopbacks = True,
-            secondary_loopbacks = True)
+            secondary_loopbacks = True, journal = journal, headroom = headroom)
+    if journal:
+        journal.save()
 
     autonetkit.update_http(anm)
 
@@ -625,6 +694,7 @@ def build_ipv4(anm, infrastructure=True):
     # TODO: also map loopbacks to loopback interface 0
     autonetkit.update_http(anm)
 
+@profiler.profiled("build")
 def build_phy(anm):
     """Build physical overlay"""
     g_in = anm['input']
@@ -646,6 +716,7 @@ def build_phy(anm):
                 directed_edge = anm['input_directed'].edge(edge)
                 interface.name = directed_edge.name
 
+@profiler.profiled("build")
 def build_conn(anm):
     """Build connectivity overlay"""
     g_in = anm['input']
@@ -655,6 +726,7 @@ def build_conn(anm):
 
     return
 
+@profiler.profiled("build")
 def build_ospf(anm):
     """
     Build OSPF graph.
@@ -672,7 +744,7 @@ def build_ospf(anm):
     """
     import netaddr
     g_in = anm['input']
-    g_ospf = anm.add_overlay("ospf")
+    g_ospf = anm.add_overlay("ospf", parent=g_in)
     g_ospf.add_nodes_from(g_in.nodes("is_router", igp = "ospf"), retain=['asn'])
     g_ospf.add_nodes_from(g_in.nodes("is_switch"), retain=['asn'])
     g_ospf.add_edges_from(g_in.edges(), retain=['edge_id'])
@@ -813,6 +885,7 @@ def ip_to_net_bit_str(ip_addr):
 
     return dec_str 
 
+@profiler.profiled("build")
 def build_isis(anm):
     """Build isis overlay"""
     g_in = anm['input']
@@ -820,7 +893,7 @@ def build_isis(anm):
         log.debug("No ISIS nodes")
         return
     g_ipv4 = anm['ipv4']
-    g_isis = anm.add_overlay("isis")
+    g_isis = anm.add_overlay("isis", parent=g_in)
     g_isis.add_nodes_from(g_in.nodes("is_router", igp = "isis"), retain=['asn'])
     g_isis.add_nodes_from(g_in.nodes("is_switch"), retain=['asn'])
     g_isis.add_edges_from(g_in.edges(), retain=['edge_id'])
@@ -850,6 +923,7 @@ def build_isis(anm):
             interface.metric = edge.metric
             interface.multipoint = edge.multipoint
 
+@profiler.profiled("build")
 def build_dns(anm):
     """Build dns overlay"""
     # Annahme: Ein DNS Server per AS
@@ -858,7 +932,7 @@ def build_dns(anm):
     g_ipv4 = anm['ipv4']
 
     # create overlay, copy all references to all relevant nodes
-    g_dns = anm.add_overlay("dns")
+    g_dns = anm.add_overlay("dns", parent=g_in)
     g_dns.add_nodes_from(g_in.nodes("dns"), retain=['asn', 'dns', 'dns2'])
     # TODO: Create edges for clients -> ( recursors -> ) servers
     # FIXME: g_dns.remove all with dns == "" or "none" or "None" 
@@ -910,14 +984,16 @@ def build_dns(anm):
                 sys.exit(1)
 
     for node in g_dns:
-        node.dns_role = g_dns._graph.node[str(node)]["dns"]
-        node.dns_type = g_dns._graph.node[str(node)]["dns2"]
+        node.dns_role = node.dns
+        node.dns_type = node.dns2
 
+@profiler.profiled("build")
 def build_memory(anm):
     g_in = anm['input']
-    g_mem = anm.add_overlay("memory")
+    g_mem = anm.add_overlay("memory", parent=g_in)
     g_mem.add_nodes_from(g_in.nodes("memory"), retain=['memory'])
 
+@profiler.profiled("build")
 def build_speed(anm):
     g_in = anm['input']
     g_speed = anm.add_overlay("speed")
@@ -938,6 +1014,28 @@ def build_speed(anm):
         edge.src_int.delay = delay
         edge.dst_int.delay = delay
 
+# Build phases in sequential order, with the overlays each reads and writes.
+# All overlays read phy, as interfaces fall through to phy interface data.
+# bgp is listed before the other protocol phases, as the first of a group of
+# independent phases runs in the main process: it is the slowest to build,
+# and has the largest overlay to transfer from a worker.
+BUILD_PHASES = [
+    Phase("phy", build_phy, ["input", "input_directed"], ["phy"]),
+    # vrf adds loopbacks to phy before ip allocations
+    Phase("vrf", build_vrf, ["input", "phy"], ["vrf", "phy"]),
+    Phase("ip", build_ip, ["input", "phy", "graphics"], ["ip", "graphics"]),
+    Phase("ip_families", build_ip_families,
+        ["input", "input_directed", "ip", "phy"], ["ipv4", "ipv6", "phy"]),
+    Phase("igp_defaults", build_igp_defaults, ["input", "phy"],
+        ["input", "phy", "ospf", "isis"]),
+    Phase("bgp", build_bgp, ["input", "phy"], ["bgp"]),
+    Phase("ospf", build_ospf, ["input", "phy"], ["ospf"]),
+    Phase("isis", build_isis, ["input", "phy", "ipv4"], ["isis"]),
+    Phase("dns", build_dns, ["input", "phy", "ipv4"], ["dns"]),
+    Phase("memory", build_memory, ["input", "phy"], ["memory"]),
+    Phase("speed", build_speed, ["input", "phy"], ["speed"]),
+    ]
+
 def update_messaging(anm):
     """Sends ANM to web server"""
     log.debug("Sending anm to messaging")
@@ -0,0 +1,133 @@
+"""Dependency-aware scheduler for build phases
+
+A build is declared as a list of phases, in sequential order, each with the
+overlays it reads and writes. A phase must run after any earlier phase that
+writes an overlay it reads or writes, or reads an overlay it writes.
+Phases with no such dependency between them can run concurrently, in worker
+processes: the overlays each phase writes are sent back and merged into
+the ANM.
+"""
+
+import os
+import cPickle
+from cStringIO import StringIO
+import multiprocessing
+import autonetkit.log as log
+import autonetkit.profiler as profiler
+
+class Phase(object):
+    """Build step: func(anm), reading and writing the named overlays"""
+    def __init__(self, name, func, reads, writes):
+        self.name = name
+        self.func = func
+        self.reads = set(reads)
+        self.writes = set(writes)
+
+    def __repr__(self):
+        return self.name
+
+    def depends_on(self, other):
+        """If this phase must run after other (an earlier phase)"""
+        return bool(other.writes & (self.reads | self.writes)
+                or other.reads & self.writes)
+
+def waves(phases):
+    """Groups phases into lists which can run concurrently,
+    each after all phases in previous lists"""
+    level = {}
+    for index, phase in enumerate(phases):
+        level[phase.name] = max([level[earlier.name] + 1
+            for earlier in phases[:index] if phase.depends_on(earlier)] or [0])
+
+    retval = [[] for _ in range(max(level.values() or [-1]) + 1)]
+    for phase in phases:
+        retval[level[phase.name]].append(phase) # keep declared order
+    return retval
+
+def run(anm, phases, jobs=1, completed=None):
+    """Runs phases on anm, using up to jobs worker processes.
+    completed(anm, phase) is called after each phase finishes"""
+    if jobs > 1 and not hasattr(os, "fork"):
+        log.info("Parallel build requires fork, building sequentially")
+        jobs = 1
+
+    for wave in waves(phases):
+        if jobs > 1 and len(wave) > 1:
+            log.debug("Running build phases %s in parallel" % wave)
+            results = run_parallel(anm, wave, jobs)
+            if completed:
+                completed(anm, wave[0])
+            for phase, result in zip(wave[1:], results):
+                merge(anm, result)
+                if completed:
+                    completed(anm, phase)
+            continue
+
+        for phase in wave:
+            run_phase(anm, phase)
+            if completed:
+                completed(anm, phase)
+
+def run_phase(anm, phase):
+    with profiler.phase("build_phase", phase.name, count_objects=True):
+        phase.func(anm)
+
+# set before forking workers, so inherited rather than pickled
+_worker_anm = None
+_worker_phases = None
+
+def _anm_id(anm):
+    def persistent_id(obj):
+        if obj is anm:
+            return "anm" # wrappers stored in data refer to the parent's anm
+        return None
+    return persistent_id
+
+def _run_phase(index):
+    """Runs phase in worker, returns pickled overlays it wrote,
+    and profiler records"""
+    anm = _worker_anm
+    phase = _worker_phases[index]
+    profiler.reset() # only send back records from this phase
+    run_phase(anm, phase)
+    overlays = dict((overlay_id, (anm._overlays[overlay_id],
+        anm._views.get(overlay_id))) for overlay_id in phase.writes
+        if overlay_id in anm._overlays)
+
+    data = StringIO()
+    pickler = cPickle.Pickler(data, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = _anm_id(anm)
+    pickler.dump((overlays, profiler.records))
+    return data.getvalue()
+
+def run_parallel(anm, phases, jobs):
+    """Runs first phase in this process, and the others concurrently in
+    up to jobs - 1 worker processes. Returns results of the other phases.
+    Running the first phase locally avoids transferring its overlays,
+    and keeps the order of their data the same as a sequential build."""
+    global _worker_anm, _worker_phases
+    _worker_anm = anm
+    _worker_phases = phases
+    pool = multiprocessing.Pool(min(jobs - 1, len(phases) - 1))
+    try:
+        pending = pool.map_async(_run_phase, range(1, len(phases)))
+        run_phase(anm, phases[0])
+        results = pending.get()
+    finally:
+        pool.close()
+        pool.join()
+        _worker_anm = _worker_phases = None
+
+    retval = []
+    for result in results:
+        unpickler = cPickle.Unpickler(StringIO(result))
+        unpickler.persistent_load = lambda persistent_id: anm
+        overlays, records = unpickler.load()
+        profiler.records.extend(records)
+        retval.append(overlays)
+    return retval
+
+def merge(anm, overlays):
+    """Sets overlays returned from a worker into anm"""
+    for overlay_id, (graph, view) in overlays.items():
+        anm._set_overlay(overlay_id, graph, view)
@@ -0,0 +1,187 @@
+"""Cache of compiled NIDB node data, to skip recompiling unchanged nodes
+
+Each node is keyed by a hash of its compile inputs: its data before compile
+(render settings, interface ids), its data in the overlays the compilers
+read, its edges and iBGP mesh groups there and the data of the nodes they
+connect to, the graph data of those overlays, and the source of the router
+compiler. Keys are stored in the NIDB graph data, so a cache can be loaded
+from the previous NIDB kept in memory (monitor mode), or from the compiled
+node data archived with the NIDB in versions/nidb.
+"""
+
+import os
+import sys
+import copy
+import gzip
+import json
+import cPickle
+import hashlib
+import inspect
+import autonetkit.log as log
+import autonetkit.ank_json as ank_json
+
+# overlays read by the router compilers
+COMPILE_OVERLAYS = ("input", "phy", "graphics", "ipv4", "ipv6", "ospf",
+        "isis", "bgp", "vrf", "dns", "memory", "speed")
+
+CACHE_FILE = os.path.join("versions", "nidb", "compile_cache.pickle.gz")
+
+_compiler_versions = {}
+
+def compiler_version(router_compiler):
+    """Returns digest of source of router_compiler's class and its bases"""
+    cls = type(router_compiler)
+    if cls not in _compiler_versions:
+        digest = hashlib.md5()
+        for base in inspect.getmro(cls):
+            module = sys.modules.get(base.__module__)
+            try:
+                digest.update(inspect.getsource(module))
+            except (IOError, TypeError):
+                digest.update(base.__module__) # builtin, or no source
+        _compiler_versions[cls] = digest.hexdigest()
+    return _compiler_versions[cls]
+
+def _digest(data):
+    return hashlib.md5(json.dumps(data, cls=ank_json.AnkEncoder,
+        sort_keys=True)).hexdigest()
+
+class CompileCache(object):
+    """Compiled node data by compile key, and hit and miss counts"""
+    def __init__(self, anm, previous = None):
+        self.anm = anm
+        self.entries = {} # {key: node data}
+        self.hits = 0
+        self.misses = 0
+        self._node_digests = None # built on first key, after build
+        if previous is not None:
+            self.load(previous)
+
+    def __repr__(self):
+        return "CompileCache: %s entries" % len(self.entries)
+
+    def load(self, nidb):
+        """Adds compiled node data of (previous) nidb"""
+        graph = nidb._graph
+        for node_id, key in graph.graph.get('compile_keys', {}).items():
+            if node_id in graph:
+                self.entries[key] = graph.node[node_id]
+        log.debug("Loaded %s compiled nodes into compile cache"
+                % len(self.entries))
+
+    def _node_data(self, overlay_id, graph, node_id):
+        """Node data, including attributes read through from a parent view"""
+        data = graph.node[node_id]
+        view = self.anm._views.get(overlay_id)
+        if view is None:
+            return data
+        data = dict(data)
+        for key in view.retained.get(node_id, ()):
+            if key not in data:
+                data[key] = self.anm._view_attr(overlay_id, node_id, key)
+        return data
+
+    def _overlays(self):
+        return [(overlay_id, self.anm._overlays[overlay_id])
+                for overlay_id in COMPILE_OVERLAYS
+                if overlay_id in self.anm._overlays]
+
+    def _build_digests(self):
+        """Digests of each overlay's graph data, each node's data in all
+        overlays, and each mesh group (members are compiled together)"""
+        self._overlay_digests = {}
+        self._node_digests = {}
+        self._mesh_digests = {}
+        node_data = {}
+        for overlay_id, graph in self._overlays():
+            graph_data = dict(graph.graph)
+            groups = graph_data.pop('mesh_groups', [])
+            self._overlay_digests[overlay_id] = _digest(graph_data)
+            for node_id in graph:
+                node_data.setdefault(node_id, []).append((overlay_id,
+                    self._node_data(overlay_id, graph, node_id)))
+            for group in groups:
+                for member in group['members']:
+                    self._mesh_digests.setdefault(member, []).append(group)
+
+        self._node_digests = dict((node_id, _digest(data))
+                for node_id, data in node_data.items())
+        group_digests = {}
+        for node_id, groups in self._mesh_digests.items():
+            digests = []
+            for group in groups:
+                if id(group) not in group_digests:
+                    group_digests[id(group)] = _digest([group['interface'],
+                        group['data'], [(member, self._node_digests.get(member))
+                            for member in group['members']]])
+                digests.append(group_digests[id(group)])
+            self._mesh_digests[node_id] = digests
+
+    def key(self, router_compiler, nidb_node):
+        """Returns hash of compile inputs of nidb_node"""
+        if self._node_digests is None:
+            self._build_digests()
+        node_id = nidb_node.node_id
+        inputs = [compiler_version(router_compiler),
+                nidb_node.nidb._graph.node[node_id],
+                self._node_digests.get(node_id),
+                self._mesh_digests.get(node_id, [])]
+        for overlay_id, graph in self._overlays():
+            if node_id not in graph:
+                continue
+            edges = [("out", str(neigh), data)
+                    for neigh, data in graph[node_id].items()]
+            if graph.is_directed():
+                edges += [("in", str(neigh), data)
+                        for neigh, data in graph.pred[node_id].items()]
+            edges.sort(key = lambda edge: edge[:2])
+            inputs.append([overlay_id, self._overlay_digests[overlay_id],
+                [(direction, neigh, data, self._node_digests.get(neigh))
+                    for direction, neigh, data in edges]])
+        return _digest(inputs)
+
+    def restore(self, nidb_node, key):
+        """Sets compiled data for key on nidb_node, returns False if not cached"""
+        try:
+            data = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        nidb_node.nidb._graph.node[nidb_node.node_id] = copy.deepcopy(data)
+        return True
+
+    def record(self, nidb_node, key):
+        """Stores key of compiled nidb_node in its nidb"""
+        graph = nidb_node.nidb._graph
+        graph.graph.setdefault('compile_keys', {})[nidb_node.node_id] = key
+
+def save(nidb, filename = None):
+    """Archives compiled node data of nidb by key, for load_cache.
+    Pickled, as the json NIDB archive doesn't keep types (eg interface ids)"""
+    if not filename:
+        filename = CACHE_FILE
+    archive_dir = os.path.dirname(filename)
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+    graph = nidb._graph
+    entries = dict((key, graph.node[node_id]) for node_id, key
+            in graph.graph.get('compile_keys', {}).items() if node_id in graph)
+    log.debug("Saving compile cache to %s" % filename)
+    with gzip.open(filename, "wb") as fh:
+        cPickle.dump(entries, fh, cPickle.HIGHEST_PROTOCOL)
+
+def load_cache(anm, previous = None, filename = None):
+    """Returns cache for anm, from previous nidb, or else archived by save"""
+    cache = CompileCache(anm, previous)
+    if previous is None:
+        if not filename:
+            filename = CACHE_FILE
+        if os.path.isfile(filename):
+            with gzip.open(filename, "rb") as fh:
+                cache.entries = cPickle.load(fh)
+            log.debug("Loaded %s compiled nodes into compile cache"
+                    % len(cache.entries))
+        else:
+            log.debug("No archived compile cache in %s" % filename)
+    return cache
@@ -2,10 +2,14 @@ import autonetkit.ank as ank
 import itertools
 import netaddr
 import os
+import cPickle
+import multiprocessing
+from cStringIO import StringIO
 from collections import defaultdict
 import string
 from datetime import datetime
 import autonetkit.log as log
+import autonetkit.profiler as profiler
 import autonetkit.plugins.naming as naming
 import autonetkit.config
 settings = autonetkit.config.settings
@@ -22,6 +26,71 @@ def dot_to_underscore(instring):
     """Replace dots with underscores"""
     return instring.replace(".", "_")
 
+class CompileContext(object):
+    """Overlays, overlay nodes and interfaces of a node being compiled.
+    Each is looked up once, and shared by the compiler methods,
+    rather than per method and interface"""
+    def __init__(self, anm, node):
+        self.anm = anm
+        self.node_id = node.node_id
+        self._node = node
+        self._overlays = {}
+        self._nodes = {}
+        self._interfaces = {}
+        self._physical_interfaces = None
+        self._loopback_interfaces = None
+        self._loopback_zero = None
+
+    def __repr__(self):
+        return "CompileContext %s" % self.node_id
+
+    def overlay(self, overlay_id):
+        try:
+            return self._overlays[overlay_id]
+        except KeyError:
+            overlay = self._overlays[overlay_id] = self.anm[overlay_id]
+            return overlay
+
+    def node(self, overlay_id):
+        """Returns node in overlay_id, None if not in overlay"""
+        try:
+            return self._nodes[overlay_id]
+        except KeyError:
+            node = self._nodes[overlay_id] = self.overlay(overlay_id).node(
+                    self._node)
+            return node
+
+    def in_overlay(self, overlay_id):
+        return self.node(overlay_id) is not None
+
+    def interface(self, interface, overlay_id = "phy"):
+        """Returns interface in overlay_id"""
+        key = (interface.interface_id, overlay_id)
+        try:
+            return self._interfaces[key]
+        except KeyError:
+            overlay_int = self._interfaces[key] = self.overlay(
+                    overlay_id).interface(interface)
+            return overlay_int
+
+    @property
+    def physical_interfaces(self):
+        if self._physical_interfaces is None:
+            self._physical_interfaces = list(self._node.physical_interfaces)
+        return self._physical_interfaces
+
+    @property
+    def loopback_interfaces(self):
+        if self._loopback_interfaces is None:
+            self._loopback_interfaces = list(self._node.loopback_interfaces)
+        return self._loopback_interfaces
+
+    @property
+    def loopback_zero(self):
+        if self._loopback_zero is None:
+            self._loopback_zero = self._node.loopback_zero
+        return self._loopback_zero
+
 class RouterCompiler(object):
     """Base router compiler"""
     lo_interface = "lo0"
@@ -32,10 +101,19 @@ class RouterCompiler(object):
     def __init__(self, nidb, anm):
         self.nidb = nidb
         self.anm = anm
+        self._context = None
+
+    def context(self, node):
+        """Returns CompileContext of node, shared by the methods compiling it"""
+        context = self._context
+        if context is None or context.node_id != node.node_id:
+            context = self._context = CompileContext(self.anm, node)
+        return context
 
     def compile(self, node):
-        phy_node = self.anm['phy'].node(node)
-        ipv4_node = self.anm['ipv4'].node(node)
+        context = self.context(node)
+        phy_node = context.node('phy')
+        ipv4_node = context.node('ipv4')
 
         node.ip.use_ipv4 = phy_node.use_ipv4 or False
         node.ip.use_ipv6 = phy_node.use_ipv6 or False
@@ -50,22 +128,23 @@ class RouterCompiler(object):
         node.loopback_subnet.prefixlen = 32
 
         self.interfaces(node)
-        if node in self.anm['ospf']:
+        if context.in_overlay('ospf'):
             self.ospf(node)
-        if node in self.anm['isis']:
+        if context.in_overlay('isis'):
             self.isis(node)
-        if node in self.anm['bgp']:
+        if context.in_overlay('bgp'):
             self.bgp(node)
         self.speed(node)
 
     def interfaces(self, node):
+        context = self.context(node)
         node.interfaces = []
 
-        node.loopback_zero.id = self.lo_interface
-        node.loopback_zero.description = "Loopback"
+        context.loopback_zero.id = self.lo_interface
+        context.loopback_zero.description = "Loopback"
 
-        for interface in node.physical_interfaces:
-            phy_int = self.anm['phy'].interface(interface)
+        for interface in context.physical_interfaces:
+            phy_int = context.interface(interface)
 
             interface.description = phy_int.description
 
@@ -73,36 +152,35 @@ class RouterCompiler(object):
             #TODO: allocate ID in platform compiler
 
             if node.ip.use_ipv4:
-                ipv4_int = phy_int['ipv4']
+                ipv4_int = context.interface(interface, 'ipv4')
                 interface.ipv4_address = ipv4_int.ip_address
                 interface.ipv4_subnet = ipv4_int.subnet
                 interface.ipv4_cidr = address_prefixlen_to_network(interface.ipv4_address,
                         interface.ipv4_subnet.prefixlen)
 
             if node.ip.use_ipv6:
-                ipv6_int = phy_int['ipv6']
+                ipv6_int = context.interface(interface, 'ipv6')
 #TODO: for consistency, make ipv6_cidr
                 interface.ipv6_subnet = ipv6_int.subnet
                 interface.ipv6_address = address_prefixlen_to_network(ipv6_int.ip_address,
                         interface.ipv6_subnet.prefixlen)
 
 
-        for interface in node.loopback_interfaces:
+        for interface in context.loopback_interfaces:
             #TODO: check if nonzero is different to __eq__
-            if interface == node.loopback_zero:
+            if interface == context.loopback_zero:
                 continue
             else:
                 #print "here for non zero", interface.id
-                phy_int = self.anm['phy'].interface(interface)
                 if node.ip.use_ipv4:
-                    ipv4_int = phy_int['ipv4']
+                    ipv4_int = context.interface(interface, 'ipv4')
                     interface.ipv4_address = ipv4_int.loopback
                     interface.ipv4_subnet = node.loopback_subnet
                     interface.ipv4_cidr = address_prefixlen_to_network(interface.ipv4_address,
                             interface.ipv4_subnet.prefixlen)
 
                 if node.ip.use_ipv6:
-                    ipv6_int = phy_int['ipv6']
+                    ipv6_int = context.interface(interface, 'ipv6')
 #TODO: for consistency, make ipv6_cidr
                     #interface.ipv6_subnet = ipv6_int.loopback # TODO: do we need for consistency?
                     interface.ipv6_address = address_prefixlen_to_network(
@@ -131,21 +209,20 @@ class RouterCompiler(object):
     def ospf(self, node):
         """Returns OSPF links, also sets process_id
         """
-        g_ospf = self.anm['ospf']
-        g_ipv4 = self.anm['ipv4']
+        context = self.context(node)
 
-        node.ospf.loopback_area = g_ospf.node(node).area
+        node.ospf.loopback_area = context.node('ospf').area
 
         node.ospf.process_id = 1 #TODO: set this in build_network module
         node.ospf.lo_interface = self.lo_interface
 
         node.ospf.ospf_links = []
         added_networks = set()
-        for interface in node.physical_interfaces:
+        for interface in context.physical_interfaces:
             if interface.exclude_igp:
                 continue # don't configure IGP for this interface
-            ipv4_int = g_ipv4.interface(interface)
-            ospf_int = g_ospf.interface(interface)
+            ipv4_int = context.interface(interface, 'ipv4')
+            ospf_int = context.interface(interface, 'ospf')
             if not ospf_int.is_bound:
                 continue # not an OSPF interface
             try:
@@ -167,9 +244,10 @@ class RouterCompiler(object):
                 )
 
     def bgp(self, node):
-        phy_node = self.anm['phy'].node(node)
-        g_bgp = self.anm['bgp']
-        g_ipv4 = self.anm['ipv4']
+        context = self.context(node)
+        phy_node = context.node('phy')
+        g_bgp = context.overlay('bgp')
+        g_ipv4 = context.overlay('ipv4')
         asn = phy_node.asn
         node.asn = asn
         node.bgp.ipv4_advertise_subnets = []
@@ -178,7 +256,7 @@ class RouterCompiler(object):
                 asn) or []  # could be none (if one-node AS) default empty list
         node.bgp.ipv6_advertise_subnets = []
         if node.ip.use_ipv6:
-            g_ipv6 = self.anm['ipv6']
+            g_ipv6 = context.overlay('ipv6')
             node.bgp.ipv6_advertise_subnets = g_ipv6.data.infra_blocks.get(
                 asn) or []
 
@@ -192,7 +270,7 @@ class RouterCompiler(object):
             if use_ipv4:
                 neigh_ip = g_ipv4.node(neigh)
             elif use_ipv6:
-                neigh_ip = self.anm['ipv6'].node(neigh)
+                neigh_ip = context.overlay('ipv6').node(neigh)
             else:
                 log.debug(
                     "Neither v4 nor v6 selected for BGP session %s, skipping"
@@ -209,7 +287,7 @@ class RouterCompiler(object):
                     'asn': neigh.asn,
                     'loopback': neigh_ip.loopback,
                     # TODO: this is platform dependent???
-                    'update_source': node.loopback_zero.id,
+                    'update_source': update_source,
                 }
                 if session.direction == 'down':
                     # ibgp_rr_clients[key] = data
@@ -236,9 +314,10 @@ class RouterCompiler(object):
                     'local_int_ip': local_int_ip,
                     'dst_int_ip': dst_int_ip,
                     # TODO: change templates to access from node.bgp.lo_int
-                    'update_source': node.loopback_zero.id,
+                    'update_source': update_source,
                 })
 
+        update_source = context.loopback_zero.id
         for session in g_bgp.edges(phy_node):
             if node.ip.use_ipv4:
                 format_session(session, use_ipv4=True)
@@ -249,18 +328,15 @@ class RouterCompiler(object):
         return
 
     def isis(self, node):
-        g_isis = self.anm['isis']
+        context = self.context(node)
         node.isis.isis_links = []
 
-        for interface in node.physical_interfaces:
+        for interface in context.physical_interfaces:
             if interface.exclude_igp:
                 continue # don't configure IGP for this interface
 
-            phy_int = self.anm['phy'].interface(interface)
-
-            isis_int = phy_int['isis']
+            isis_int = context.interface(interface, 'isis')
             if isis_int and isis_int.is_bound:
-                isis_node = g_isis.node(node)
                 interface.isis = {
                         'metric': isis_int.metric,
                         'process_id': node.isis.process_id,
@@ -275,25 +351,24 @@ class RouterCompiler(object):
                         multipoint= isis_int.multipoint,
                         )
 
-        g_isis = self.anm['isis']
-        isis_node = self.anm['isis'].node(node)
+        isis_node = context.node('isis')
         node.isis.net = isis_node.net
         node.isis.net_bit_str = isis_node.net_bit_str
         node.isis.process_id = isis_node.process_id
         node.isis.lo_interface = self.lo_interface
 # set isis on loopback_zero
         
-        node.loopback_zero.isis = {
+        context.loopback_zero.isis = {
                         'use_ipv4': node.ip.use_ipv4,
                         'use_ipv6': node.ip.use_ipv6,
                         } #TODO: add wrapper for this
 
     def speed(self, node):
+        context = self.context(node)
         speed = 100000
         count = 3
-        for interface in node.physical_interfaces:
-            phy_int = self.anm['phy'].interface(interface)
-            speed_int = phy_int['speed']
+        for interface in context.physical_interfaces:
+            speed_int = context.interface(interface, 'speed')
             if speed_int.speed > 0:
                 if interface.id.startswith("eth"):
                     interface.speed = {
@@ -309,17 +384,19 @@ class QuaggaCompiler(RouterCompiler):
 
     def compile(self, node):
         super(QuaggaCompiler, self).compile(node)
-        if node in self.anm['isis']:
+        context = self.context(node)
+        if context.in_overlay('isis'):
             self.isis(node)
-        if node in self.anm['dns']:
+        if context.in_overlay('dns'):
             self.dns(node)
         self.speed(node)
         self.memory(node)
 
     def interfaces(self, node):
         """Quagga interface compiler"""
-        ipv4_node = self.anm['ipv4'].node(node)
-        phy_node = self.anm['phy'].node(node)
+        context = self.context(node)
+        ipv4_node = context.node('ipv4')
+        phy_node = context.node('phy')
 
         super(QuaggaCompiler, self).interfaces(node)
         # OSPF cost
@@ -327,23 +404,25 @@ class QuaggaCompiler(RouterCompiler):
         # see yellow note!
 
         if phy_node.is_router:
-            node.loopback_zero.id = self.lo_interface
-            node.loopback_zero.description = "Loopback"
-            node.loopback_zero.ipv4_address=str(ipv4_node.loopback)
-            node.loopback_zero.ipv4_subnet=node.loopback_subnet
+            loopback_zero = context.loopback_zero
+            loopback_zero.id = self.lo_interface
+            loopback_zero.description = "Loopback"
+            loopback_zero.ipv4_address=str(ipv4_node.loopback)
+            loopback_zero.ipv4_subnet=node.loopback_subnet
 
     def ospf(self, node):
         """Quagga ospf compiler"""
         super(QuaggaCompiler, self).ospf(node)
 
         # add eBGP link subnets
+        context = self.context(node)
         node.ospf.passive_interfaces = []
 
-        for interface in node.physical_interfaces:
+        for interface in context.physical_interfaces:
             if interface.exclude_igp:
                 continue # don't configure IGP for this interface
 
-            bgp_int = self.anm['bgp'].interface(interface)
+            bgp_int = context.interface(interface, 'bgp')
             if bgp_int.ebgp: # ebgp interface
                 node.ospf.passive_interfaces.append(
                         id=interface.id,
@@ -361,8 +440,7 @@ class QuaggaCompiler(RouterCompiler):
         super(QuaggaCompiler, self).isis(node)
 
     def dns(self, node):
-        g_dns = self.anm['dns']
-        dns_node = g_dns.node(node)
+        dns_node = self.context(node).node('dns')
 
         if dns_node.dns_role == "server":
             node.dns.role = "server"
@@ -388,8 +466,7 @@ class QuaggaCompiler(RouterCompiler):
     def memory(self, node):
         """Returns memory links, also sets process_id
         """
-        g_memory = self.anm['memory']
-        memory_node = g_memory.node(node)
+        memory_node = self.context(node).node('memory')
         if memory_node:
             if memory_node.memory > 0:
                 node.memory = memory_node.memory
@@ -403,22 +480,23 @@ class IosBaseCompiler(RouterCompiler):
     lo_interface = "%s%s" % (lo_interface_prefix, 0)
 
     def compile(self, node):
+        context = self.context(node)
         self.vrf_igp_interfaces(node)
-        phy_node = self.anm['phy'].node(node)
+        phy_node = context.node('phy')
 
-        if node in self.anm['ospf']:
+        if context.in_overlay('ospf'):
             node.ospf.use_ipv4 = phy_node.use_ipv4
             node.ospf.use_ipv6 = phy_node.use_ipv6
 
-        if node in self.anm['isis']:
+        if context.in_overlay('isis'):
             node.isis.use_ipv4 = phy_node.use_ipv4
             node.isis.use_ipv6 = phy_node.use_ipv6
 
         super(IosBaseCompiler, self).compile(node)
-        if node in self.anm['isis']:
+        if context.in_overlay('isis'):
             self.isis(node)
 
-        node.label = self.anm['phy'].node(node).label
+        node.label = phy_node.label
         """Note:
         VRFs are either: before, and mark IGP interfaces to skip;
         or after, and remove IGP interfaces
@@ -426,19 +504,20 @@ class IosBaseCompiler(RouterCompiler):
         self.vrf(node)
 
     def interfaces(self, node):
-        phy_loopback_zero = self.anm['phy'].interface(node.loopback_zero)
+        context = self.context(node)
+        loopback_zero = context.loopback_zero
         if node.ip.use_ipv4:
             ipv4_loopback_subnet = netaddr.IPNetwork("0.0.0.0/32")
-            ipv4_loopback_zero = phy_loopback_zero['ipv4']
+            ipv4_loopback_zero = context.interface(loopback_zero, 'ipv4')
             ipv4_address = ipv4_loopback_zero.ip_address
-            node.loopback_zero.ipv4_address = ipv4_address
-            node.loopback_zero.ipv4_subnet = ipv4_loopback_subnet
-            node.loopback_zero.ipv4_cidr = address_prefixlen_to_network(
+            loopback_zero.ipv4_address = ipv4_address
+            loopback_zero.ipv4_subnet = ipv4_loopback_subnet
+            loopback_zero.ipv4_cidr = address_prefixlen_to_network(
                     ipv4_address, ipv4_loopback_subnet.prefixlen)
 
         if node.ip.use_ipv6:
-            ipv6_loopback_zero = phy_loopback_zero['ipv6']
-            node.loopback_zero.ipv6_address = address_prefixlen_to_network(
+            ipv6_loopback_zero = context.interface(loopback_zero, 'ipv6')
+            loopback_zero.ipv6_address = address_prefixlen_to_network(
                 ipv6_loopback_zero.ip_address, 128)
 
         super(IosBaseCompiler, self).interfaces(node)
@@ -447,15 +526,16 @@ class IosBaseCompiler(RouterCompiler):
         node.bgp.lo_interface = self.lo_interface
         super(IosBaseCompiler, self).bgp(node)
 
+        context = self.context(node)
         if node.ip.use_ipv4:
-            node.bgp.ipv4_advertise_subnets = [node.loopback_zero.ipv4_cidr]
+            node.bgp.ipv4_advertise_subnets = [context.loopback_zero.ipv4_cidr]
         if node.ip.use_ipv6:
-            node.bgp.ipv6_advertise_subnets = [node.loopback_zero.ipv6_address]
+            node.bgp.ipv6_advertise_subnets = [context.loopback_zero.ipv6_address]
 
         # vrf
         #TODO: this should be inside vrf section?
         node.bgp.vrfs = []
-        vrf_node = self.anm['vrf'].node(node)
+        vrf_node = context.node('vrf')
         if vrf_node.vrf_role is "PE":
             for vrf in vrf_node.node_vrf_names:
                 rd_index = vrf_node.rd_indices[vrf]
@@ -469,16 +549,18 @@ class IosBaseCompiler(RouterCompiler):
 
     def vrf_igp_interfaces(self, node):
         # marks physical interfaces to exclude from IGP
-        vrf_node = self.anm['vrf'].node(node)
+        context = self.context(node)
+        vrf_node = context.node('vrf')
         if vrf_node.vrf_role is "PE":
-            for interface in node.physical_interfaces:
-                vrf_int = self.anm['vrf'].interface(interface)
+            for interface in context.physical_interfaces:
+                vrf_int = context.interface(interface, 'vrf')
                 if vrf_int.vrf_name:
                     interface.exclude_igp = True
 
     def vrf(self, node):
-        g_vrf = self.anm['vrf']
-        vrf_node = self.anm['vrf'].node(node)
+        context = self.context(node)
+        g_vrf = context.overlay('vrf')
+        vrf_node = context.node('vrf')
         node.vrf.vrfs = []
         if vrf_node.vrf_role is "PE":
             #TODO: check if mpls ldp already set elsewhere
@@ -490,8 +572,8 @@ class IosBaseCompiler(RouterCompiler):
                     'route_target': route_target,
                 })
 
-            for interface in node.physical_interfaces:
-                vrf_int = self.anm['vrf'].interface(interface)
+            for interface in context.physical_interfaces:
+                vrf_int = context.interface(interface, 'vrf')
                 if vrf_int.vrf_name:
                     interface.vrf = vrf_int.vrf_name # mark interface as being part of vrf
                     interface.description += " (vrf %s)" % vrf_int.vrf_name
@@ -503,7 +585,7 @@ class IosBaseCompiler(RouterCompiler):
 
         if vrf_node.vrf_role is "P":
             node.mpls.ldp_interfaces = []
-            for interface in node.physical_interfaces:
+            for interface in context.physical_interfaces:
                 node.mpls.ldp_interfaces.append(interface.id)
 
         node.vrf.use_ipv4 = node.ip.use_ipv4
@@ -512,10 +594,9 @@ class IosBaseCompiler(RouterCompiler):
 
     def ospf(self, node):
         super(IosBaseCompiler, self).ospf(node)
-        for interface in node.physical_interfaces:
-            phy_int = self.anm['phy'].interface(interface)
-
-            ospf_int = phy_int['ospf']
+        context = self.context(node)
+        for interface in context.physical_interfaces:
+            ospf_int = context.interface(interface, 'ospf')
             if ospf_int and ospf_int.is_bound:
                 if interface.exclude_igp:
                     continue # don't configure IGP for this interface
@@ -533,21 +614,21 @@ class IosClassicCompiler(IosBaseCompiler):
     def compile(self, node):
         super(IosClassicCompiler, self).compile(node)
 
-        phy_node = self.anm['phy'].node(node)
+        phy_node = self.context(node).node('phy')
         if phy_node.include_csr:
             node.include_csr = True
 
 class Ios2Compiler(IosBaseCompiler):
     def ospf(self, node):
         super(Ios2Compiler, self).ospf(node)
-        g_ospf = self.anm['ospf']
+        context = self.context(node)
         interfaces_by_area = defaultdict(list)
 
-        for interface in node.physical_interfaces:
+        for interface in context.physical_interfaces:
             if interface.exclude_igp:
                 continue # don't configure IGP for this interface
 
-            ospf_int = g_ospf.interface(interface)
+            ospf_int = context.interface(interface, 'ospf')
             if ospf_int and ospf_int.is_bound:
                 area = ospf_int.area
                 interfaces_by_area[area].append({
@@ -556,11 +637,11 @@ class Ios2Compiler(IosBaseCompiler):
                     'passive': False,
                 })
 
-        loopback_zero = node.loopback_zero
-        ospf_loopback_zero = g_ospf.interface(loopback_zero)
+        loopback_zero = context.loopback_zero
+        ospf_loopback_zero = context.interface(loopback_zero, 'ospf')
         router_area = ospf_loopback_zero.area # area assigned to router
         interfaces_by_area[router_area].append({
-            'id': node.loopback_zero.id,
+            'id': loopback_zero.id,
             'cost': 0,
             'passive': True,
         })
@@ -577,20 +658,125 @@ class NxOsCompiler(IosBaseCompiler):
         super(NxOsCompiler, self).ospf(node)
         # TODO: configure OSPF on loopback like example
 
+# Parallel compilation of nodes: router compilers only read the anm and
+# write to the nidb node they compile, so nodes can be compiled in worker
+# processes, and their data merged back into the nidb
+
+# set before forking workers, so inherited rather than pickled
+_worker_compiler = None
+_worker_nodes = None
+
+def _persistent_id(anm, nidb):
+    def persistent_id(obj):
+        # wrappers stored in node data refer to the parent's anm and nidb
+        if obj is anm:
+            return "anm"
+        if obj is nidb:
+            return "nidb"
+        return None
+    return persistent_id
+
+def compile_node(router_compiler, nidb_node):
+    with profiler.phase("compile_node", nidb_node):
+        router_compiler.compile(nidb_node)
+
+def _compile_nodes(indices):
+    """Compiles nodes at indices in worker, returns pickled data of
+    each node, and profiler records"""
+    router_compiler = _worker_compiler
+    profiler.reset() # only send back records from these nodes
+    node_data = []
+    for index in indices:
+        nidb_node = _worker_nodes[index]
+        compile_node(router_compiler, nidb_node)
+        node_data.append(router_compiler.nidb._graph.node[nidb_node.node_id])
+
+    data = StringIO()
+    pickler = cPickle.Pickler(data, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = _persistent_id(router_compiler.anm,
+            router_compiler.nidb)
+    pickler.dump((node_data, profiler.records))
+    return data.getvalue()
+
+def compile_nodes(router_compiler, nidb_nodes, jobs=1, cache=None):
+    """Compiles nidb_nodes with router_compiler, using up to jobs worker
+    processes. Results are the same as compiling in order.
+    If cache is set, nodes with unchanged compile inputs are restored
+    from it instead of compiled."""
+    nidb_nodes = list(nidb_nodes)
+    if cache is None:
+        _compile_nodes_parallel(router_compiler, nidb_nodes, jobs)
+        return
+
+    # keys from inputs before compile
+    keys = [(nidb_node, cache.key(router_compiler, nidb_node))
+            for nidb_node in nidb_nodes]
+    misses = [nidb_node for nidb_node, key in keys
+            if not cache.restore(nidb_node, key)]
+    _compile_nodes_parallel(router_compiler, misses, jobs)
+    for nidb_node, key in keys:
+        cache.record(nidb_node, key)
+
+def _compile_nodes_parallel(router_compiler, nidb_nodes, jobs):
+    global _worker_compiler, _worker_nodes
+    if jobs > 1 and not hasattr(os, "fork"):
+        log.info("Parallel compile requires fork, compiling sequentially")
+        jobs = 1
+    if jobs < 2 or len(nidb_nodes) < 2:
+        for nidb_node in nidb_nodes:
+            compile_node(router_compiler, nidb_node)
+        return
+
+    # interleaved chunks, a few per worker to balance load
+    chunk_count = min(len(nidb_nodes), jobs * 4)
+    chunks = [range(len(nidb_nodes))[i::chunk_count]
+            for i in range(chunk_count)]
+
+    _worker_compiler = router_compiler
+    _worker_nodes = nidb_nodes
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_compile_nodes, chunks)
+    finally:
+        pool.close()
+        pool.join()
+        _worker_compiler = _worker_nodes = None
+
+    anm = router_compiler.anm
+    nidb = router_compiler.nidb
+    graph = nidb._graph
+    for chunk, result in zip(chunks, results):
+        unpickler = cPickle.Unpickler(StringIO(result))
+        unpickler.persistent_load = lambda persistent_id: {"anm": anm,
+                "nidb": nidb}[persistent_id]
+        node_data, records = unpickler.load()
+        profiler.records.extend(records)
+        for index, data in zip(chunk, node_data):
+            graph.node[nidb_nodes[index].node_id] = data
+
 # Platform compilers
 
 class PlatformCompiler(object):
     """Base Platform Compiler"""
 # and set properties in nidb._graph.graph
-    def __init__(self, nidb, anm, host):
+    def __init__(self, nidb, anm, host, compile_jobs = 1,
+            compile_cache = None):
         self.nidb = nidb
         self.anm = anm
         self.host = host
+        self.compile_jobs = compile_jobs
+        self.compile_cache = compile_cache
 
     @property
     def timestamp(self):
         return self.nidb.timestamp
 
+    def compile_nodes(self, router_compiler, nidb_nodes):
+        """Compiles nidb_nodes, in up to compile_jobs processes,
+        reusing data from compile_cache if set"""
+        compile_nodes(router_compiler, nidb_nodes, self.compile_jobs,
+                self.compile_cache)
+
     def compile(self):
         # TODO: make this abstract
         pass
@@ -608,6 +794,7 @@ class JunosphereCompiler(PlatformCompiler):
         log.info("Compiling Junosphere for %s" % self.host)
         g_phy = self.anm['phy']
         junos_compiler = JunosCompiler(self.nidb, self.anm)
+        nidb_nodes = []
         for phy_node in g_phy.nodes('is_router', host=self.host, syntax='junos'):
             nidb_node = self.nidb.node(phy_node)
             nidb_node.render.template = "templates/junos.mako"
@@ -621,13 +808,17 @@ class JunosphereCompiler(PlatformCompiler):
                 interface.unit = 0
                 interface.id = int_ids.next()
 
-            junos_compiler.compile(nidb_node)
+            nidb_nodes.append(nidb_node)
+
+        self.compile_nodes(junos_compiler, nidb_nodes)
 
 
 class NetkitCompiler(PlatformCompiler):
     """Netkit Platform Compiler"""
-    def __init__(self, nidb, anm, host, ssh_pub_key = None):
-        super(NetkitCompiler, self).__init__(nidb, anm, host)
+    def __init__(self, nidb, anm, host, ssh_pub_key = None, compile_jobs = 1,
+            compile_cache = None):
+        super(NetkitCompiler, self).__init__(nidb, anm, host, compile_jobs,
+                compile_cache)
         self.ssh_pub_key = ssh_pub_key
 
     @staticmethod
@@ -638,6 +829,7 @@ class NetkitCompiler(PlatformCompiler):
         log.info("Compiling Netkit for %s" % self.host)
         g_phy = self.anm['phy']
         quagga_compiler = QuaggaCompiler(self.nidb, self.anm)
+        nidb_nodes = []
 # TODO: this should be all l3 devices not just routers
         for phy_node in g_phy.nodes('is_router', syntax='quagga'):
             folder_name = naming.network_hostname(phy_node)
@@ -666,9 +858,11 @@ class NetkitCompiler(PlatformCompiler):
 
 # and allocate tap interface
             nidb_node.tap.id = self.index_to_int_id(int_ids.next())
+            nidb_nodes.append(nidb_node)
 
-            quagga_compiler.compile(nidb_node)
+        self.compile_nodes(quagga_compiler, nidb_nodes)
 
+        for nidb_node in nidb_nodes:
             # TODO: move these into inherited BGP config
             nidb_node.bgp.debug = True
             static_routes = []
@@ -817,6 +1011,7 @@ class CiscoCompiler(PlatformCompiler):
                 if interface != nidb_node.loopback_zero:
                     interface.id = loopback_ids.next()
 
+        nidb_nodes = []
         for phy_node in g_phy.nodes('is_router', host=self.host, syntax='ios'):
             nidb_node = self.nidb.node(phy_node)
             nidb_node.render.template = "templates/ios.mako"
@@ -837,9 +1032,12 @@ class CiscoCompiler(PlatformCompiler):
                 else:
                     interface.id = int_ids.next()
 
-            ios_compiler.compile(nidb_node)
+            nidb_nodes.append(nidb_node)
+
+        self.compile_nodes(ios_compiler, nidb_nodes)
 
         ios2_compiler = Ios2Compiler(self.nidb, self.anm)
+        nidb_nodes = []
         for phy_node in g_phy.nodes('is_router', host=self.host, syntax='ios2'):
             nidb_node = self.nidb.node(phy_node)
             nidb_node.render.template = "templates/ios2/router.conf.mako"
@@ -859,9 +1057,12 @@ class CiscoCompiler(PlatformCompiler):
                 else:
                     interface.id = int_ids.next()
 
-            ios2_compiler.compile(nidb_node)
+            nidb_nodes.append(nidb_node)
+
+        self.compile_nodes(ios2_compiler, nidb_nodes)
 
         nxos_compiler = NxOsCompiler(self.nidb, self.anm)
+        nidb_nodes = []
         for phy_node in g_phy.nodes('is_router', host=self.host, syntax='nx_os'):
             nidb_node = self.nidb.node(phy_node)
             nidb_node.render.template = "templates/nx_os.mako"
@@ -881,7 +1082,9 @@ class CiscoCompiler(PlatformCompiler):
                 else:
                     interface.id = int_ids.next()
 
-            nxos_compiler.compile(nidb_node)
+            nidb_nodes.append(nidb_node)
+
+        self.compile_nodes(nxos_compiler, nidb_nodes)
 
         other_nodes = [phy_node for phy_node in g_phy.nodes('is_router', host=self.host)
                        if phy_node.syntax not in ("ios", "ios2")]
@@ -917,6 +1120,7 @@ class DynagenCompiler(PlatformCompiler):
         g_phy = self.anm['phy']
         G_graphics = self.anm['graphics']
         ios_compiler = IosClassicCompiler(self.nidb, self.anm)
+        nidb_nodes = []
         for phy_node in g_phy.nodes('is_router', host=self.host, syntax='ios'):
             nidb_node = self.nidb.node(phy_node)
             graphics_node = G_graphics.node(phy_node)
@@ -937,8 +1141,9 @@ class DynagenCompiler(PlatformCompiler):
             for interface in nidb_node.physical_interfaces:
                 interface.id = int_ids.next()
 
-            ios_compiler.compile(nidb_node)
+            nidb_nodes.append(nidb_node)
 
+        self.compile_nodes(ios_compiler, nidb_nodes)
         self.allocate_ports()
         self.lab_topology()
 
@@ -9,11 +9,14 @@ import os
 import shutil
 import time
 import autonetkit.compiler as compiler
+import autonetkit.compile_cache as compile_cache
 import pkg_resources
 import autonetkit.log as log
 import autonetkit.ank_messaging as ank_messaging
 import autonetkit.config as config
 import autonetkit.ank_json as ank_json
+import autonetkit.incremental as incremental
+import autonetkit.profiler as profiler
 
 # import autonetkit.bgp_pol as bgp_pol
 # raise SystemExit
@@ -42,8 +45,16 @@ def file_monitor(filename):
         yield False
 
 
-def manage_network(input_graph_string, timestamp, hosts, build_options, reload_build=False, grid = None, ssh_pub_key = None):
-    """Build, compile, render network as appropriate"""
+def manage_network(input_graph_string, timestamp, hosts, build_options, reload_build=False, grid = None, ssh_pub_key = None, previous = None):
+    """Build, compile, render network as appropriate
+
+    previous is the state returned by the last call, used in monitor mode:
+    unchanged input is skipped, position-only changes are republished without
+    rebuilding (unless positions are rendered, eg dynagen), and only nodes
+    whose compiled data changed are re-rendered. Build and IP allocation are
+    global, so always rerun; monitor mode always uses the compile cache, to
+    recompile only nodes whose compile inputs changed.
+    Returns state for the next call."""
     # import build_network_simple as build_network
     import autonetkit.build_network as build_network
     if reload_build:
@@ -51,6 +62,7 @@ def manage_network(input_graph_string, timestamp, hosts, build_options, reload_b
         build_network = reload(build_network)
 
     messaging = ank_messaging.AnkMessaging()
+    state = {}
 
     if build_options['build']:
         if input_graph_string:
@@ -58,7 +70,36 @@ def manage_network(input_graph_string, timestamp, hosts, build_options, reload_b
         elif grid:
             graph = build_network.grid_2d(grid)
 
-        anm = build_network.build(graph)
+        if previous and not reload_build:
+            change = incremental.input_change(previous['graph'], graph)
+            if change == incremental.NO_CHANGE:
+                log.info("No changes to input graph")
+                return previous
+            if (change == incremental.GRAPHICS_CHANGE
+                    and incremental.renders_graphics(previous.get('nidb'))):
+                log.info("Only node positions changed, but are rendered: "
+                        "recompiling")
+            elif change == incremental.GRAPHICS_CHANGE:
+                log.info("Only node positions changed, updating graphics")
+                incremental.update_graphics(previous['anm'],
+                        previous.get('nidb'), graph)
+                body = ank_json.dumps(previous['anm'], previous.get('nidb'))
+                messaging.publish_compressed("www", "client", body)
+                previous['graph'] = graph
+                return previous
+
+        if build_options.get('profile'):
+            profiler.reset()
+            profiler.enable()
+
+        state['graph'] = graph.copy() # build modifies input graph
+        with profiler.phase("total", "build", count_objects=True):
+            anm = build_network.build(graph,
+                    build_jobs = build_options.get('build_jobs', 1),
+                    stable_ips = build_options.get('stable_ips', False),
+                    ip_headroom = build_options.get('ip_headroom', 0),
+                    columnar = build_options.get('columnar', False))
+        state['anm'] = anm
         if not build_options['compile']:
             # publish without nidb
             body = ank_json.dumps(anm)
@@ -71,15 +112,49 @@ def manage_network(input_graph_string, timestamp, hosts, build_options, reload_b
     if build_options['compile']:
         if build_options['archive']:
             anm.save()
-        nidb = compile_network(anm, hosts, ssh_pub_key = ssh_pub_key)
+        # only render changed nodes if have previous render to compare to
+        render_changed = (build_options['render'] and previous
+                and previous.get('digests') is not None)
+        cache = None
+        if build_options.get('compile_cache'):
+            cache = compile_cache.load_cache(anm,
+                    previous.get('nidb') if previous else None)
+        elif build_options.get('monitor'):
+            # only from previous run, not from archive
+            cache = compile_cache.CompileCache(anm,
+                    previous.get('nidb') if previous else None)
+        with profiler.phase("total", "compile", count_objects=True):
+            nidb = compile_network(anm, hosts, ssh_pub_key = ssh_pub_key,
+                    clean = not render_changed,
+                    compile_jobs = build_options.get('compile_jobs', 1),
+                    compile_cache = cache)
+        if cache:
+            log.info("Compile cache: %s hits, %s misses" % (cache.hits,
+                cache.misses))
+        state['nidb'] = nidb
         body = ank_json.dumps(anm, nidb)
         messaging.publish_compressed("www", "client", body)
         log.debug("Sent ANM to web server")
         if build_options['archive']:
             nidb.save()
+            if cache:
+                compile_cache.save(nidb)
         # render.remove_dirs(["rendered"])
         if build_options['render']:
-            render.render(nidb)
+            digests = incremental.node_digests(nidb)
+            with profiler.phase("total", "render", count_objects=True):
+                if render_changed:
+                    changed, removed = incremental.changed_nodes(
+                            previous['digests'], digests)
+                    incremental.remove_rendered(previous['nidb'], removed)
+                    render.render(nidb, changed,
+                            jobs = build_options.get('render_jobs', 1),
+                            link_skeleton = build_options.get('link_skeleton'))
+                else:
+                    render.render(nidb,
+                            jobs = build_options.get('render_jobs', 1),
+                            link_skeleton = build_options.get('link_skeleton'))
+            state['digests'] = digests
 
     if not(build_options['build'] or build_options['compile']):
         # Load from last run
@@ -111,7 +186,13 @@ def manage_network(input_graph_string, timestamp, hosts, build_options, reload_b
     if build_options['measure']:
         measure_network(nidb)
 
+    if profiler.enabled:
+        profiler.log_summary()
+        profiler.write_report()
+        profiler.disable()
+
     log.info("Finished")
+    return state
 
 
 def parse_options():
@@ -152,6 +233,25 @@ def parse_options():
     parser.add_argument('--webserver', action="store_true", 
                         default=False, help="Webserver")
     parser.add_argument('--grid', type=int, help="Webserver")
+    parser.add_argument('--profile', action="store_true", default=False,
+                        help="Time build, compile and render phases, write to profile.json")
+    parser.add_argument('--build-jobs', type=int, default=1,
+                        help="Number of processes to build independent overlays in")
+    parser.add_argument('--compile-jobs', type=int, default=1,
+                        help="Number of processes to compile nodes in")
+    parser.add_argument('--compile-cache', action="store_true", default=False,
+                        help="Reuse compiled data of unchanged nodes from previous NIDB"
+                        " (always on in monitor mode)")
+    parser.add_argument('--render-jobs', type=int,
+                        help="Number of processes to render nodes in, 0 for one per CPU")
+    parser.add_argument('--link-skeleton', action="store_true", default=False,
+                        help="Hardlink static files into rendered folders rather than copying")
+    parser.add_argument('--stable-ips', action="store_true", default=False,
+                        help="Keep IPv4 allocations from previous build, in versions/ip")
+    parser.add_argument('--ip-headroom', type=int,
+                        help="Percent spare addresses in IPv4 loopback blocks and subnets (not applied to IPv6)")
+    parser.add_argument('--columnar', action="store_true", default=False,
+                        help="Store node attributes in numpy arrays (requires numpy)")
     arguments = parser.parse_args()
     return arguments
 
@@ -179,6 +279,19 @@ def main():
         'monitor': options.monitor or settings['General']['monitor'],
         'diff': options.diff or settings['General']['diff'],
         'archive': options.archive or settings['General']['archive'],
+        'build_jobs': options.build_jobs,
+        'compile_jobs': options.compile_jobs,
+        'compile_cache': (options.compile_cache
+            or settings['General']['compile_cache']),
+        'render_jobs': (options.render_jobs if options.render_jobs is not None
+            else settings['General']['render_jobs']),
+        'link_skeleton': (options.link_skeleton
+            or settings['General']['link_skeleton']),
+        'profile': options.profile or settings['General']['profile'],
+        'stable_ips': options.stable_ips or settings['General']['stable_ips'],
+        'ip_headroom': (options.ip_headroom if options.ip_headroom is not None
+            else settings['General']['ip_headroom']),
+        'columnar': options.columnar or settings['General']['columnar'],
     }
 
 
@@ -227,7 +340,7 @@ def main():
 
     hosts = options.hosts.lower().split(",")
 
-    manage_network(input_string, timestamp, hosts, build_options=build_options, grid = options.grid, ssh_pub_key = ssh_pub )
+    state = manage_network(input_string, timestamp, hosts, build_options=build_options, grid = options.grid, ssh_pub_key = ssh_pub )
 
 
 # TODO: work out why build_options is being clobbered for monitor mode
@@ -255,8 +368,9 @@ def main():
                         log.info("Input graph updated, recompiling network")
                         with open(options.file, "r") as fh:
                             input_string = fh.read()  # read updates
-                        manage_network(input_string,
-                                       timestamp, hosts, build_options, reload_build)
+                        state = manage_network(input_string,
+                                       timestamp, hosts, build_options, reload_build,
+                                       previous = state)
                         log.info("Monitoring for updates...")
                     except Exception, e:
                         log.warning("Unable to build network %s" %e)
@@ -267,7 +381,12 @@ def main():
             log.info("Exiting")
 
 
-def compile_network(anm, hosts, ssh_pub_key = None ):
+def compile_network(anm, hosts, ssh_pub_key = None, clean = True, compile_jobs = 1,
+        compile_cache = None):
+    """Compiles anm into nidb for hosts.
+    If clean is set, removes previously rendered output for each host.
+    Nodes are compiled in up to compile_jobs processes, unless unchanged
+    in compile_cache"""
     nidb = NIDB()
     g_phy = anm['phy']
     g_ip = anm['ip']
@@ -301,18 +420,26 @@ def compile_network(anm, hosts, ssh_pub_key = None ):
         except KeyError:
             log.warning("no platform defined for %s" % target)
             continue
-        shutil.rmtree(os.path.join("rendered", "%s_%s" % (target, platform)), ignore_errors=True)
+        if clean:
+            shutil.rmtree(os.path.join("rendered", "%s_%s" % (target, platform)), ignore_errors=True)
 
         if platform == "netkit":
-            platform_compiler = compiler.NetkitCompiler(nidb, anm, target, ssh_pub_key = ssh_pub_key)
+            platform_compiler = compiler.NetkitCompiler(nidb, anm, target,
+                    ssh_pub_key = ssh_pub_key, compile_jobs = compile_jobs,
+                    compile_cache = compile_cache)
         elif platform == "cisco":
-            platform_compiler = compiler.CiscoCompiler(nidb, anm, target)
+            platform_compiler = compiler.CiscoCompiler(nidb, anm, target,
+                    compile_jobs = compile_jobs, compile_cache = compile_cache)
         elif platform == "dynagen":
-            platform_compiler = compiler.DynagenCompiler(nidb, anm, target)
+            platform_compiler = compiler.DynagenCompiler(nidb, anm, target,
+                    compile_jobs = compile_jobs, compile_cache = compile_cache)
         elif platform == "junosphere":
-            platform_compiler = compiler.JunosphereCompiler(nidb, anm, target)
+            platform_compiler = compiler.JunosphereCompiler(nidb, anm, target,
+                    compile_jobs = compile_jobs, compile_cache = compile_cache)
 
-        platform_compiler.compile()
+        with profiler.phase("compile", "%s_%s" % (target, platform),
+                count_objects=True):
+            platform_compiler.compile()
         #if any(g_phy.nodes(host=target, platform=platform)): # this is really problematic
         #    log.info("Compile for %s on %s" % (platform, target))
         #    platform_compiler.compile()  # only compile if host set
@@ -81,14 +81,14 @@ def compare(graph_a, graph_b):
     nodes_b = set(graph_b.nodes())
     common_nodes = nodes_a & nodes_b
     added_nodes = nodes_b - nodes_a
+    diff['nodes'] = {
+            'm': {},
+            }
     if added_nodes:
         diff['nodes']['a'] = list(added_nodes)
     removed_nodes = nodes_a - nodes_b
     if removed_nodes:
         diff['nodes']['r'] = list(removed_nodes)
-    diff['nodes'] = {
-            'm': {},
-            }
 
     for node in common_nodes:
         dict_a = graph_a.node[node]
@@ -108,16 +108,15 @@ def compare(graph_a, graph_b):
     edges_a = set(graph_a.edges())
     edges_b = set(graph_b.edges())
     added_edges = edges_b - edges_a
+    diff['edges'] = {
+            'm': {},
+            }
     if added_edges:
         diff['edges']['a'] = list(added_edges)
     removed_edges = edges_a - edges_b
     if removed_edges:
         diff['edges']['r'] = list(removed_edges)
 
-    diff['edges'] = {
-            'm': {},
-            }
-
     common_edges = edges_a & edges_b
     for (src, dst) in common_edges:
         dictA = graph_a[src][dst]
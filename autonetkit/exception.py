@@ -7,3 +7,9 @@ class AnkException(Exception):
 class AnkIncorrectFileFormat(AnkException):
     """Wrong file format"""
 
+
+class AnkAllocationConflict(AnkException):
+    """Previous allocation can't be kept"""
+
+class AnkRenderError(AnkException):
+    """Nodes failed to render"""
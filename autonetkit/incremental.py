@@ -0,0 +1,101 @@
+"""Change-driven rebuilds for monitor mode
+
+Compares successive input graphs and compiled NIDBs, so that unchanged
+input is skipped, layout-only changes are republished without a rebuild
+(unless a platform renders node positions), and only devices whose compiled
+data changed are re-rendered. Build and IP allocation always run over the
+whole network; compile reuses unchanged nodes from the compile cache.
+"""
+
+import os
+import shutil
+import hashlib
+import json
+import autonetkit.log as log
+import autonetkit.ank_json as ank_json
+import autonetkit.diff as diff
+
+GRAPHICS_ATTRS = set(['x', 'y'])
+# platforms whose compiled output includes node positions, eg dynagen .net
+GRAPHICS_PLATFORMS = set(['dynagen'])
+
+NO_CHANGE = "none"
+GRAPHICS_CHANGE = "graphics"
+TOPOLOGY_CHANGE = "topology"
+
+def input_change(graph_a, graph_b):
+    """Classifies changes between two input graphs:
+    NO_CHANGE, GRAPHICS_CHANGE (only node x/y moved) or TOPOLOGY_CHANGE"""
+    graph_diff = diff.compare(graph_a, graph_b)
+    if graph_diff.get('graph') or 'edges' in graph_diff:
+        return TOPOLOGY_CHANGE
+
+    node_diff = graph_diff.get('nodes')
+    if not node_diff:
+        return NO_CHANGE
+    if 'a' in node_diff or 'r' in node_diff:
+        return TOPOLOGY_CHANGE
+
+    for changes in node_diff.get('m', {}).values():
+        if set(changes.keys()) - GRAPHICS_ATTRS:
+            return TOPOLOGY_CHANGE # attributes added/removed, or non-graphics
+
+    return GRAPHICS_CHANGE
+
+def update_graphics(anm, nidb, graph):
+    """Copies input node positions into the graphics overlay and nidb"""
+    g_graphics = anm['graphics']
+    for key in GRAPHICS_ATTRS:
+        values = dict((node, data[key]) for node, data in graph.nodes(data=True)
+                if key in data and node in g_graphics._graph)
+        g_graphics.set_node_attr(key, values)
+    if nidb:
+        nidb.copy_graphics(g_graphics)
+
+def renders_graphics(nidb):
+    """Returns if any node in nidb is compiled for a platform that renders
+    node positions, so a GRAPHICS_CHANGE needs a recompile"""
+    if not nidb:
+        return False
+    return any(data.get('platform') in GRAPHICS_PLATFORMS
+            for node, data in nidb._graph.nodes(data=True))
+
+def node_digests(nidb):
+    """Returns {node_id: digest} of compiled data of each nidb node,
+    including its edges, to detect which nodes need re-rendering"""
+    graph = nidb._graph
+    digests = {}
+    for node_id, data in graph.nodes(data=True):
+        edges = sorted((str(neigh), edge_data) for neigh, edge_data
+                in graph[node_id].items())
+        dumped = json.dumps([data, edges], cls=ank_json.AnkEncoder,
+                sort_keys=True)
+        digests[node_id] = hashlib.md5(dumped).hexdigest()
+    return digests
+
+def changed_nodes(digests_a, digests_b):
+    """Returns (set of changed or added node ids, set of removed node ids)"""
+    changed = set(node_id for node_id, digest in digests_b.items()
+            if digests_a.get(node_id) != digest)
+    removed = set(digests_a) - set(digests_b)
+    return changed, removed
+
+def remove_rendered(nidb, node_ids):
+    """Removes rendered output of node_ids in (previous) nidb"""
+    for node in nidb:
+        if node.node_id not in node_ids:
+            continue
+        log.debug("Removing rendered output for %s" % node)
+        try:
+            base_dst_folder = node.render.base_dst_folder
+            dst_folder = node.render.dst_folder
+            dst_file = node.render.dst_file
+        except KeyError:
+            continue # not rendered
+        if base_dst_folder:
+            shutil.rmtree(base_dst_folder, ignore_errors=True)
+        if dst_folder and dst_file:
+            try:
+                os.remove(os.path.join(dst_folder, dst_file))
+            except OSError:
+                pass # not rendered
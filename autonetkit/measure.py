@@ -40,6 +40,10 @@ def send(nidb, command, hosts, server = "measure_client", threads = 3):
 
     hosts_received = set(hosts)
 
+    # built once, rather than scanning nidb per hop
+    index = process_data.address_index(nidb)
+    tap_index = process_data.tap_index(nidb)
+
     # parsing function mappings
     parsing = {
             'vtysh -c "show ip route"': process_data.sh_ip_route,
@@ -58,12 +62,14 @@ def send(nidb, command, hosts, server = "measure_client", threads = 3):
                     parse_command(nidb, command_result)
                 elif "traceroute" in command:
                     dst = command.split()[-1]   # last argument is the dst ip
-                    src_host = process_data.reverse_tap_lookup(nidb, host)
-                    dst_host = process_data.reverse_lookup(nidb, dst)
+                    src_host = process_data.reverse_tap_lookup(nidb, host,
+                            tap_index)
+                    dst_host = process_data.reverse_lookup(nidb, dst, index)
                     log.info("Trace from %s to %s" % (src_host, dst_host[1]))
                     parse_command = parsing["traceroute"]
                     log.info(command_result)
-                    trace_result = parse_command(nidb, command_result)
+                    trace_result = parse_command(nidb, command_result,
+                            index = index)
                     trace_result.insert(0, src_host) 
                     log.info(trace_result)
                     if str(trace_result[-1]) == str(dst_host[1]): #TODO: fix so direct comparison, not string, either here or in anm object comparison: eg compare on label?
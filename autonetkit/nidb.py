@@ -5,6 +5,7 @@ import time
 import autonetkit.log as log
 import ank_json
 import functools
+from autonetkit.ank_utils import LabelIndex, InterfaceEdgeIndex
 import string
 
 try:
@@ -254,10 +255,10 @@ class overlay_interface(object):
         """Returns all edges from node that have this interface ID
         This is the convention for binding an edge to an interface"""
         # edges have _interfaces stored as a dict of {node_id: interface_id, }
-        valid_edges = [e for e in self.node.edges()
-                if self.node_id in e._interfaces
-                and e._interfaces[self.node_id] == self.interface_id]
-        return valid_edges
+        dst_ids = self.nidb._interface_edge_index.lookup(self._graph,
+                self.node_id, self.interface_id)
+        return [overlay_edge(self.nidb, self.node_id, dst_id)
+                for dst_id in dst_ids]
 
 class overlay_edge_accessor(object):
 #TODO: do we even need this?
@@ -345,6 +346,8 @@ class overlay_edge(object):
     def __setattr__(self, key, val):
         """Sets edge property"""
         self._graph[self.src_id][self.dst_id][key] = val
+        if key == "_interfaces":
+            self.nidb._interface_edge_index.invalidate()
 
 class overlay_node_accessor(object):
 #TODO: do we even need this?
@@ -650,6 +653,8 @@ class nidb_node(object):
     def __setattr__(self, key, val):
         """Sets edge property"""
         self._node_data[key] = val
+        if key == "label":
+            self.nidb._label_index.invalidate()
         #return nidb_node_category(self.nidb, self.node_id, key)
 
     def __iter__(self):
@@ -736,6 +741,24 @@ class NIDB_base(object):
     def __repr__(self):
         return "nidb"
 
+    @property
+    def _label_index(self):
+        """Label lookup table, created on first use"""
+        try:
+            return self._labels
+        except AttributeError:
+            self._labels = LabelIndex()
+            return self._labels
+
+    @property
+    def _interface_edge_index(self):
+        """(node_id, interface_id) -> edge lookup table, created on first use"""
+        try:
+            return self._interface_edges
+        except AttributeError:
+            self._interface_edges = InterfaceEdgeIndex()
+            return self._interface_edges
+
     def dump(self):
         #TODO: adapt the json version?
         return "%s %s %s" % (
@@ -792,6 +815,8 @@ class NIDB_base(object):
             #data = json.load(fh)
             data = fh.read()
             self._graph = ank_json.ank_json_loads(data)
+        self._label_index.invalidate()
+        self._interface_edge_index.invalidate()
 
 
     @property
@@ -835,17 +860,16 @@ class NIDB_base(object):
 
     def node(self, key):
         """Returns node based on name
-        This is currently O(N). Could use a lookup table"""
-#TODO: check if node.node_id in graph, if so return wrapped node for this...
-# returns node based on name
+        Label lookups use the label index"""
         try:
             if key.node_id in self._graph:
                 return nidb_node(self, key.node_id)
         except AttributeError:
             # doesn't have node_id, likely a label string, search based on this label
-            for node in self:
-                if str(node) == key:
-                    return node
+            node = self._label_index.lookup(key, self.__iter__,
+                    len(self._graph))
+            if node is not None:
+                return node
             print "Unable to find node", key, "in", self
             return None
 
@@ -915,6 +939,7 @@ class NIDB_base(object):
         else:
             log.warning("Cannot add node ids directly to NIDB: must add overlay nodes")
         self._graph.add_nodes_from(nbunch, **kwargs)
+        self._label_index.invalidate()
 
         for node in nodes_to_add:
             #TODO: add an interface_retain for attributes also
@@ -953,6 +978,7 @@ class NIDB_base(object):
         for edge in edges_to_add:
             # copy across interface bindings
             self._graph[edge.src.node_id][edge.dst.node_id]['_interfaces'] = edge._interfaces
+        self._interface_edge_index.invalidate()
 
     def __iter__(self):
         return iter(nidb_node(self, node)
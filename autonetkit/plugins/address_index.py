@@ -0,0 +1,119 @@
+"""Radix trie of IP addresses and subnets
+
+Supports exact match of an address or subnet, and longest prefix match of
+an address, in O(address length), for IPv4 and IPv6.
+
+>>> index = AddressIndex()
+>>> index.add("10.0.0.0/30", "cd1")
+>>> index.add("10.0.0.1", "r1 eth0")
+>>> index.get("10.0.0.1"), index.longest_match("10.0.0.2")
+('r1 eth0', 'cd1')
+"""
+
+import netaddr
+
+class _TrieNode(object):
+    __slots__ = ('value', 'prefixlen', 'children', 'data', 'has_data')
+    def __init__(self, value, prefixlen):
+        self.value = value
+        self.prefixlen = prefixlen
+        self.children = [None, None]
+        self.data = None
+        self.has_data = False
+
+def parse(address):
+    """Returns (integer, prefixlen, bits) of address or subnet,
+    as netaddr object or string"""
+    if not isinstance(address, (netaddr.IPAddress, netaddr.IPNetwork)):
+        address = str(address)
+        if "/" in address:
+            address = netaddr.IPNetwork(address)
+        else:
+            address = netaddr.IPAddress(address)
+    bits = 32 if address.version == 4 else 128
+    if isinstance(address, netaddr.IPNetwork):
+        return address.first, address.prefixlen, bits
+    return int(address), bits, bits
+
+class AddressIndex(object):
+    """Maps addresses and subnets to data, in a path compressed
+    binary trie per address length"""
+    def __init__(self):
+        self._roots = {32: _TrieNode(0, 0), 128: _TrieNode(0, 0)}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _bit(self, value, position, bits):
+        return value >> (bits - position - 1) & 1
+
+    def _matches(self, node, value, bits):
+        """If value is in node's prefix"""
+        shift = bits - node.prefixlen
+        return value >> shift == node.value >> shift
+
+    def add(self, address, data, replace = False):
+        """Adds address (or subnet) with data,
+        keeping data of an existing entry unless replace"""
+        value, prefixlen, bits = parse(address)
+        value = value >> (bits - prefixlen) << (bits - prefixlen)
+        node = self._roots[bits]
+        while node.prefixlen < prefixlen:
+            bit = self._bit(value, node.prefixlen, bits)
+            child = node.children[bit]
+            if child is None:
+                child = node.children[bit] = _TrieNode(value, prefixlen)
+                node = child
+                break
+
+            # length of common prefix of value and child
+            common = min(prefixlen, child.prefixlen,
+                    bits - (value ^ child.value).bit_length())
+            if common == child.prefixlen:
+                node = child
+                continue
+
+            parent = _TrieNode(value >> (bits - common) << (bits - common),
+                    common)
+            parent.children[self._bit(child.value, common, bits)] = child
+            node.children[bit] = parent
+            node = parent
+            if common < prefixlen:
+                leaf = _TrieNode(value, prefixlen)
+                parent.children[self._bit(value, common, bits)] = leaf
+                node = leaf
+            break
+
+        if node.has_data and not replace:
+            return
+        if not node.has_data:
+            self._len += 1
+        node.data = data
+        node.has_data = True
+
+    def get(self, address, default = None):
+        """Returns data of exact match of address (or subnet)"""
+        value, prefixlen, bits = parse(address)
+        node = self._roots[bits]
+        while node is not None and node.prefixlen < prefixlen:
+            node = node.children[self._bit(value, node.prefixlen, bits)]
+        if (node is not None and node.prefixlen == prefixlen
+                and node.has_data and self._matches(node, value, bits)):
+            return node.data
+        return default
+
+    def longest_match(self, address, default = None):
+        """Returns data of the longest prefix (or address) containing address"""
+        value, prefixlen, bits = parse(address)
+        node = self._roots[bits]
+        retval = default
+        while node is not None and node.prefixlen <= prefixlen:
+            if not self._matches(node, value, bits):
+                break
+            if node.has_data:
+                retval = node.data
+            if node.prefixlen == bits:
+                break
+            node = node.children[self._bit(value, node.prefixlen, bits)]
+        return retval
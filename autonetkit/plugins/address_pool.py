@@ -0,0 +1,99 @@
+"""Buddy allocator of address blocks, for IPv4 and IPv6
+
+Blocks are integer (first address, prefixlen) pairs. Free blocks are kept as
+a bitmap per prefixlen, bit n set if the nth block of that length is free.
+Allocation is best fit: the lowest of the smallest free blocks that fit,
+split if larger. This isn't always the lowest free address: a larger free
+block may sit below it. Above the highest address allocated there is at
+most one free block per prefixlen (the buddy of the block containing it),
+so bitmaps grow with that address rather than with the pool size, even in
+a large IPv6 pool.
+
+>>> pool = AddressPool(int(netaddr.IPAddress("10.0.0.0")), 16)
+>>> pool.allocate_subnet(30)
+IPNetwork('10.0.0.0/30')
+"""
+
+import math
+import netaddr
+import autonetkit.exception
+
+def with_headroom(count, headroom):
+    """Returns count increased by headroom percent"""
+    return int(math.ceil(count * (100 + headroom) / 100.0))
+
+class AddressPool(object):
+    """Allocates and reserves blocks within first/prefixlen, each in
+    O(prefixlen) bitmap operations"""
+    def __init__(self, first, prefixlen, version = 4):
+        self.version = version
+        self.bits = 32 if version == 4 else 128
+        self.prefixlen = prefixlen
+        self.first = first - first % 2 ** (self.bits - prefixlen)
+        self.free_blocks = {prefixlen: 1} # {prefixlen: bitmap}
+
+    def __repr__(self):
+        return "AddressPool %s" % self.network()
+
+    def network(self):
+        return netaddr.IPNetwork((self.first, self.prefixlen),
+                version = self.version)
+
+    def _index(self, value, prefixlen):
+        return (value - self.first) >> (self.bits - prefixlen)
+
+    def _is_free(self, prefixlen, index):
+        return self.free_blocks.get(prefixlen, 0) >> index & 1
+
+    def _put(self, prefixlen, index):
+        self.free_blocks[prefixlen] = self.free_blocks.get(prefixlen, 0) | 1 << index
+
+    def _take(self, prefixlen, index):
+        self.free_blocks[prefixlen] ^= 1 << index
+
+    def _check(self, value, prefixlen):
+        size = 2 ** (self.bits - prefixlen)
+        if not (self.prefixlen <= prefixlen <= self.bits and value % size == 0
+                and 0 <= value - self.first < 2 ** (self.bits - self.prefixlen)):
+            raise autonetkit.exception.AnkAllocationConflict(
+                    "%s/%s not a block in %s" % (netaddr.IPAddress(value,
+                        self.version), prefixlen, self.network()))
+
+    def allocate(self, prefixlen):
+        """Returns first address of a free block of prefixlen, split from
+        the lowest of the smallest free blocks that fit it (best fit)"""
+        for level in range(prefixlen, self.prefixlen - 1, -1):
+            bitmap = self.free_blocks.get(level)
+            if not bitmap:
+                continue
+            index = (bitmap & -bitmap).bit_length() - 1
+            self._take(level, index)
+            while level < prefixlen: # split, freeing upper halves
+                level += 1
+                index <<= 1
+                self._put(level, index + 1)
+            return self.first + (index << (self.bits - prefixlen))
+
+        raise autonetkit.exception.AnkAllocationConflict(
+                "No free /%s in %s" % (prefixlen, self.network()))
+
+    def allocate_subnet(self, prefixlen):
+        return netaddr.IPNetwork((self.allocate(prefixlen), prefixlen),
+                version = self.version)
+
+    def reserve(self, value, prefixlen):
+        """Marks block at value as allocated, eg to keep a previous allocation"""
+        self._check(value, prefixlen)
+        index = self._index(value, prefixlen)
+        for level in range(prefixlen, self.prefixlen - 1, -1):
+            if self._is_free(level, index >> (prefixlen - level)):
+                break
+        else:
+            raise autonetkit.exception.AnkAllocationConflict(
+                    "%s/%s already allocated in %s" % (netaddr.IPAddress(value,
+                        self.version), prefixlen, self.network()))
+
+        self._take(level, index >> (prefixlen - level))
+        while level < prefixlen: # split, freeing halves not containing block
+            level += 1
+            self._put(level, index >> (prefixlen - level) ^ 1)
@@ -1,18 +1,18 @@
-import time
+import os
 import json
 import itertools
 import math
 import autonetkit.ank as ank_utils
 import autonetkit.log as log
+import autonetkit.anm
 import autonetkit.ank_json
-import networkx as nx
+import autonetkit.exception
 from collections import defaultdict
 import netaddr
-import functools
+from autonetkit.plugins.address_pool import AddressPool, with_headroom
 
 messaging = autonetkit.ank_messaging.AnkMessaging()
 
-#TODO: allow slack in allocations: both for ASN (group level), and for collision domains to allow new nodes to be easily added
 
 try:
     import cPickle as pickle
@@ -25,403 +25,497 @@ def subnet_size(host_count):
     host_count += 2 # network and broadcast
     return int(math.ceil(math.log(host_count, 2)))
 
-@functools.total_ordering
-class TreeNode(object):
-    def __init__(self, graph, node):
-        object.__setattr__(self, 'graph', graph)
-        object.__setattr__(self, 'node', node)
-
-#TODO: make thise fixed attributes, as only certain number needed here
-    def __getattr__(self, attr):
-        return self.graph.node[self.node].get(attr)
-
-    def __setattr__(self, key, val):
-        self.graph.node[self.node][key] = val
-
-    def __lt__(self, other):
-        if self.host and other.host:
-            return self.host < other.host
-        return self.node < other.node
-
-#TODO: restore function that truncated subnets
-
-    def __repr__(self):
-        if self.host:
-            return "%s %s" % (self.subnet, self.host)
-        if self.loopback_group:
-            return "Lo Gr %s: %s" % (self.group_attr, self.subnet)
-        if self.group_attr:
-            return "%s: %s" % (self.group_attr, self.subnet)
-        if self.subnet:
-            return "%s" % self.subnet
-        return "TreeNode: %s" % self.node 
-
-    def is_collision_domain(self):
-        return (self.host and self.host.collision_domain)
-
-    def is_loopback_group(self):
-        return self.loopback_group
-
-    def is_interface(self):
-        return isinstance(self.host, autonetkit.anm.overlay_interface)
-
-    def is_host(self):
-        return bool(self.host)
-
-    def children(self):
-        return [TreeNode(self.graph, child) for child in self.graph.successors(self.node)]
-
-class IpTree(object):
-    def __init__(self, root_ip_block):
+def host_key(item):
+    """Sort key of node or interface to allocate: node id, then interface
+    id"""
+    if isinstance(item, autonetkit.anm.overlay_interface):
+        return (item.node_id, item.interface_id)
+    return (item.node_id,)
+
+def parse_subnet(subnet):
+    """Returns (integer, prefixlen) of subnet string, prefixlen is None
+    for an address"""
+    if "/" in subnet:
+        subnet = netaddr.IPNetwork(subnet)
+        return int(subnet.network), subnet.prefixlen
+    return int(netaddr.IPAddress(subnet)), None
+
+def subnet_block(value, prefixlen):
+    """Returns (first integer, size) of subnet"""
+    size = 2 ** (32 - prefixlen)
+    return value - value % size, size
+
+def keep(pool, value, prefixlen):
+    """Reserves previous allocation in pool, returns False if not available"""
+    try:
+        pool.reserve(value, prefixlen)
+    except autonetkit.exception.AnkAllocationConflict:
+        return False
+    return True
+
+class FlatIpTree(object):
+    """Allocates subnets and addresses from a binary tree, using flat lists
+    indexed by tree node id, and integer subnets. Converts to netaddr only
+    on assignment.
+
+    Allocation order is deterministic: hosts of each group (eg asn) are
+    sorted by node id, then interface id, and the children of each tree
+    node are in tree node id order, the order they are added.
+    headroom is percent extra hosts to size loopback groups and
+    collision domains for, so they can grow without reallocating."""
+    def __init__(self, root_ip_block, headroom = 0):
         self.unallocated_nodes = []
-        self.graph = nx.DiGraph()
+        self.headroom = headroom
         self.root_node = None
-        self.timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-#taken_nodes -> these are nodes manually specified, eg in graphml
-        self.node_id_counter = (i for i in itertools.count(0) if i not in self.graph)
         self.root_ip_block = root_ip_block
+        self.prefixlen = [] # in tree, subnet of children is one longer
+        self.host = [] # allocated object, or None
+        self.loopback_group = []
+        self.collision_domain = []
+        self.group_attr = {} # {subtree root: group attribute value}
+        self.children = {} # {node: [child nodes]} in order added
+        self.value = [] # allocated address or subnet, as integer
+        self.subnet_prefixlen = [] # prefixlen of subnet, None if address
 
     def __len__(self):
-        return len(self.graph)
+        return len(self.prefixlen)
 
-    def __iter__(self):
-        return iter(TreeNode(self.graph, node) for node in self.graph)
+    def add_nodes(self, nodes):
+        self.unallocated_nodes += list(nodes)
+
+    def _add_node(self, prefixlen, host=None, loopback_group=False):
+        node = len(self.prefixlen)
+        self.prefixlen.append(prefixlen)
+        self.host.append(host)
+        self.loopback_group.append(loopback_group)
+        self.collision_domain.append(host and host.collision_domain)
+        self.value.append(None)
+        self.subnet_prefixlen.append(None)
+        return node
 
-    @property
-    def next_node_id(self):
-        return self.node_id_counter.next()
+    def _add_edge(self, node, child):
+        self.children.setdefault(node, []).append(child)
 
-    def add_parent_nodes(self, subgraph, level_counts):
+    def _nodes_by_level(self, nodes):
+        nodes_by_level = defaultdict(list)
+        for node in nodes:
+            nodes_by_level[self.prefixlen[node]].append(node)
+        return nodes_by_level
+
+    def _add_parent_nodes(self, nodes, level_counts):
+        """Adds parent nodes for each level to list nodes, up to a single
+        root"""
         for level in range(32, 0, -1):
-            try:
-                current_count = float(level_counts[level]) # float so do floating point division
-            except KeyError:
-                continue # key not present - likely higher up tree
+            # level_counts is a defaultdict: reading a level adds it
+            current_count = float(level_counts[level])
             parent_count = int(math.ceil(current_count/2))
             parent_level = level - 1
             level_counts[parent_level] += parent_count
-            subgraph.add_nodes_from((self.next_node_id, {'prefixlen': parent_level}) for n in range(parent_count))
+            for _ in range(parent_count):
+                nodes.append(self._add_node(parent_level))
 
             if level_counts[parent_level] == 1:
                 if parent_level == min(level_counts.keys()):
-                    children = [n for n in subgraph if subgraph.node[n]['prefixlen'] == parent_level + 1]
-                    if all('host' in subgraph.node[n] for n in children):
-                        subgraph.add_node(self.next_node_id, prefixlen = parent_level - 1)
+                    children = [n for n in nodes
+                            if self.prefixlen[n] == parent_level + 1]
+                    if all(self.host[n] is not None for n in children):
+                        nodes.append(self._add_node(parent_level - 1))
 
                     break # Reached top of tree
 
-    def build_tree(self, subgraph, level_counts, nodes_by_level):
+    def _build_tree(self, level_counts, nodes_by_level):
         smallest_prefix = min(level_counts.keys())
         for prefixlen in range(smallest_prefix, 32):
-            #TODO: fix sorting here
-            unallocated_children = set(nodes_by_level[prefixlen + 1])
+            # pair children to parents in node id order
+            unallocated_children = sorted(nodes_by_level[prefixlen + 1],
+                    reverse = True)
             for node in sorted(nodes_by_level[prefixlen]):
-                is_not_subnet = not ("host" in subgraph.node[node] or "group_attr" in subgraph.node[node])
-                if is_not_subnet:
-                    child_a = unallocated_children.pop()
-                    subgraph.add_edge(node, child_a)
-                    try:
-                        child_b = unallocated_children.pop()
-                        subgraph.add_edge(node, child_b)
-                    except KeyError:
-                        pass # single child, just attach
-
-        root_node = nodes_by_level[smallest_prefix][0]
-        return root_node
+                if self.host[node] is None and node not in self.group_attr:
+                    self._add_edge(node, unallocated_children.pop())
+                    if unallocated_children:
+                        self._add_edge(node, unallocated_children.pop())
 
-    def save(self):
-        import os
-        import gzip
-        archive_dir = os.path.join("versions", "ip")
-        if not os.path.isdir(archive_dir):
-            os.makedirs(archive_dir)
-
-        self.graph.graph['timestamp'] = self.timestamp
-        data = autonetkit.ank_json.ank_json_dumps(self.graph)
-#TODO: should this use the ank_json.jsonify_nidb() ?
-        json_file = "ip_%s.json.gz" % self.timestamp
-        json_path = os.path.join(archive_dir, json_file)
-        log.debug("Saving to %s" % json_path)
-        #with gzip.open(json_path, "wb") as json_fh:
-        with open(json_path, "wb") as json_fh:
-            json_fh.write(data)
+        return nodes_by_level[smallest_prefix][0]
 
     def build(self, group_attr = 'asn'):
-        """Builds tree from unallocated_nodes,
+        """Builds and allocates tree from unallocated_nodes,
         groupby is the attribute to build subtrees from"""
-        subgraphs = []
-
-# if network final octet is .0 eg 10.0.0.0 or 192.168.0.0, then add extra "dummy" node, so don't have a loopback of 10.0.0.0
-# Change strategy: if just hosts (ie loopbacks), then allocate as a large collision domain
         if not len(self.unallocated_nodes):
-# no nodes to allocate - eg could be no collision domains
             return
 
-        unallocated_nodes = self.unallocated_nodes
-        key_func  = lambda x: x.get(group_attr)
-        if all(isinstance(item, autonetkit.anm.overlay_interface) for item in unallocated_nodes):
-            key_func  = lambda x: x.node.get(group_attr) # interface, map key function to be the interface's node
+        overlay_interface = autonetkit.anm.overlay_interface
+        key_func = lambda x: x.get(group_attr)
+        if all(isinstance(item, overlay_interface)
+                for item in self.unallocated_nodes):
+            key_func = lambda x: x.node.get(group_attr)
 
-        unallocated_nodes = sorted(unallocated_nodes, key = key_func)
-        groupings = itertools.groupby(unallocated_nodes, key = key_func)
-        for attr_value, items in groupings:
-# make subtree for each attr
+        unallocated_nodes = sorted(self.unallocated_nodes,
+                key = lambda x: (key_func(x), host_key(x)))
+        root_nodes = []
+        for attr_value, items in itertools.groupby(unallocated_nodes,
+                key = key_func):
             items = list(items)
-            subgraph = nx.DiGraph()
-
-            if all(isinstance(item, autonetkit.anm.overlay_interface) for item in items):
-                # interface 
-                if all(item.is_loopback for item in items):
-                    parent_id = self.next_node_id
-                    prefixlen = 32 - subnet_size(len(items)) # group all loopbacks into single subnet
-                    subgraph.add_node(parent_id, prefixlen = prefixlen, loopback_group = True)
-                    for item in items:
-                    #subgraph.add_edge(node, child_a)
-                        item_id = self.next_node_id
-                        subgraph.add_node(item_id, prefixlen = 32, host = item)
-                        subgraph.add_edge(parent_id, item_id)
-
-                    root_node = parent_id
-                    subgraphs.append(subgraph)
-                    subgraph.graph['root'] = root_node
-                    subgraph.node[root_node]['group_attr'] = attr_value
-                    continue # finished for loopbacks, continue only for collision domains
-
-            if all(item.is_l3device for item in items): 
-                # Note: only l3 devices are added for loopbacks: cds allocate to edges not devices (for now) - will be fixed when move to proper interface model 
-                parent_id = self.next_node_id
-                prefixlen = 32 - subnet_size(len(items)) # group all loopbacks into single subnet
-                subgraph.add_node(parent_id, prefixlen = prefixlen, loopback_group = True)
+            if ((all(isinstance(item, overlay_interface) for item in items)
+                    and all(item.is_loopback for item in items))
+                    or all(item.is_l3device for item in items)):
+                # group all loopbacks into single subnet
+                root = self._add_node(32 - subnet_size(
+                    with_headroom(len(items), self.headroom)),
+                        loopback_group = True)
                 for item in items:
-                #subgraph.add_edge(node, child_a)
-                    item_id = self.next_node_id
-                    subgraph.add_node(item_id, prefixlen = 32, host = item)
-                    subgraph.add_edge(parent_id, item_id)
-
-                root_node = parent_id
-                subgraphs.append(subgraph)
-                subgraph.graph['root'] = root_node
-                subgraph.node[root_node]['group_attr'] = attr_value
-                continue # finished for loopbacks, continue only for collision domains
+                    self._add_edge(root, self._add_node(32, host = item))
+                self.group_attr[root] = attr_value
+                root_nodes.append(root)
+                continue
 
+            nodes = []
             for item in items:
                 if item.collision_domain:
-                    subgraph.add_node(self.next_node_id, prefixlen = 32 - subnet_size(item.degree()), host = item)
+                    nodes.append(self._add_node(32 - subnet_size(
+                        with_headroom(item.degree(), self.headroom)),
+                        host = item))
                 if item.is_l3device:
-                    subgraph.add_node(self.next_node_id, prefixlen = 32, host = item)
-
-            # now group by levels
-            level_counts = defaultdict(int)
-
-            nodes_by_level = defaultdict(list)
-            for node in subgraph.nodes():
-                prefixlen = subgraph.node[node]['prefixlen']
-                nodes_by_level[prefixlen].append(node)
+                    nodes.append(self._add_node(32, host = item))
 
             log.debug("Building IP subtree for %s %s" % (group_attr, attr_value))
+            level_counts = defaultdict(int)
+            for level, level_nodes in self._nodes_by_level(nodes).items():
+                level_counts[level] = len(level_nodes)
 
-            for level, nodes in nodes_by_level.items():
-                level_counts[level] = len(nodes)
-
+            # ensure root node isn't a cd
             min_level = min(level_counts)
-            # need to update level counts if added extra parent nodes,
-            # in order to ensure root node isn't a cd
             if level_counts[min_level] == 1:
-                # one node at this level -> added one parent at next level (node is a cd)
                 level_counts[min_level - 1] = 1
             elif level_counts[min_level] == 2:
-                # two nodes at this level -> added a grandparent (nodes are cds)
                 level_counts[min_level - 2] = 1
 
-            self.add_parent_nodes(subgraph, level_counts)
-
-            # rebuild with parent nodes
-            nodes_by_level = defaultdict(list)
-            for node in subgraph.nodes():
-                prefixlen = subgraph.node[node]['prefixlen']
-                nodes_by_level[prefixlen].append(node)
-
-            root_node = self.build_tree(subgraph, level_counts, nodes_by_level)
-            subgraphs.append(subgraph)
-
-            subgraph.graph['root'] = root_node
-#FOrce to be a /16 block
-#TODO: document this
-            subgraph.node[root_node]['prefixlen']  = 16
-            subgraph.node[root_node]['group_attr'] = attr_value
-
-        global_graph = nx.DiGraph()
-        subgraphs = sorted(subgraphs, key = lambda x: subgraph.node[subgraph.graph['root']]['group_attr'])
-        root_nodes = [subgraph.graph['root'] for subgraph in subgraphs]
-        root_nodes = []
-        for subgraph in subgraphs:
-            root_node = subgraph.graph['root']
-            root_nodes.append(root_node)
-            global_graph.add_node(root_node, subgraph.node[root_node])
-
-        nodes_by_level = defaultdict(list)
-        for node in root_nodes:
-            prefixlen = global_graph.node[node]['prefixlen']
-            nodes_by_level[prefixlen].append(node)
+            self._add_parent_nodes(nodes, level_counts)
+            root = self._build_tree(level_counts, self._nodes_by_level(nodes))
+            self.prefixlen[root] = 16
+            self.group_attr[root] = attr_value
+            root_nodes.append(root)
 
+        nodes = list(root_nodes)
         level_counts = defaultdict(int)
-        for level, nodes in nodes_by_level.items():
-            level_counts[level] = len(nodes)
-
-        self.add_parent_nodes(global_graph, level_counts)
-
-# rebuild nodes by level
-#TODO: make this a function
-        nodes_by_level = defaultdict(list)
-        for node in global_graph:
-            prefixlen = global_graph.node[node]['prefixlen']
-            nodes_by_level[prefixlen].append(node)
-
-        global_root = self.build_tree(global_graph, level_counts, nodes_by_level)
-        global_root = TreeNode(global_graph, global_root)
+        for level, level_nodes in self._nodes_by_level(root_nodes).items():
+            level_counts[level] = len(level_nodes)
+        self._add_parent_nodes(nodes, level_counts)
+        global_root = self._build_tree(level_counts,
+                self._nodes_by_level(nodes))
 
-        for subgraph in subgraphs:
-            global_graph = nx.compose(global_graph, subgraph)
-
-        # now allocate the IPs
-        global_prefix_len = global_root.prefixlen
-        global_ip_block = netaddr.IPNetwork("%s/%s" % (self.root_ip_block, global_prefix_len))
-        self.graph = global_graph
-
-# add children of collision domains
-        cd_nodes = [n for n in self if n.is_collision_domain()]
+        cd_nodes = [n for n in range(len(self)) if self.collision_domain[n]]
         for cd in cd_nodes:
-            for edge in sorted(cd.host.edges()):
-                #TODO: sort these
-                child_id = self.next_node_id
-                cd_id = cd.node
-                global_graph.add_node(child_id, prefixlen = 32, host = edge)
-                global_graph.add_edge(cd_id, child_id) # cd -> neigh (cd is parent)
-
-#TODO: make allocate seperate step
-        def allocate(node):
-            #children = graph.successors(node)
-            children = sorted(node.children())
-            prefixlen = node.prefixlen + 1
-
-            # workaround for clobbering attr subgraph root node with /16 if was a /28 
-            """
-            child_prefixlen = {c.prefixlen for c in children}.pop()
-            if (prefixlen) != child_prefixlen:
-                prefixlen = child_prefixlen
-            """
-
-            subnet = node.subnet.subnet(prefixlen)
-
-# handle case where children subnet 
-            if node.is_loopback_group() or node.is_collision_domain(): # special case of single AS -> root is loopback_group
-                #TODO: generalise this rather than repeated code with below
-                #node.subnet = subnet.next() # Note: don't break into smaller subnets if single-AS
-                iterhosts = node.subnet.iter_hosts() # ensures start at .1 rather than .0
-                sub_children = node.children()
-                for sub_child in sub_children:
-                    sub_child.subnet = iterhosts.next()
-
-                return
-
-            for child in children:
-                if child.is_collision_domain():
-                    child.subnet = subnet.next()
-                    iterhosts = child.subnet.iter_hosts() # ensures start at .1 rather than .0
-                    sub_children = child.children()
-                    for sub_child in sub_children:
-                        sub_child.subnet = iterhosts.next()
-                        log.debug( "Allocate sub_child to %s %s" % ( sub_child, sub_child.subnet))
-                elif child.is_host():
-                    child.subnet = subnet.next()
-                elif child.is_loopback_group():
-                    child.subnet = subnet.next()
-                    iterhosts = child.subnet.iter_hosts() # ensures start at .1 rather than .0
-                    sub_children = child.children()
-                    for sub_child in sub_children:
-                        sub_child.subnet = iterhosts.next()
-                else:
-                    child.subnet = subnet.next()
-                    allocate(child) # continue down the tree
-
-        global_root.subnet = global_ip_block
-#TODO: fix this workaround where referring to the wrong graph
-        global_root_id = global_root.node
-        global_root = TreeNode(global_graph, global_root_id)
-        allocate(global_root)
-
-# check for parentless nodes
-
-        self.graph = global_graph
+            self.children[cd] = [self._add_node(32, host = edge)
+                    for edge in sorted(self.host[cd].edges())]
+
+        self.value[global_root] = int(netaddr.IPAddress(self.root_ip_block))
+        self.subnet_prefixlen[global_root] = self.prefixlen[global_root]
         self.root_node = global_root
+        self.allocate(global_root)
+
+    def _lt(self, node, other):
+        """Orders nodes by host if both have one, otherwise by node id"""
+        host = self.host[node]
+        other_host = self.host[other]
+        if host and other_host:
+            return host < other_host
+        return node < other
+
+    def _subnets(self, node, prefixlen):
+        """Iterator of integer subnets of length prefixlen in node's subnet"""
+        size = 2 ** (32 - self.subnet_prefixlen[node])
+        first = self.value[node] - self.value[node] % size
+        if prefixlen < self.subnet_prefixlen[node]:
+            return iter([])
+        return iter(xrange(first, first + size, 2 ** (32 - prefixlen)))
+
+    def _hosts(self, node):
+        """Iterator of integer host addresses in node's subnet"""
+        size = 2 ** (32 - self.subnet_prefixlen[node])
+        first = self.value[node] - self.value[node] % size
+        if size >= 4:
+            return iter(xrange(first + 1, first + size - 1))
+        return iter(xrange(first, first + size))
+
+    def _allocate_hosts(self, node):
+        hosts = self._hosts(node)
+        for child in self.children.get(node, []):
+            self.value[child] = hosts.next()
+
+    def allocate(self, node):
+        if self.loopback_group[node] or self.collision_domain[node]:
+            self._allocate_hosts(node)
+            return
+
+        prefixlen = self.prefixlen[node] + 1
+        subnets = self._subnets(node, prefixlen)
+        children = sorted(self.children.get(node, []),
+                cmp = lambda a, b: -1 if self._lt(a, b) else 1)
+        for child in children:
+            self.value[child] = subnets.next()
+            self.subnet_prefixlen[child] = prefixlen
+            if self.collision_domain[child]:
+                self._allocate_hosts(child)
+            elif self.host[child]:
+                pass
+            elif self.loopback_group[child]:
+                self._allocate_hosts(child)
+            else:
+                self.allocate(child) # continue down the tree
+
+    def subnet(self, node):
+        """Returns netaddr subnet (or address) allocated to node"""
+        value = self.value[node]
+        if value is None:
+            return None
+        if self.subnet_prefixlen[node] is None:
+            return netaddr.IPAddress(value, 4)
+        return netaddr.IPNetwork((value, self.subnet_prefixlen[node]),
+                version = 4)
 
     def group_allocations(self):
         allocs = {}
-        for node in self:
-            if node.group_attr:
-                #TODO: Also need to store the type
-                allocs[node.group_attr] = [node.subnet]
-
+        for node, group_attr in sorted(self.group_attr.items()):
+            if group_attr:
+                allocs[group_attr] = [self.subnet(node)]
         return allocs
 
-    def add_nodes(self, nodes):
-        self.unallocated_nodes += list(nodes)
-
-    def walk(self):
-        def list_successors(node):
-            successors = self.graph.successors(node)
-            if successors:
-                children = [list_successors(n) for n in successors]
-                return {node: children}
-            return node
-
-        return list_successors(self.root_node)
+    def node_repr(self, node):
+        """Name of node in json"""
+        subnet = self.subnet(node)
+        if self.host[node]:
+            return "%s %s" % (subnet, self.host[node])
+        group_attr = self.group_attr.get(node)
+        if self.loopback_group[node]:
+            return "Lo Gr %s: %s" % (group_attr, subnet)
+        if group_attr:
+            return "%s: %s" % (group_attr, subnet)
+        if subnet:
+            return "%s" % subnet
+        return "TreeNode: %s" % node
 
     def json(self):
         def list_successors(node):
-            children = node.children()
+            children = self.children.get(node)
             if children:
                 children = [list_successors(n) for n in children]
-                return {"name": node,
-                        "subnet": node.subnet,
+                return {"name": self.node_repr(node),
+                        "subnet": self.subnet(node),
                         "children": children}
-            return {"name": node, "subnet": node.subnet}
+            return {"name": self.node_repr(node), "subnet": self.subnet(node)}
 
-        if not self.root_node:
+        if self.root_node is None:
             log.debug("No root node set")
             return {"name": str(self.root_ip_block),
                     "subnet": str(self.root_ip_block),
                     "children": []}
-            return
         return list_successors(self.root_node)
 
-    
     def assign(self):
-# assigns allocated addresses back to hosts
-        edges = [n for n in self if n.is_host() and n.host.src]
-        for edge in edges:
-            edge.host.ip_address = edge.subnet
-
-#TODO: do we need to store loopback groups into advertise addresses?
-
-        #loopback_groups = [n for n in self if n.is_loopback_group()]
-        #for loopback_group in loopback_groups:
-            #print loopback_group
-    
-        # don't look at host nodes now - use loopback_groups
-        host_tree_nodes = [n for n in self if n.is_host() and n.host.is_l3device]
-        #for host_tree_node in host_tree_nodes:
-            #print host_tree_node, host_tree_node.subnet
-        for host_tree_node in host_tree_nodes:
-            host_tree_node.host.loopback = host_tree_node.subnet
-
-        cds = [n for n in self if n.is_collision_domain()]
-        for cd in cds:
-            cd.host.subnet = cd.subnet
-
-        interfaces = [n for n in self if n.is_interface()]
-        for n in interfaces:
-            n.host.loopback = n.subnet
+        """Assigns allocated addresses back to hosts"""
+        overlay_interface = autonetkit.anm.overlay_interface
+        for node, host in enumerate(self.host):
+            if host is None:
+                continue
+            subnet = self.subnet(node)
+            if host and host.src:
+                host.ip_address = subnet
+            if host and host.is_l3device:
+                host.loopback = subnet
+            if self.collision_domain[node]:
+                host.subnet = subnet
+            if isinstance(host, overlay_interface):
+                host.loopback = subnet
+
+    def _subtree(self, node):
+        """Returns node and nodes below it"""
+        nodes = [node]
+        for child in self.children.get(node, []):
+            nodes += self._subtree(child)
+        return nodes
+
+    def _allocated_below(self, node):
+        """Returns hosts allocated a subnet below node, eg collision domains"""
+        nodes = []
+        for child in self.children.get(node, []):
+            if self.host[child] is None:
+                nodes += self._allocated_below(child)
+            else:
+                nodes.append(child)
+        return nodes
+
+    def journal_key(self, node):
+        """Identifies host of node across builds"""
+        host = self.host[node]
+        if isinstance(host, autonetkit.anm.overlay_interface):
+            return "%s %s" % (host.node_id, host.interface_id)
+        if isinstance(host, autonetkit.anm.OverlayEdge):
+            return "%s %s" % (host.src_id, host.dst_id)
+        return str(host.node_id)
+
+    def journal_entries(self):
+        """Returns allocations as strings, to keep with stabilise()"""
+        if self.root_node is None:
+            return {}
+        return {
+                'root': str(self.subnet(self.root_node)),
+                'groups': dict((str(group_attr), str(self.subnet(node)))
+                    for node, group_attr in self.group_attr.items()),
+                'entities': dict((self.journal_key(node), str(self.subnet(node)))
+                    for node, host in enumerate(self.host) if host is not None),
+                }
+
+    def stabilise(self, previous):
+        """Keeps allocations from previous journal_entries() of hosts still
+        present, allocating new hosts from free space in their group's block,
+        and new groups from free space in the root block.
+        Raises AnkAllocationConflict if there isn't space."""
+        if self.root_node is None or not previous:
+            return
+
+        groups = dict((key, parse_subnet(subnet))
+                for key, subnet in previous['groups'].items())
+        entities = dict((key, parse_subnet(subnet))
+                for key, subnet in previous['entities'].items())
+
+        # search for space in the larger of the previous and current root block
+        root_block = parse_subnet(previous['root'])
+        if root_block[1] > self.subnet_prefixlen[self.root_node]:
+            root_block = (self.value[self.root_node],
+                    self.subnet_prefixlen[self.root_node])
+        pool = AddressPool(*root_block)
+
+        moved = []
+        for root in sorted(self.group_attr):
+            previous_block = groups.get(str(self.group_attr[root]))
+            if not (previous_block
+                    and previous_block[1] <= self._required_prefixlen(root)
+                    and keep(pool, *previous_block)):
+                moved.append(root) # new, or previous block too small
+                continue
+
+            self.value[root], self.subnet_prefixlen[root] = previous_block
+            if self.loopback_group[root]:
+                self._stabilise_hosts(root, entities)
+            else:
+                self._stabilise_subnets(root, entities)
+
+        for root in moved:
+            first = pool.allocate(self.subnet_prefixlen[root])
+            offset = first - subnet_block(self.value[root],
+                    self.subnet_prefixlen[root])[0]
+            for node in self._subtree(root):
+                self.value[node] += offset
+
+    def _required_prefixlen(self, node):
+        """Longest prefixlen that fits node's children, without headroom"""
+        if self.loopback_group[node] or self.collision_domain[node]:
+            return 32 - subnet_size(len(self.children.get(node, [])))
+        return self.prefixlen[node]
+
+    def _pool(self, node):
+        """Returns AddressPool of node's subnet"""
+        return AddressPool(self.value[node], self.subnet_prefixlen[node])
+
+    def _stabilise_subnets(self, root, entities):
+        """Keeps subnets in entities of hosts below root that are
+        still large enough, and allocates the others from free space"""
+        pool = self._pool(root)
+        new_nodes = []
+        nodes = self._allocated_below(root)
+        for node in nodes:
+            previous = entities.get(self.journal_key(node))
+            if not (previous and previous[1] is not None
+                    and previous[1] <= self._required_prefixlen(node)
+                    and keep(pool, *previous)):
+                new_nodes.append(node) # new, or previous subnet too small
+                continue
+            self.value[node], self.subnet_prefixlen[node] = previous
+
+        for node in new_nodes:
+            self.value[node] = pool.allocate(self.prefixlen[node])
+            self.subnet_prefixlen[node] = self.prefixlen[node]
+
+        for node in nodes:
+            if self.collision_domain[node]:
+                self._stabilise_hosts(node, entities)
+
+    def _stabilise_hosts(self, node, entities):
+        """Keeps addresses in entities of children of node, and allocates
+        the others from free host addresses in node's subnet"""
+        pool = self._pool(node)
+        if self.subnet_prefixlen[node] <= 30:
+            pool.reserve(pool.first, 32) # network address
+            pool.reserve(pool.first + 2 ** (32 - pool.prefixlen) - 1, 32) # broadcast
+
+        new_children = []
+        for child in self.children.get(node, []):
+            previous = entities.get(self.journal_key(child))
+            if not (previous and previous[1] is None
+                    and keep(pool, previous[0], 32)):
+                new_children.append(child)
+                continue
+            self.value[child] = previous[0]
+
+        for child in new_children:
+            self.value[child] = pool.allocate(32)
+
+class AllocationJournal(object):
+    """Allocations of each tree from the previous build, kept in
+    versions/ip so rebuilds only allocate new nodes and collision domains"""
+    def __init__(self, filename=None):
+        if not filename:
+            filename = os.path.join("versions", "ip", "allocations.json")
+        self.filename = filename
+        self.trees = {}
+        try:
+            with open(filename, "r") as fh:
+                self.trees = json.load(fh)
+        except IOError:
+            log.debug("No previous IP allocations in %s" % filename)
+        except ValueError:
+            log.warning("Unable to read IP allocations in %s, reallocating"
+                    % filename)
+
+    def stabilise(self, name, ip_tree):
+        """Keeps previous allocations of tree name in ip_tree,
+        returns False if they can't be kept"""
+        try:
+            ip_tree.stabilise(self.trees.get(name))
+        except autonetkit.exception.AnkAllocationConflict, error:
+            log.warning("Unable to keep previous %s allocations: %s"
+                    % (name, error))
+            return False
+        return True
+
+    def record(self, name, ip_tree):
+        self.trees[name] = ip_tree.journal_entries()
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        log.debug("Saving IP allocations to %s" % self.filename)
+        with open(self.filename, "w") as fh:
+            json.dump(self.trees, fh, indent = 4, sort_keys = True)
+
+def allocate_tree(root_ip_block, nodes, journal = None, name = None,
+        headroom = 0):
+    """Returns allocated FlatIpTree of nodes, keeping allocations
+    of tree name in journal if set"""
+    nodes = list(nodes)
+    ip_tree = FlatIpTree(root_ip_block, headroom)
+    ip_tree.add_nodes(nodes)
+    ip_tree.build()
+    if journal is None:
+        return ip_tree
+
+    if not journal.stabilise(name, ip_tree):
+        ip_tree = FlatIpTree(root_ip_block, headroom) # fresh allocation
+        ip_tree.add_nodes(nodes)
+        ip_tree.build()
+    journal.record(name, ip_tree)
+    return ip_tree
 
 def assign_asn_to_interasn_cds(g_ip):
     G_phy = g_ip.overlay("phy")
@@ -435,15 +529,17 @@ def assign_asn_to_interasn_cds(g_ip):
 
     return
 
-def allocate_ips(g_ip, infrastructure = True, loopbacks = True, secondary_loopbacks = False):
+def allocate_ips(g_ip, infrastructure = True, loopbacks = True, secondary_loopbacks = False,
+        journal = None, headroom = 0):
     #TODO: tidy up the below comment and make all arguments default to False
-    """Can disable infrastructure, eg for ipv6, still want to alloc ipv4 loopbacks for router ids"""
+    """Can disable infrastructure, eg for ipv6, still want to alloc ipv4 loopbacks for router ids.
+    Keeps previous allocations recorded in journal (an AllocationJournal) if set.
+    headroom is percent extra space for loopback groups and collision domains"""
     loopback_tree = []
     if loopbacks:
         log.info("Allocating v4 Primary Host loopback IPs")
-        ip_tree = IpTree("192.168.2.0")
-        ip_tree.add_nodes(g_ip.nodes("is_l3device"))
-        ip_tree.build()
+        ip_tree = allocate_tree("192.168.2.0", g_ip.nodes("is_l3device"),
+                journal, "loopback", headroom)
         loopback_tree = ip_tree.json()
     # json.dumps(ip_tree.json(), cls=autonetkit.ank_json.AnkEncoder, indent = 4)
         #body = json.dumps({"ip_allocations": jsontree})
@@ -456,13 +552,12 @@ def allocate_ips(g_ip, infrastructure = True, loopbacks = True, secondary_loopba
     if secondary_loopbacks:
         log.info("Allocating v4 Secondary Host loopback IPs")
         #TODO: trim g_ip.nodes() to g_ip
-        ip_tree = IpTree("172.16.0.0")
         secondary_loopbacks = [i for n in g_ip.nodes()
                 for i in n.loopback_interfaces
                 if not i.is_loopback_zero]
 
-        ip_tree.add_nodes(secondary_loopbacks)
-        ip_tree.build()
+        ip_tree = allocate_tree("172.16.0.0", secondary_loopbacks,
+                journal, "secondary_loopback", headroom)
         secondary_loopback_tree = ip_tree.json()
     # json.dumps(ip_tree.json(), cls=autonetkit.ank_json.AnkEncoder, indent = 4)
         #body = json.dumps({"ip_allocations": jsontree})
@@ -474,10 +569,9 @@ def allocate_ips(g_ip, infrastructure = True, loopbacks = True, secondary_loopba
     cd_tree = []
     if infrastructure:
         log.info("Allocating v4 Infrastructure IPs")
-        ip_tree = IpTree("10.0.0.0")
         assign_asn_to_interasn_cds(g_ip)
-        ip_tree.add_nodes(g_ip.nodes("collision_domain"))
-        ip_tree.build()
+        ip_tree = allocate_tree("10.0.0.0", g_ip.nodes("collision_domain"),
+                journal, "infrastructure", headroom)
         cd_tree = ip_tree.json()
         ip_tree.assign()
     else:
@@ -3,6 +3,7 @@ import autonetkit.ank as ank_utils
 import autonetkit.log as log
 import autonetkit.ank_json
 import netaddr
+from autonetkit.plugins.address_pool import AddressPool
 
 messaging = autonetkit.ank_messaging.AnkMessaging()
 
@@ -27,6 +28,25 @@ def assign_asn_to_interasn_cds(G_ip):
 
     return
 
+def subnet(base, prefixlen, index):
+    """Returns index-th subnet of length prefixlen from integer base"""
+    return netaddr.IPNetwork((base + (index << (128 - prefixlen)), prefixlen),
+            version = 6)
+
+def host(base, index):
+    """Returns index-th address from integer base"""
+    return netaddr.IPAddress(base + index, 6)
+
+def allocate_cds(cds, base, prefixlen, start = 0):
+    """Allocates index-th subnet of prefixlen from base to each cd,
+    and addresses to its edges"""
+    for index, cd in enumerate(cds, start):
+        cd.subnet = subnet(base, prefixlen, index)
+        first = cd.subnet.first
+        # drop .0 and .1 as host addresses (valid but can be confusing)
+        for host_index, edge in enumerate(cd.edges(), 2):
+            edge.ip = host(first, host_index)
+
 def allocate_ips(G_ip):
     log.info("Allocating Host loopback IPs")
 
@@ -39,123 +59,57 @@ def allocate_ips(G_ip):
 
 #TODO: check if need to do network address... possibly only for loopback_pool and infra_pool so maps to asn
 
-    global_pool = netaddr.IPNetwork("2001:db8::/32").subnet(48)
-    global_pool = netaddr.IPNetwork("::/32").subnet(64)
-    global_pool.next() # network address
-    [global_pool.next() for i in range(9)] # consume generator to start infra at "a", loopbacks at "b"
-    loopback_pool = global_pool.next().subnet(80)
-    infra_pool = global_pool.next().subnet(80)
-    secondary_loopback_pool = global_pool.next().subnet(80)
+    # /64 from ::/32, start infra at "a", loopbacks at "b"
+    global_base = netaddr.IPNetwork("::/32").first
+    # pools of /80 per asn
+    loopback_pool = AddressPool(subnet(global_base, 64, 10).first, 64, version = 6)
+    infra_pool = AddressPool(subnet(global_base, 64, 11).first, 64, version = 6)
+    secondary_loopback_pool = AddressPool(subnet(global_base, 64, 12).first, 64, version = 6)
 
     # consume the first address as it is the network address
-    loopback_network = loopback_pool.next() # network address
-    infra_network = infra_pool.next() # network address
-    secondary_loopback_network = secondary_loopback_pool.next() # network address
+    loopback_network = loopback_pool.allocate_subnet(80) # network address
+    infra_network = infra_pool.allocate_subnet(80) # network address
+    secondary_loopback_network = secondary_loopback_pool.allocate_subnet(80) # network address
 
     unique_asns = set(n.asn for n in G_ip)
     for asn in sorted(unique_asns):
-        loopback_blocks[asn] = loopback_pool.next()
-        infra_blocks[asn] = infra_pool.next()
-        secondary_loopback_blocks[asn] = secondary_loopback_network.next()
+        loopback_blocks[asn] = loopback_pool.allocate_subnet(80)
+        infra_blocks[asn] = infra_pool.allocate_subnet(80)
+        secondary_loopback_blocks[asn] = secondary_loopback_pool.allocate_subnet(80)
 
     for asn, devices in G_ip.groupby("asn").items():
-        subnets = infra_blocks[asn].subnet(96)
-        subnets.next() # network address
-        ptp_subnet = subnets.next().subnet(126)
-        ptp_subnet.next() # network address
+        # first /96 is network address, second is split into ptp /126
+        infra_base = infra_blocks[asn].first
+        ptp_base = subnet(infra_base, 96, 1).first
         all_cds = set(d for d in devices if d.collision_domain)
         ptp_cds = [cd for cd in all_cds if cd.degree() == 2]
-
-        for cd in ptp_cds:
-            subnet = ptp_subnet.next()
-            hosts = subnet.iter_hosts()
-            hosts.next() # drop .0 as a host address (valid but can be confusing)
-            cd.subnet = subnet 
-            for edge in cd.edges():
-                edge.ip = hosts.next()
+        allocate_cds(ptp_cds, ptp_base, 126, start = 1) # skip network address
 
         non_ptp_cds = all_cds - set(ptp_cds)
         # break into /96 subnets
-        for cd in non_ptp_cds:
-            subnet = subnets.next()
-            hosts = subnet.iter_hosts()
-            hosts.next() # drop .0 as a host address (valid but can be confusing)
-            cd.subnet = subnet 
-            for edge in cd.edges():
-                edge.ip = hosts.next()
+        allocate_cds(non_ptp_cds, infra_base, 96, start = 2)
 
-
-        loopback_hosts = loopback_blocks[asn].iter_hosts()
-        loopback_hosts.next() # drop .0 as a host address (valid but can be confusing)
-        l3hosts = set(d for d in devices if d.is_l3device)
-        for host in sorted(l3hosts):
-            host.loopback = loopback_hosts.next()
+        # drop .0 and .1 as host addresses (valid but can be confusing)
+        loopback_base = loopback_blocks[asn].first
+        l3hosts = sorted(d for d in devices if d.is_l3device)
+        for index, l3host in enumerate(l3hosts, 2):
+            l3host.loopback = host(loopback_base, index)
 
         routers = [n for n in l3hosts if n.is_router] # filter
         secondary_loopbacks = [i for n in routers
                 for i in n.loopback_interfaces
                 if not i.is_loopback_zero]
 
-        secondary_loopback_hosts = secondary_loopback_blocks[asn].iter_hosts()
-        secondary_loopback_hosts.next() # drop .0 as a host address (valid but can be confusing)
-        for interface in sorted(secondary_loopbacks):
+        secondary_loopback_base = secondary_loopback_blocks[asn].first
+        for index, interface in enumerate(sorted(secondary_loopbacks), 2):
             #TODO: check sorting is first node, then interface
-            interface.loopback = secondary_loopback_hosts.next()
+            interface.loopback = host(secondary_loopback_base, index)
 
     # Store allocations for routing advertisement
 # convert blocks from being {asn: block} to {asn: [block]} for consistency with ipv4, and scalability with compiler if multiple blocks in future
     G_ip.data.infra_blocks = dict((asn, [subnet]) for asn, subnet in infra_blocks.items())
     G_ip.data.loopback_blocks = dict((asn, [subnet]) for asn, subnet in loopback_blocks.items())
 
-    jsontree = {}
-    infra_tree = []
-    loopback_tree = []
-
-    for asn in unique_asns:
-        children = []
-        for cd in G_ip.nodes('collision_domain', asn = asn):
-            cd_children = []
-            for edge in cd.edges():
-                cd_children.append( {
-                    'name': "%s %s" % (edge.ip, edge.dst),
-                    'subnet': edge.ip,
-                    })
-            children.append({
-                    'name': "%s %s" % (cd.subnet, cd.id),
-                    'subnet': cd.subnet,
-                    'children': cd_children,
-                    })
-        asn_infra_tree = {'subnet': infra_blocks[asn], 'name': "AS%s" % asn, 'children': children}
-        infra_tree.append( asn_infra_tree)
-
-
-        children = []
-        for host in sorted(G_ip.nodes("is_l3device", asn = asn)):
-            children.append({
-                'name': "%s %s" % (host.loopback, host.id),
-                'subnet': host.loopback,
-                })
-        loopback_tree.append({
-            'name': 'AS%s' % asn,
-            'subnet': loopback_blocks[asn],
-            'children': children,
-            })
-
-    infra_tree = {'name': "infra %s" % infra_network, 'children': infra_tree}
-    loopback_tree = {'name': "loopback %s" % loopback_network, 'subnet': '1.2.3.4', 'children': loopback_tree}
-
-    total_tree = {
-            'name': "IPv6",
-            'children': 
-            [loopback_tree, infra_tree],
-            #[infra_tree],
-            }
-
-    jsontree = json.dumps(total_tree, cls=autonetkit.ank_json.AnkEncoder, indent = 4)
-    
-    body = json.dumps({"ip_allocations": jsontree})
-    #messaging.publish_compressed("www", "client", body)
-
 
 #TODO: need to update with loopbacks if wish to advertise also - or subdivide blocks?
 
@@ -1,5 +1,7 @@
 import autonetkit.log as log
 import pkg_resources
+import netaddr
+from autonetkit.plugins.address_index import AddressIndex
 try:
     import textfsm
 except ImportError:
@@ -13,7 +15,7 @@ def sh_ip_route(nidb, data):
     print "\t".join(route)
     return
 
-def traceroute(nidb, data):
+def traceroute(nidb, data, index = None):
     template_file = pkg_resources.resource_filename(__name__, "../textfsm/linux/traceroute")
     template = open(template_file)
     re_table = textfsm.TextFSM(template)
@@ -24,25 +26,57 @@ def traceroute(nidb, data):
         route = route[0] # first element of table: todo make this programatic from table.header
         #print reverse_lookup(nidb, route)
 
+    if index is None:
+        index = address_index(nidb)
     try:
-        return [reverse_lookup(nidb, route[0])[1] for route in routes]
+        return [reverse_lookup(nidb, route[0], index)[1] for route in routes]
     except TypeError:
         log.info("Unable to parse %s" % routes)
         return []
 
 
-def reverse_lookup(nidb, address):
-    for node in nidb.nodes("is_l3device"):
-        if str(node.loopback) == address:
-            return ("loopback", node)
+def address_index(nidb):
+    """Returns AddressIndex of loopbacks and interface addresses of l3 nodes,
+    to (interface id, node), and interface subnets to first interface"""
+    index = AddressIndex()
+    nodes = list(nidb.nodes("is_l3device"))
+    for node in nodes:
+        if node.loopback:
+            index.add(node.loopback, ("loopback", node))
+        for interface in node.interfaces:
+            if interface.ipv4_address:
+                index.add(interface.ipv4_address, (interface.id, node))
 
+    for node in nodes:
         for interface in node.interfaces:
-            if str(interface.ipv4_address) == address:
-                return (interface.id, node)
-            
-    return None 
+            if interface.ipv4_subnet:
+                index.add(interface.ipv4_subnet, (interface.id, node))
+    return index
 
-def reverse_tap_lookup(nidb, address):
+def tap_index(nidb):
+    """Returns AddressIndex of tap addresses of l3 nodes"""
+    index = AddressIndex()
     for node in nidb.nodes("is_l3device"):
-        if str(node.tap.ip) == address:
-            return node
+        if node.tap and node.tap.ip:
+            index.add(node.tap.ip, node)
+    return index
+
+def reverse_lookup(nidb, address, index = None):
+    """Returns (interface id, node) with address, or else of the longest
+    subnet containing address, or None.
+    Pass index from address_index() when looking up many addresses"""
+    if index is None:
+        index = address_index(nidb)
+    try:
+        return index.get(address) or index.longest_match(address)
+    except (netaddr.AddrFormatError, ValueError):
+        return None # not an address, eg * for no response
+
+def reverse_tap_lookup(nidb, address, index = None):
+    """Returns node with tap address, or else of the longest match, or None"""
+    if index is None:
+        index = tap_index(nidb)
+    try:
+        return index.get(address) or index.longest_match(address)
+    except (netaddr.AddrFormatError, ValueError):
+        return None
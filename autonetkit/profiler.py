@@ -0,0 +1,155 @@
+"""Per-phase timing and memory instrumentation
+
+Enabled with --profile, or profile in the [General] section of the config.
+Records wall time, CPU time and peak RSS growth for build functions,
+platform compilers, node compiles and renders. Object counts are only taken
+for coarse phases (count_objects=True), as counting walks every object.
+
+>>> with profiler.phase("compile_node", nidb_node):
+...     compiler.compile(nidb_node)
+"""
+
+import os
+import gc
+import time
+import json
+import functools
+import autonetkit.log as log
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+enabled = False
+records = []
+_categories = [] # of phases currently running, outermost first
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    del records[:]
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1] # user + system
+
+def _peak_rss():
+    """Peak resident set size in kB, or None if unavailable"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    def __init__(self, category, name, count_objects):
+        self.category = category
+        self.name = str(name)
+        self.count_objects = count_objects
+
+    def __enter__(self):
+        self.depth = len(_categories)
+        self.nested = self.category in _categories
+        _categories.append(self.category)
+        self.objects = len(gc.get_objects()) if self.count_objects else None
+        self.rss = _peak_rss()
+        self.cpu = _cpu_time()
+        self.wall = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self.wall
+        cpu = _cpu_time() - self.cpu
+        _categories.pop()
+        record = {
+                'category': self.category,
+                'name': self.name,
+                'depth': self.depth,
+                'nested': self.nested, # within phase of same category
+                'wall': wall,
+                'cpu': cpu,
+                }
+        if self.rss is not None:
+            record['peak_rss_delta'] = _peak_rss() - self.rss
+        if self.objects is not None:
+            record['objects_delta'] = len(gc.get_objects()) - self.objects
+        records.append(record)
+        return False
+
+def phase(category, name, count_objects=False):
+    """Context manager recording a phase, if profiling is enabled"""
+    if not enabled:
+        return _NULL_PHASE
+    return _Phase(category, name, count_objects)
+
+def profiled(category, count_objects=False):
+    """Decorator recording each call of function as a phase"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with phase(category, func.__name__, count_objects):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
+
+def summarise(phase_records=None):
+    """Returns {category: {name: totals}} of phase_records"""
+    if phase_records is None:
+        phase_records = records
+    summary = {}
+    for record in phase_records:
+        totals = summary.setdefault(record['category'], {}).setdefault(
+                record['name'], {'count': 0, 'wall': 0, 'cpu': 0})
+        totals['count'] += 1
+        totals['wall'] += record['wall']
+        totals['cpu'] += record['cpu']
+        for key in ('peak_rss_delta', 'objects_delta'):
+            if key in record:
+                totals[key] = totals.get(key, 0) + record[key]
+    return summary
+
+def report():
+    return {
+            'phases': list(records),
+            'summary': summarise(),
+            }
+
+def write_report(filename="profile.json"):
+    with open(filename, "w") as fh:
+        json.dump(report(), fh, indent=4, sort_keys=True)
+    log.info("Wrote profile to %s" % filename)
+
+def log_summary(top=5):
+    """Logs totals per category, and the slowest phases in each"""
+    outermost = summarise([record for record in records
+        if not record['nested']]) # so recursive calls aren't double counted
+    for category, names in sorted(summarise().items()):
+        wall = sum(totals['wall'] for totals in outermost[category].values())
+        cpu = sum(totals['cpu'] for totals in outermost[category].values())
+        count = sum(totals['count'] for totals in names.values())
+        log.info("Profile %s: %s calls, %.3fs wall, %.3fs cpu" % (category,
+            count, wall, cpu))
+        slowest = sorted(names.items(), key=lambda item: item[1]['wall'],
+                reverse=True)[:top]
+        for name, totals in slowest:
+            memory = ""
+            if 'peak_rss_delta' in totals:
+                memory = ", peak RSS +%skB" % totals['peak_rss_delta']
+            if 'objects_delta' in totals:
+                memory += ", %+d objects" % totals['objects_delta']
+            log.info("    %s: %s calls, %.3fs wall, %.3fs cpu%s" % (name,
+                totals['count'], totals['wall'], totals['cpu'], memory))
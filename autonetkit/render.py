@@ -2,13 +2,17 @@ import mako
 from mako.lookup import TemplateLookup
 from mako.exceptions import SyntaxException
 import os
-import threading
-import Queue
 import time
 import shutil
 import fnmatch
+import traceback
+import multiprocessing
 import pkg_resources
 import autonetkit.log as log
+import autonetkit.profiler as profiler
+import autonetkit.exception
+import autonetkit.config
+settings = autonetkit.config.settings
 
 
 #TODO: clean up cache enable/disable
@@ -40,20 +44,55 @@ def remove_empty_folders(base):
             os.rmdir(directory)
             log.debug("Removing empty directory %s" % directory)
 
+def prepare_skeletons(nodes, folder_cache):
+    """Creates the folders of each node's render base in one pass,
+    for link_skeleton"""
+    for node in nodes:
+        render_base = node.render.base
+        if render_base not in folder_cache:
+            continue
+        render_base_output_dir = node.render.base_dst_folder
+        shutil.rmtree(render_base_output_dir, ignore_errors=True)
+        for folder in folder_cache[render_base]['folder_list']:
+            os.makedirs(os.path.normpath(
+                os.path.join(render_base_output_dir, folder)))
+
+def link_skeleton(src_folder, files, dst_folder):
+    """Hardlinks static files of src_folder into dst_folder,
+    copying if the filesystem doesn't support links"""
+    for filename in files:
+        src_file = os.path.join(src_folder, filename)
+        dst_file = os.path.normpath(os.path.join(dst_folder, filename))
+        try:
+            os.link(src_file, dst_file)
+        except OSError:
+            shutil.copy2(src_file, dst_file)
+
 def resource_path(relative):
     """Makes relative to package"""
     return pkg_resources.resource_filename(__name__, relative)
 
+def folder_template(render_base, template_file):
+    """Returns compiled template_file in render_base folder, from lookup"""
+    return lookup.get_template(os.path.normpath(
+        os.path.join(render_base, template_file)).replace(os.sep, "/"))
+
 #TODO: fix support here for template lookups, internal, user provided
-#template_cache_dir = config.template_cache_dir
-template_cache_dir = "cache"
+# compiled template modules, per Mako version as modules aren't compatible
+template_cache_dir = os.path.join(autonetkit.config.ank_user_dir, "cache",
+        "mako_%s" % mako.__version__)
 
-#disable cache for cleaner folder structure
+def module_directory():
+    """Directory to keep compiled templates in, if template_cache is set"""
+    if settings['General']['template_cache']:
+        return template_cache_dir
 
 #TODO: Also try for Cisco build here
 
+# Templates are compiled once per run: the lookup keeps them in memory by
+# uri, and recompiles if the template file's mtime changes
 lookup = TemplateLookup(directories=[resource_path("")],
-                        #module_directory= template_cache_dir,
+                        module_directory = module_directory(),
                         cache_type='memory',
                         cache_enabled=True,
                        )
@@ -107,11 +146,13 @@ def render_node(node, folder_cache):
                 dst_file = os.path.join(render_output_dir, node.render.dst_file)
                 with open( dst_file, 'wb') as dst_fh:
                     try:
-                        dst_fh.write(render_template.render(
-                            node = node,
-                            ank_version = ank_version,
-                            date = date,
-                            ))
+                        with profiler.phase("render_template",
+                                render_template_file):
+                            dst_fh.write(render_template.render(
+                                node = node,
+                                ank_version = ank_version,
+                                date = date,
+                                ))
                     except KeyError, error:
                         log.warning( "Unable to render %s: %s not set" % (node, error))
                     except AttributeError, error:
@@ -135,47 +176,46 @@ def render_node(node, folder_cache):
                             )
 
         if render_base:
-            mako_tmp_dir = "cache"
             if render_base in folder_cache:
                 src_folder = folder_cache[render_base]['folder']
                 fs_mako_templates = folder_cache[render_base]['templates']
                 folder_list = folder_cache[render_base]['folder_list']
+                link = folder_cache['_link_skeleton']
 
-                try:
-                    shutil.rmtree(render_base_output_dir)
-                except OSError:
-                    pass # doesn't exist
-                shutil.copytree(src_folder, render_base_output_dir)
-                #for folder in folder_list:
-                    #folder = os.path.normpath((os.path.join(render_base_output_dir, folder)))
-                    #os.mkdir(folder)
+                if link: # folders created by prepare_skeletons
+                    link_skeleton(src_folder, folder_cache[render_base]['files'],
+                            render_base_output_dir)
+                else:
+                    try:
+                        shutil.rmtree(render_base_output_dir)
+                    except OSError:
+                        pass # doesn't exist
+                    shutil.copytree(src_folder, render_base_output_dir)
 
                 for template_file in fs_mako_templates:
-                    render_base_rel = resource_path(render_base)
-                    template_file_path = os.path.normpath(os.path.join(render_base_rel, template_file))
-                    mytemplate = mako.template.Template(filename=template_file_path,
-# disabled cache
-#module_directory= mako_tmp_dir
-                            )
+                    mytemplate = folder_template(render_base, template_file)
                     dst_file = os.path.normpath((os.path.join(render_base_output_dir, template_file)))
                     dst_file, _ = os.path.splitext(dst_file) # remove .mako suffix
-                    rendered_template = mytemplate.render(
-                        node = node, 
-                        ank_version = ank_version,
-                        date = date,
-                        )
+                    with profiler.phase("render_template", template_file):
+                        rendered_template = mytemplate.render(
+                            node = node, 
+                            ank_version = ank_version,
+                            date = date,
+                            )
                     if len(rendered_template) > 0:
+                        if link and os.path.exists(dst_file):
+                            os.remove(dst_file) # don't write to linked file
                         with open( dst_file, 'wb') as dst_fh:
                             dst_fh.write(rendered_template)
 
-                remove_empty_folders(render_base_output_dir)
+                if not link: # else removed once all nodes rendered
+                    remove_empty_folders(render_base_output_dir)
                 return
                 
-            render_base = resource_path(render_base)
             fs_mako_templates = []
-            for root, dirnames, filenames in os.walk(render_base):
+            for root, dirnames, filenames in os.walk(resource_path(render_base)):
                 for filename in fnmatch.filter(filenames, '*.mako'):
-                    rel_root = os.path.relpath(root, render_base) # relative to fs root
+                    rel_root = os.path.relpath(root, resource_path(render_base)) # relative to fs root
                     fs_mako_templates.append(os.path.join(rel_root, filename))
 
 
@@ -188,15 +228,11 @@ def render_node(node, folder_cache):
                 shutil.rmtree(render_base_output_dir)
             except OSError:
                 pass # doesn't exist
-            shutil.copytree(render_base, render_base_output_dir, 
+            shutil.copytree(resource_path(render_base), render_base_output_dir, 
                     ignore=shutil.ignore_patterns('*.mako'))
 # now use templates
             for template_file in fs_mako_templates:
-                template_file_path = os.path.normpath(os.path.join(render_base, template_file))
-                mytemplate = mako.template.Template(filename=template_file_path,
-# disabled cache
-                        module_directory= mako_tmp_dir
-                        )
+                mytemplate = folder_template(render_base, template_file)
                 dst_file = os.path.normpath((os.path.join(render_base_output_dir, template_file)))
                 dst_file, _ = os.path.splitext(dst_file) # remove .mako suffix
                 #print("Writing %s"% dst_file)
@@ -213,11 +249,18 @@ def render_node(node, folder_cache):
             remove_empty_folders(render_base_output_dir)
         return
 
-def cache_folders(nidb):
-    #TODO: look at copying to clobber folders rather than shutil remove
+def cache_folders(nidb, nodes = None, link = False):
+    """Copies static files of each render base to a temporary folder,
+    and lists its templates. If link is set, the folder is in the current
+    directory, so its files can be hardlinked to rendered folders"""
     import tempfile
-    render_base = {node.render.base for node in nidb}
-    folder_cache_dir = tempfile.mkdtemp()
+    if nodes is None:
+        nodes = nidb
+    render_base = {node.render.base for node in nodes}
+    if link:
+        folder_cache_dir = tempfile.mkdtemp(prefix=".skeleton_", dir=".")
+    else:
+        folder_cache_dir = tempfile.mkdtemp()
     try:
         render_base.remove(None)
     except KeyError:
@@ -225,6 +268,7 @@ def cache_folders(nidb):
 
     folder_cache = {}
     folder_cache['_folder_cache_dir'] = folder_cache_dir
+    folder_cache['_link_skeleton'] = link
 
     for base in render_base:
         folder_list = []
@@ -234,13 +278,16 @@ def cache_folders(nidb):
                 ignore=shutil.ignore_patterns('*.mako'))
 
         fs_mako_templates = []
+        files = []
         for root, dirnames, filenames in os.walk(full_base):
             rel_root = os.path.relpath(root, full_base) # relative to fs root
             folder_list.append(rel_root)
             mako_templates = {f for f in filenames if f.endswith(".mako")}
             other_files = set(filenames) - set(mako_templates)
+            files += [os.path.join(rel_root, f) for f in sorted(other_files)]
             for filename in mako_templates:
                 fs_mako_templates.append(os.path.join(rel_root, filename))
+                folder_template(base, fs_mako_templates[-1]) # compile before render
 
 #TODO: push templates into a cache dir
 
@@ -248,65 +295,128 @@ def cache_folders(nidb):
                 'folder': base_cache_dir,
                 'templates': fs_mako_templates,
                 'folder_list': folder_list,
+                'files': files,
                 }
 
     return folder_cache
 
 
-def render(nidb):
-    #TODO: config option for single or multi threaded
+def render(nidb, node_ids = None, jobs = 1, link_skeleton = False):
+    """Renders nidb. If node_ids is set, only these nodes are rendered
+    (eg those changed since the last render), topologies are always rendered.
+    Nodes are rendered in up to jobs processes, 0 for one per CPU.
+    If link_skeleton is set, static files in render base folders are
+    hardlinked rather than copied into each node's folder"""
     log.info("Rendering Network")
-    folder_cache = cache_folders(nidb)
-    render_single(nidb, folder_cache)
-    #render_multi(nidb, folder_cache)
-    render_topologies(nidb)
-
+    nodes = None
+    if node_ids is not None:
+        nodes = [node for node in nidb if node.node_id in node_ids]
+        log.info("Rendering %s of %s nodes" % (len(nodes), len(nidb)))
+    folder_cache = cache_folders(nidb, nodes, link_skeleton)
+    try:
+        if link_skeleton:
+            prepare_skeletons(nodes or nidb, folder_cache)
+        if jobs == 1:
+            render_single(nidb, folder_cache, nodes)
+        else:
+            render_multi(nidb, folder_cache, nodes, jobs)
+        if link_skeleton:
+            for node in (nodes or nidb):
+                if node.render.base in folder_cache:
+                    remove_empty_folders(node.render.base_dst_folder)
+        render_topologies(nidb)
+    finally:
 #TODO: Also cache for topologies
+        folder_cache_dir = folder_cache['_folder_cache_dir']
+        shutil.rmtree(folder_cache_dir)
+
+def render_single(nidb, folder_cache, nodes = None):
+    if nodes is None:
+        nodes = nidb
+    for node in sorted(nodes):
+        with profiler.phase("render_node", node):
+            render_node(node, folder_cache)
+
+# Parallel rendering: workers are forked with the nidb and folder cache, so
+# only node indices are sent to them. Rendered files are written by the
+# workers; in-memory renders, errors and profiler records are sent back.
+
+# set before forking workers, so inherited rather than pickled
+_worker_nodes = None
+_worker_folder_cache = None
+
+def _render_nodes(indices):
+    """Renders nodes at indices in worker. Returns in-memory render of each
+    node (or None), errors as (node, traceback), and profiler records"""
+    profiler.reset() # only send back records from these nodes
+    to_memory = []
+    errors = []
+    for index in indices:
+        node = _worker_nodes[index]
+        try:
+            with profiler.phase("render_node", node):
+                render_node(node, _worker_folder_cache)
+        except Exception:
+            errors.append((str(node), traceback.format_exc()))
+        rendered = node.render.to_memory
+        to_memory.append(rendered if isinstance(rendered, basestring)
+                else None)
+    return indices, to_memory, errors, list(profiler.records)
+
+def render_multi(nidb, folder_cache, nodes = None, jobs = 0):
+    """Renders nodes in a pool of jobs processes, 0 for one per CPU.
+    Raises AnkRenderError listing nodes which failed, after rendering all"""
+    global _worker_nodes, _worker_folder_cache
+    if nodes is None:
+        nodes = nidb
+    nodes = sorted(nodes)
+    if not jobs:
+        jobs = multiprocessing.cpu_count()
+    if not hasattr(os, "fork"):
+        log.info("Parallel render requires fork, rendering sequentially")
+        jobs = 1
+    if jobs < 2 or len(nodes) < 2:
+        render_single(nidb, folder_cache, nodes)
+        return
 
-    folder_cache_dir = folder_cache['_folder_cache_dir']
-    shutil.rmtree(folder_cache_dir)
-
-def render_single(nidb, folder_cache):
-    for node in sorted(nidb):
-        render_node(node, folder_cache)
-
-def render_multi(nidb, folder_cache):
-        nidb_node_count = len(nidb)
-        num_worker_threads = 10
-        rendered_nodes = []
-        def worker():
-                while True:
-                    node = q.get()
-                    render_node(node, folder_cache)
-                    q.task_done()
-                    rendered_nodes.append(node.label)
-
-        q = Queue.Queue()
-
-        for i in range(num_worker_threads):
-            t = threading.Thread(target=worker)
-            t.setDaemon(True)
-            t.start()
-
-        # Sort so starup looks neater
-#TODO: fix sort
-        for node in sorted(nidb):
-            q.put(node)
-
-        while True:
-            """ Using this instead of q.join allows easy way to quit all threads (but not allow cleanup)
-            refer http://stackoverflow.com/questions/820111"""
-            time.sleep(1)
-            if len(rendered_nodes) == nidb_node_count:
-# all routers started
-                break
-            else:
-                #print "rendered", len(rendered_nodes)
-                pass
+    # interleaved chunks, a few per worker to balance load and report progress
+    chunk_count = min(len(nodes), jobs * 4)
+    chunks = [range(len(nodes))[i::chunk_count] for i in range(chunk_count)]
+
+    _worker_nodes = nodes
+    _worker_folder_cache = folder_cache
+    pool = multiprocessing.Pool(jobs)
+    rendered = reported = 0
+    errors = []
+    try:
+        for indices, to_memory, chunk_errors, records in pool.imap_unordered(
+                _render_nodes, chunks):
+            profiler.records.extend(records)
+            errors += chunk_errors
+            for index, rendered_template in zip(indices, to_memory):
+                if rendered_template is not None:
+                    nodes[index].render.to_memory = rendered_template
+            rendered += len(indices)
+            if 10 * rendered // len(nodes) > reported: # every 10%
+                reported = 10 * rendered // len(nodes)
+                log.info("Rendered %s of %s nodes" % (rendered, len(nodes)))
+    finally:
+        pool.close()
+        pool.join()
+        _worker_nodes = _worker_folder_cache = None
+
+    if errors:
+        for node, error in sorted(errors):
+            log.warning("Unable to render %s: %s" % (node, error))
+        raise autonetkit.exception.AnkRenderError(
+                "Unable to render %s of %s nodes: %s" % (len(errors), len(nodes),
+                    ", ".join(sorted(node for node, _ in errors))))
+    log.info("Rendered %s nodes in %s processes" % (len(nodes), jobs))
 
 def render_topologies(nidb):
     for topology in nidb.topology:
-        render_topology(topology)
+        with profiler.phase("render_topology", topology.topology_id):
+            render_topology(topology)
 
 def render_topology(topology):
     try:
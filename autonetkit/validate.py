@@ -1,4 +1,6 @@
 import autonetkit.log as log
+import netaddr
+from collections import defaultdict
 
 """TODO: map the log info/warning/debug to functions here
 # which then map to the appropriate log function, so that can handle either be verbose or not verbose to console with test information.
@@ -7,6 +9,8 @@ import autonetkit.log as log
 def validate(anm):
     tests_passed = True
     tests_passed = validate_ipv4(anm) and tests_passed
+    if anm.has_overlay("ipv6"):
+        tests_passed = validate_ipv6(anm) and tests_passed
 
     if tests_passed:
         log.info("All validation tests passed.")
@@ -26,54 +30,97 @@ def all_unique(items):
      return not any(i in seen or seen.add(i) for i in items)
 
 def duplicate_items(items):
-    unique = set(items)
-    counts = {i: items.count(i) for i in unique}
+    """Returns items occurring more than once"""
+    counts = defaultdict(int)
+    for i in items:
+        counts[i] += 1
     return [i for i in counts if counts[i] > 1]
 
 #TODO: add high-level symmetry, anti-summetry, uniqueness, etc functions as per NCGuard
 
 #TODO: make generic interface equal or unique function that takes attr
 
-def validate_ipv4(anm):
-    #TODO: make this generic to also handle IPv6
-    g_ipv4 = anm['ipv4']
-    # interface IP uniqueness
+def integer(address):
+    """Integer value of address, netaddr or string"""
+    try:
+        return int(address)
+    except ValueError:
+        return int(netaddr.IPAddress(address))
+
+def subnet_range(subnet):
+    """(first, last) integer addresses of subnet, netaddr or string"""
+    if not isinstance(subnet, netaddr.IPNetwork):
+        subnet = netaddr.IPNetwork(subnet)
+    return subnet.first, subnet.last
+
+def unique_addresses(addresses, description):
+    """addresses is list of (integer address, address, owner),
+    returns True if all integer addresses are unique, else logs duplicates"""
+    duplicate_ips = set(duplicate_items([a[0] for a in addresses]))
+    if not duplicate_ips:
+        log.debug("All %s globally unique" % description)
+        return True
+
+    duplicates = ", ".join("%s: %s" % (owner, address)
+            for (value, address, owner) in addresses if value in duplicate_ips)
+    log.warning("Global duplicate %s %s" % (description, duplicates))
+    return False
+
+def validate_ip(g_ip):
+    """Checks addresses in IPv4 or IPv6 overlay g_ip are unique, and that
+    interfaces on each collision domain have the same subnet, which
+    contains their address. Compares integer addresses."""
     tests_passed = True
 
-    # check globally unique ip addresses
-    all_ints = [i for n in g_ipv4.nodes("is_l3device")
-            for i in n.physical_interfaces]
-    all_int_ips = [i.ip_address for i in all_ints]
-
-    if all_unique(all_int_ips):
-        log.debug("All interface IPs globally unique")
-    else:
+    interface_ips = []
+    loopback_ips = []
+    for node in g_ip.nodes("is_l3device"):
+        if node.loopback is not None:
+            loopback_ips.append((integer(node.loopback), node.loopback, node))
+        for interface in node.loopback_interfaces:
+            if not interface.is_loopback_zero and interface.loopback is not None:
+                loopback_ips.append((integer(interface.loopback),
+                    interface.loopback, interface))
+        for interface in node.physical_interfaces:
+            if interface.ip_address is not None:
+                interface_ips.append((integer(interface.ip_address),
+                    interface.ip_address, interface.node))
+
+    tests_passed = unique_addresses(interface_ips,
+            "interface IP addresses") and tests_passed
+    tests_passed = unique_addresses(loopback_ips,
+            "loopback IP addresses") and tests_passed
+    overlaps = (set(a[0] for a in loopback_ips)
+            & set(a[0] for a in interface_ips))
+    if overlaps:
         tests_passed = False
-        duplicates = duplicate_items(all_int_ips)
-        duplicate_ips = set(duplicate_items(all_int_ips))
-        duplicate_ints = [n for n in all_ints 
-                if n.ip_address in duplicate_ips]
-        duplicates = ", ".join("%s: %s" % (i.node, i.ip_address)
-            for i in duplicate_ints)
-        log.warning("Global duplicate IP addresses %s" % duplicates)
-
-    for cd in g_ipv4.nodes("collision_domain"):
+        overlaps = ", ".join("%s: %s" % (owner, address) for (value, address,
+            owner) in loopback_ips + interface_ips if value in overlaps)
+        log.warning("Loopback IP addresses also on interfaces %s" % overlaps)
+
+    for cd in g_ip.nodes("collision_domain"):
         log.debug("Verifying subnet and interface IPs for %s" % cd)
-        neigh_ints = list(cd.neighbor_interfaces())
-        neigh_int_subnets = [i.subnet for i in neigh_ints]
+        neigh_ints = [i for i in cd.neighbor_interfaces()
+                if i.ip_address is not None and i.subnet is not None]
+        if not neigh_ints:
+            continue
+
+        # (first, last) integer addresses
+        neigh_int_subnets = [subnet_range(i.subnet) for i in neigh_ints]
         if all_same(neigh_int_subnets):
             # log ok
             pass
         else:
-            subnets = ", ".join("%s: %s" % (i.node, i.subnets)
-                    for i in neigh_int_subnets)
+            subnets = ", ".join("%s: %s" % (i.node, i.subnet)
+                    for i in neigh_ints)
             tests_passed = False
             log.warning("Different subnets on %s. %s" %
                     (cd, subnets))
             # log warning
 
-        ip_subnet_mismatches = [i for i in neigh_ints
-                    if i.ip_address not in i.subnet]
+        ip_subnet_mismatches = [i for i, (first, last)
+                in zip(neigh_ints, neigh_int_subnets)
+                if not first <= integer(i.ip_address) <= last]
         if len(ip_subnet_mismatches):
             tests_passed = False
             mismatches = ", ".join("%s not in %s on %s" % 
@@ -84,23 +131,22 @@ def validate_ipv4(anm):
         else:
             log.debug("All subnets match for %s" % cd)
 
-        neigh_int_ips = [i.ip_address for i in neigh_ints]
-        if all_unique(neigh_int_ips):
-            log.debug("All interface IP addresses unique for %s" % cd)
-            duplicates = duplicate_items(neigh_int_ips)
-        else:
-            tests_passed = False
-            duplicate_ips = set(duplicate_items(neigh_int_ips))
-            duplicate_ints = [n for n in neigh_ints 
-                    if n.ip_address in duplicate_ips]
-            duplicates = ", ".join("%s: %s" % (i.node, i.ip_address)
-                    for i in duplicate_ints)
-            log.warning("Duplicate IP addresses on %s. %s" %
-                    (cd, duplicates))
+    return tests_passed
 
+def validate_ipv4(anm):
+    tests_passed = validate_ip(anm['ipv4'])
     if tests_passed:
         log.info("All IPv4 tests passed.")
     else:
         log.warning("Some IPv4 tests failed.")
 
     return tests_passed
+
+def validate_ipv6(anm):
+    tests_passed = validate_ip(anm['ipv6'])
+    if tests_passed:
+        log.info("All IPv6 tests passed.")
+    else:
+        log.warning("Some IPv6 tests failed.")
+
+    return tests_passed
@@ -0,0 +1,330 @@
+"""Micro-benchmarks for AutoNetkit internals
+
+Usage: python benchmark.py [graphml_file]
+"""
+import sys
+import os
+import time
+import autonetkit.anm
+import autonetkit.log as log
+import autonetkit.build_network as build_network
+
+def load_input(filename=None):
+    if not filename:
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                "small_internet.graphml")
+    with open(filename, "r") as fh:
+        return build_network.load(fh.read())
+
+def best_time(func, repeat=5):
+    """Returns (best time over repeat runs, result of last run)"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+def count_wrappers(func):
+    """Counts OverlayNode, OverlayEdge and overlay_interface objects
+    created while running func"""
+    classes = [autonetkit.anm.OverlayNode, autonetkit.anm.OverlayEdge,
+            autonetkit.anm.overlay_interface]
+    counts = dict((cls.__name__, 0) for cls in classes)
+    originals = {}
+
+    def counting_init(cls, init):
+        def wrapped(self, *args, **kwargs):
+            counts[cls.__name__] += 1
+            init(self, *args, **kwargs)
+        return wrapped
+
+    for cls in classes:
+        originals[cls] = cls.__init__
+        cls.__init__ = counting_init(cls, cls.__init__)
+    try:
+        func()
+    finally:
+        for cls, init in originals.items():
+            cls.__init__ = init
+
+    return counts
+
+def wrapper_size(wrapper):
+    """Size in bytes of wrapper object, including any __dict__"""
+    size = sys.getsizeof(wrapper)
+    try:
+        size += sys.getsizeof(object.__getattribute__(wrapper, "__dict__"))
+    except AttributeError:
+        pass # __slots__
+    return size
+
+def benchmark_build(input_graph):
+    """Wrapper allocations and time for build_network.build()"""
+    build = lambda: build_network.build(input_graph.copy())
+    counts = count_wrappers(build)
+    duration, anm = best_time(build)
+
+    node = iter(anm['phy']).next()
+    print "build(): %.3fs" % duration
+    for name, count in sorted(counts.items()):
+        print "  %s created: %s" % (name, count)
+    print "  OverlayNode size: %s bytes" % wrapper_size(node)
+    print "  OverlayEdge size: %s bytes" % wrapper_size(
+            iter(anm['phy'].edges()).next())
+    print "  overlay_interface size: %s bytes" % wrapper_size(
+            iter(node.interfaces()).next())
+
+def interface_memory(anm):
+    """Returns (count, bytes) of distinct interface data dicts in all overlays"""
+    seen = {}
+    for overlay_id in anm.overlays():
+        graph = anm[overlay_id]._graph
+        for node, data in graph.nodes(data=True):
+            for interface_data in data.get("_interfaces", {}).values():
+                seen[id(interface_data)] = sys.getsizeof(interface_data)
+    return len(seen), sum(seen.values())
+
+def benchmark_interfaces(input_graph):
+    """Memory used by interface data after build_network.build()"""
+    anm = build_network.build(input_graph.copy())
+    count, size = interface_memory(anm)
+    print "interfaces: %s data dicts, %s bytes" % (count, size)
+
+def all_pairs_three_tier_ibgp_edges(routers):
+    """Previous implementation of three_tier_ibgp_edges, filtering all
+    pairs, for comparison"""
+    all_pairs = [(s, t) for s in routers for t in routers if s != t]
+    l1_l2_up_links = [(s, t) for (s, t) in all_pairs
+                      if (s.ibgp_level, t.ibgp_level) == (1, 2)
+                      and s.ibgp_l2_cluster == t.ibgp_l2_cluster
+                      and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    l2_l3_up_links = [(s, t) for (s, t) in all_pairs
+                      if (s.ibgp_level, t.ibgp_level) == (2, 3)
+                      and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    up_links = l1_l2_up_links + l2_l3_up_links
+    down_links = ([(t, s) for (s, t) in l1_l2_up_links]
+            + [(t, s) for (s, t) in l2_l3_up_links])
+    over_links = [(s, t) for (s, t) in all_pairs
+                  if s.ibgp_level == t.ibgp_level == 2
+                  and s.ibgp_l2_cluster == t.ibgp_l2_cluster
+                  and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    over_links += [(s, t) for (s, t) in all_pairs
+                   if s.ibgp_level == t.ibgp_level == 3]
+    corner_up, corner_down, corner_over = \
+            build_network.three_tier_ibgp_corner_cases(routers)
+    return (up_links + corner_up, down_links + corner_down,
+            over_links + corner_over)
+
+def all_pairs_two_tier_ibgp_edges(routers):
+    """Previous implementation of build_two_tier_ibgp, for comparison"""
+    all_pairs = [(s, t) for s in routers for t in routers if s != t]
+    up_links = [(s, t) for (s, t) in all_pairs
+                if (s.ibgp_level, t.ibgp_level) == (1, 2)
+                and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    down_links = [(t, s) for (s, t) in up_links]
+    over_links = [(s, t) for (s, t) in all_pairs
+                  if s.ibgp_level == t.ibgp_level == 2
+                  and s.ibgp_l3_cluster == t.ibgp_l3_cluster]
+    return up_links, down_links, over_links
+
+def ibgp_routers(count):
+    """Returns count bgp overlay routers in a single AS: 2% level 3,
+    10% level 2 and the rest level 1, in 4 l3 and 40 l2 clusters"""
+    import networkx as nx
+    graph = nx.Graph()
+    for index in range(count):
+        level = 3 if index % 50 == 0 else 2 if index % 10 == 0 else 1
+        graph.add_node("r%s" % index, asn=1, device_type="router",
+                ibgp_level=level, ibgp_l2_cluster="l2_%s" % (index % 40),
+                ibgp_l3_cluster="l3_%s" % (index % 4))
+    anm = autonetkit.anm.AbstractNetworkModel()
+    g_bgp = anm.add_overlay("bgp", graph=graph)
+    return list(g_bgp)
+
+def benchmark_ibgp(counts=(100, 300, 600)):
+    """Bucketed iBGP session generation against filtering all pairs"""
+    def session_ids(links):
+        return [[(s.node_id, t.node_id) for (s, t) in direction]
+                for direction in links]
+
+    cases = [("three tier", build_network.three_tier_ibgp_edges,
+            all_pairs_three_tier_ibgp_edges),
+            ("two tier", build_network.build_two_tier_ibgp,
+            all_pairs_two_tier_ibgp_edges)]
+    for count in counts:
+        routers = ibgp_routers(count)
+        for name, bucketed, all_pairs in cases:
+            old_time, old_links = best_time(lambda: all_pairs(routers),
+                    repeat=1)
+            new_time, new_links = best_time(lambda: bucketed(routers))
+            assert session_ids(old_links) == session_ids(new_links)
+            print "ibgp %s, %s routers: %s sessions, all pairs %.3fs, " \
+                    "bucketed %.3fs" % (name, count,
+                    sum(len(links) for links in new_links), old_time, new_time)
+
+def ip_overlay(router_count, asn_count):
+    """Returns ip overlay of router_count routers in asn_count ASes. Each
+    router has a link to the next router in its AS, every 10th also to a
+    router in another AS, and every 20th a LAN with three others in its AS.
+    Links and LANs are collision domains, as in build_ip."""
+    import networkx as nx
+    graph = nx.Graph()
+    routers = ["r%s" % index for index in range(router_count)]
+    for index, router in enumerate(routers):
+        graph.add_node(router, asn=index % asn_count + 1, device_type="router")
+    anm = autonetkit.anm.AbstractNetworkModel()
+    anm.add_overlay("phy", graph=graph.copy())
+
+    def add_cd(members):
+        cd = "cd_%s" % "_".join(members)
+        graph.add_node(cd, collision_domain=True,
+                asn=graph.node[members[0]]['asn'])
+        graph.add_edges_from((cd, member) for member in members)
+
+    for index in range(router_count - asn_count):
+        add_cd([routers[index], routers[index + asn_count]])
+        if index % 10 == 0:
+            add_cd([routers[index], routers[index + 1]])
+        if index % 20 == 0 and index + 3 * asn_count < router_count:
+            add_cd([routers[index + n * asn_count] for n in range(4)])
+    # allocation doesn't use interfaces
+    if hasattr(anm, "_set_overlay"):
+        anm._set_overlay("ip", graph)
+    else: # baseline commit, to compare allocators
+        anm.overlay_nx_graphs["ip"] = graph
+    return anm["ip"]
+
+def benchmark_ip_allocation(sizes=((1000, 10), (5000, 20), (10000, 50))):
+    """ipv4.allocate_ips, for (router count, ASN count) sizes.
+    To compare against the networkx IpTree allocator, run again with
+    PYTHONPATH set to a checkout of the baseline commit, eg from
+    git worktree add ../autonetkit-baseline <commit>"""
+    import autonetkit.plugins.ipv4 as ipv4
+    cases = [("infrastructure", dict(loopbacks=False)),
+            ("loopback", dict(infrastructure=False))]
+    for router_count, asn_count in sizes:
+        for name, kwargs in cases:
+            g_ip = ip_overlay(router_count, asn_count)
+            duration, _ = best_time(lambda: ipv4.allocate_ips(g_ip,
+                **kwargs), repeat=1)
+            print "ip %s, %s routers in %s ASes: %.3fs" % (name,
+                    router_count, asn_count, duration)
+
+def benchmark_ipv6_allocation(sizes=((1000, 10), (10000, 50))):
+    """ipv6.allocate_ips, for (router count, ASN count) sizes"""
+    import autonetkit.plugins.ipv6 as ipv6
+    for router_count, asn_count in sizes:
+        g_ip = ip_overlay(router_count, asn_count)
+        duration, _ = best_time(lambda: ipv6.allocate_ips(g_ip), repeat=1)
+        print "ipv6, %s routers in %s ASes: %s collision domains, %.3fs" % (
+                router_count, asn_count,
+                len(list(g_ip.nodes("collision_domain"))), duration)
+
+def compile_nidb(anm):
+    """Returns nidb of anm's routers, with interface ids set as platform
+    compilers do, and the routers to compile"""
+    from autonetkit.nidb import NIDB
+    nidb = NIDB()
+    routers = list(anm['phy'].nodes('is_router'))
+    nidb.add_nodes_from(routers, retain=['label', 'host', 'platform'])
+    nidb.copy_graphics(anm['graphics'])
+    nidb_nodes = [nidb.node(router) for router in routers]
+    for nidb_node in nidb_nodes:
+        for index, interface in enumerate(nidb_node.physical_interfaces):
+            interface.id = "eth%s" % index
+    return nidb, nidb_nodes
+
+def grid_input(dim, asn_count=4):
+    """Returns input graph of a dim x dim grid of routers, rows split
+    between asn_count ASes. As build_network.grid_2d, without deploy
+    settings."""
+    import networkx as nx
+    graph = nx.grid_2d_graph(dim, dim)
+    for (row, column) in graph:
+        graph.node[(row, column)].update(asn=row * asn_count // dim + 1,
+                x=row * 150, y=column * 150, device_type="router")
+    graph = nx.relabel_nodes(graph,
+            dict((n, "%s_%s" % n) for n in graph))
+    for index, (src, dst) in enumerate(sorted(graph.edges())):
+        graph[src][dst].update(type="physical",
+                edge_id="%s_%s_%s" % (index, src, dst))
+    return graph
+
+def benchmark_compile(input_graph, grid=20, repeat=3):
+    """Router compile time and wrapper allocations per router,
+    for each router compiler"""
+    import autonetkit.compiler as compiler
+    cases = [("input", build_network.build(input_graph.copy())),
+            ("%sx%s grid" % (grid, grid),
+                build_network.build(grid_input(grid)))]
+    compilers = [("quagga", compiler.QuaggaCompiler),
+            ("ios", compiler.IosClassicCompiler),
+            ("ios2", compiler.Ios2Compiler)]
+    for name, anm in cases:
+        for compiler_name, compiler_class in compilers:
+            def compile_all(nidb, nidb_nodes):
+                router_compiler = compiler_class(nidb, anm)
+                for nidb_node in nidb_nodes:
+                    router_compiler.compile(nidb_node)
+
+            best = None
+            for _ in range(repeat):
+                nidb, nidb_nodes = compile_nidb(anm)
+                start = time.time()
+                compile_all(nidb, nidb_nodes)
+                duration = time.time() - start
+                if best is None or duration < best:
+                    best = duration
+            counts = count_wrappers(lambda: compile_all(*compile_nidb(anm)))
+            router_count = len(nidb_nodes)
+            print "compile %s, %s, %s routers: %.2fms per router, " \
+                    "%s overlay_interface per router" % (compiler_name, name,
+                    router_count, 1000 * best / router_count,
+                    counts['overlay_interface'] / router_count)
+
+def benchmark_node_attrs(grids=(20, 40), repeat=5):
+    """Build time, and time of the vectorised node attribute functions,
+    with node attributes in dicts and in numpy columns"""
+    import autonetkit.anm_columns as anm_columns
+    import autonetkit.ank as ank
+    if anm_columns.numpy is None:
+        print "node attributes: numpy not installed"
+        return
+    for grid in grids:
+        for columnar in (False, True):
+            input_graph = grid_input(grid)
+            start = time.time()
+            anm = build_network.build(input_graph, columnar=columnar)
+            build_time = time.time() - start
+            g_phy = anm['phy']
+            g_ospf = anm['ospf']
+            def node_attrs():
+                g_phy.get_node_attr("asn")
+                g_phy.update(ospf_area=0)
+                g_phy.groupby("ospf_area")
+                g_phy.min_node_attr("x")
+                ank.copy_attr_from(g_phy, g_ospf, "asn", "asn_copy")
+            duration = best_time(node_attrs, repeat)[0]
+            print "node attributes, %sx%s grid, %s: build %.2fs, " \
+                    "get/update/groupby/min/copy %.2fms" % (grid, grid,
+                    "columns" if columnar else "dicts", build_time,
+                    1000 * duration)
+
+def main():
+    import autonetkit.log as log
+    log.logger.setLevel(log.logging.WARNING) # build logs at INFO
+    filename = sys.argv[1] if len(sys.argv) > 1 else None
+    input_graph = load_input(filename)
+    benchmark_build(input_graph)
+    benchmark_interfaces(input_graph)
+    benchmark_ibgp()
+    benchmark_ip_allocation()
+    benchmark_ipv6_allocation()
+    benchmark_compile(input_graph)
+    benchmark_node_attrs()
+
+if __name__ == "__main__":
+    main()